@@ -0,0 +1,83 @@
+"""
+Copyright (c) 2016 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Apache License, Version 2.0 (the "License").
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+The code, technical concepts, and all information contained herein, are the property of
+Cisco Technology, Inc. and/or its affiliated entities, under various laws including copyright,
+international treaties, patent, and/or contract. Any use of the material herein must be in
+accordance with the terms of the License.
+All rights not expressly granted by the License are reserved.
+
+Unless required by applicable law or agreed to separately in writing, software distributed under
+the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+either express or implied.
+
+Purpose:    Memory and CPU of a list of Events against an EventBatch, from collection to
+            the data collector payloads. Run from src/main/resources:
+                python -m benchmarks.events [number of events]
+
+"""
+
+import sys
+import time
+import tracemalloc
+
+from pnda_plugin import Event, EventBatch
+from sinks import json_payloads
+
+# fixed timestamps so both runs give the same payloads
+START_MILLIS = 1500000000000
+
+def collect(results, count):
+    '''
+    Events shaped like those of the Kafka whitebox: topic metrics of a few brokers
+    '''
+    for index in range(count):
+        results.append(Event(START_MILLIS + index,
+                             'kafka',
+                             'kafka.brokers.%d.topics.topic%d.BytesInPerSec.OneMinuteRate' % (index % 3 + 1, index // 21),
+                             [],
+                             index * 0.5 if index % 2 else index))
+    results.append(Event(START_MILLIS + count, 'kafka', 'kafka.health', ['broker(s) unreachable (b3:9092)'], 'ERROR'))
+    return results
+
+def measure(make, count):
+    '''
+    Seconds to collect count events and to serialise them, then the peak traced bytes of
+    both steps in a second traced run, and the payloads
+    '''
+    started = time.time()
+    results = collect(make(), count)
+    collected = time.time()
+    payloads = json_payloads(results)
+    done = time.time()
+    del results
+
+    tracemalloc.start()
+    results = collect(make(), count)
+    _, collect_peak = tracemalloc.get_traced_memory()
+    json_payloads(results)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return collected - started, done - collected, collect_peak, peak, payloads
+
+def main():
+    '''
+    Print the comparison
+    '''
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('%d events' % count)
+    print('%-12s %12s %12s %14s %14s' % ('', 'collect ms', 'encode ms', 'collect peak', 'overall peak'))
+    outcomes = {}
+    for name, make in [('list', list), ('EventBatch', EventBatch)]:
+        collect_time, encode_time, collect_peak, peak, payloads = measure(make, count)
+        outcomes[name] = payloads
+        print('%-12s %12.1f %12.1f %12.1fMB %12.1fMB' % (name, collect_time * 1000, encode_time * 1000,
+                                                         collect_peak / 1048576.0, peak / 1048576.0))
+    # the payloads only differ by the time they were made at, at their end
+    strip = lambda payloads: [payload[:payload.rindex(b'"timestamp"')] for payload in payloads]
+    print('same payloads: %s' % (strip(outcomes['list']) == strip(outcomes['EventBatch'])))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Copyright (c) 2016 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Apache License, Version 2.0 (the "License").
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+The code, technical concepts, and all information contained herein, are the property of
+Cisco Technology, Inc. and/or its affiliated entities, under various laws including copyright,
+international treaties, patent, and/or contract. Any use of the material herein must be in
+accordance with the terms of the License.
+All rights not expressly granted by the License are reserved.
+
+Unless required by applicable law or agreed to separately in writing, software distributed under
+the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+either express or implied.
+
+Purpose:    Import time of the monitor startup and of each plugin, from python -X importtime,
+            per top level package. Run from src/main/resources:
+                python -m benchmarks.imports [--check] [--top N]
+            --check fails if the startup (argument parsing, plugin discovery and logging
+            setup) imports any backend client
+
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+from collections import defaultdict
+
+HERE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# packages only the plugins (or the outputs) should import, and only when their mode needs them
+BACKENDS = ('kafka', 'kazoo', 'avro', 'happybase', 'thriftpy2', 'Hbase_thrift', 'eventlet',
+            'impala', 'prettytable', 'requests', 'urllib3', 'sinks')
+STARTUP = ("import sys; sys.argv = ['monitor.py', '--plugin', 'kafka'];"
+           "import monitor; monitor.read_args()")
+PLUGIN = "import monitor, importlib; importlib.import_module('plugins.%s.TestbotPlugin')"
+
+def import_times(code):
+    '''
+    Modules imported by running code in a fresh interpreter, as {module: (self us, cumulative us)}
+    and the microseconds spent importing them overall
+    '''
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=HERE,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    modules = {}
+    total = 0
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        nested = len(name) - len(name.lstrip())
+        name = name.strip()
+        modules[name] = (int(self_us), int(cumulative_us))
+        # the first level imports account for everything below them
+        if nested == 1:
+            total += int(cumulative_us)
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+    return modules, total
+
+def per_package(modules):
+    '''
+    Self time of the modules summed per top level package, most expensive first
+    '''
+    packages = defaultdict(int)
+    for name, (self_us, _) in modules.items():
+        packages[name.split('.')[0]] += self_us
+    return sorted(packages.items(), key=lambda item: -item[1])
+
+def backends(modules):
+    '''
+    Backend packages among the modules imported
+    '''
+    return sorted(set(name.split('.')[0] for name in modules) & set(BACKENDS))
+
+def report(title, modules, total, top):
+    '''
+    Print the import time of a phase and its most expensive packages
+    '''
+    print('%s: %.1fms, %d modules, backends: %s' % (title, total / 1000.0, len(modules),
+                                                    ', '.join(backends(modules)) or 'none'))
+    for package, self_us in per_package(modules)[:top]:
+        print('    %-30s %8.1fms' % (package, self_us / 1000.0))
+
+def main():
+    '''
+    Measure the startup then each plugin on top of it
+    '''
+    parser = argparse.ArgumentParser(description='Import time of monitor.py and of the plugins')
+    parser.add_argument('--check', action='store_const', const=True, default=False,
+                        help='exit with an error if the startup imports a backend')
+    parser.add_argument('--top', type=int, default=5, help='packages listed per phase, default 5')
+    args = parser.parse_args()
+
+    startup, total = import_times(STARTUP)
+    report('startup', startup, total, args.top)
+
+    sys.path.insert(0, HERE)
+    from monitor import discover_plugins
+    for plugin in discover_plugins():
+        try:
+            modules, _ = import_times(PLUGIN % plugin)
+        except RuntimeError as ex:
+            print('plugin %s: cannot be imported here (%s)' % (plugin, ex))
+            continue
+        added = dict((name, times) for name, times in modules.items() if name not in startup)
+        report('plugin %s' % plugin, added, sum(times[0] for times in added.values()), args.top)
+
+    if args.check and backends(startup):
+        print('startup imports %s' % ', '.join(backends(startup)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -23,19 +23,91 @@ Purpose:    Main program for starting a plugin stored in plugins/<plugin_name>.
 import argparse
 import os
 import sys
+import signal
 import logging
 import logging.config
-import json
 import time
 import importlib
-import requests
 
-from pnda_plugin import PluginException
+from pnda_plugin import PluginException, EventBatch, Event, SEVERITY, StepTimer, NO_STEP, set_run_timer
 
 HERE = os.path.abspath(os.path.dirname(__file__))
 logging.config.fileConfig("%s/logging.conf" % HERE)
 LOGGER = logging.getLogger("monitor")
-TIMESTAMP_MILLIS = lambda: int(time.time() * 1000)
+# keys of sinks.PAYLOADS and sinks.COMPRESSORS, sinks (and the clients it uses) is only
+# imported once the arguments are parsed, when an output is enabled
+PAYLOAD_FORMATS = ('compact', 'json')
+COMPRESSIONS = ('deflate', 'gzip')
+# schema of the records published by --kafka-sink
+AVRO_SCHEMA = "%s/plugins/kafka/dataplatform-raw.avsc" % HERE
+# source and metric prefix of the timings of the monitor itself, followed by the plugin name
+SELF_SOURCE = 'platform-testing'
+
+def is_health(event):
+    '''
+    True for a health event, always sent in delta mode
+    '''
+    return event.metric.endswith('.health') or (isinstance(event.value, str) and event.value in SEVERITY)
+
+class DeltaFilter(object):
+    '''
+    Keeps, out of the events of a run, the health events (a .health metric or an OK / WARN /
+    ERROR value) and the events whose value (or causes) changed since they were last sent.
+    Every keyframe_every runs, or on the run after request_keyframe(), everything is kept.
+    A float is only seen as changed when it moved by more than deadband (a fraction) of
+    the value last sent.
+    '''
+    def __init__(self, keyframe_every, deadband=0.0):
+        self.keyframe_every = keyframe_every
+        self.deadband = deadband
+        self.keyframe_requested = False
+        self._runs = 0
+        # (source, metric) -> (value, causes) last sent
+        self._sent = {}
+
+    def request_keyframe(self):
+        '''
+        Send everything on the next run
+        '''
+        self.keyframe_requested = True
+
+    def _changed(self, sent, value, causes):
+        last_value, last_causes = sent
+        if causes != last_causes:
+            return True
+        if isinstance(value, float) and isinstance(last_value, float):
+            return abs(value - last_value) > self.deadband * abs(last_value)
+        return value != last_value
+
+    def filter(self, events):
+        '''
+        Events of a run to send
+        '''
+        keyframe = self.keyframe_requested or self._runs % self.keyframe_every == 0
+        self._runs += 1
+        self.keyframe_requested = False
+        if keyframe:
+            # also forgets the metrics which are not reported any more
+            self._sent = {}
+
+        kept = EventBatch() if isinstance(events, EventBatch) else []
+        for event in events:
+            key = (event.source, event.metric)
+            causes = tuple(event.causes)
+            sent = self._sent.get(key)
+            if keyframe or sent is None or is_health(event) or self._changed(sent, event.value, causes):
+                self._sent[key] = (event.value, causes)
+                kept.append(event)
+        LOGGER.debug('%s: sending %d of %d events', 'keyframe' if keyframe else 'delta', len(kept), len(events))
+        return kept
+
+def discover_plugins():
+    '''
+    Names of the plugins found under plugins/, from the files alone without importing any of them
+    '''
+    plugins_dir = os.path.join(HERE, 'plugins')
+    return sorted(name for name in os.listdir(plugins_dir)
+                  if os.path.isfile(os.path.join(plugins_dir, name, 'TestbotPlugin.py')))
 
 def load_plugin(plugin_dir):
     '''
@@ -63,13 +135,59 @@ def read_args():
     parser = argparse.ArgumentParser(description= \
         'Monitor: collects test output from a specified plugin and sends via HTTP')
 
-    parser.add_argument('--plugin', type=str, help='plugin to run', required=True)
+    parser.add_argument('--plugin', type=str, choices=discover_plugins(), help='plugin to run', required=True)
     parser.add_argument('--postjson', type=str, help='endpoint for publishing results')
+    parser.add_argument('--post-compression', choices=COMPRESSIONS, \
+                            help='Content-Encoding the results are posted with, gzip or deflate (default none)')
+    parser.add_argument('--post-connect-timeout', type=float, default=5.0, \
+                            help='seconds to connect to the postjson endpoint, default 5')
+    parser.add_argument('--post-read-timeout', type=float, default=10.0, \
+                            help='seconds to wait for the postjson endpoint to answer, default 10')
+    parser.add_argument('--opentsdb', type=str, help='host:port of an OpenTSDB to put the numeric results to')
+    parser.add_argument('--opentsdb-batch', type=int, default=50, help='datapoints per OpenTSDB put, default 50')
+    parser.add_argument('--opentsdb-workers', type=int, default=4, help='concurrent OpenTSDB puts, default 4')
+    parser.add_argument('--kafka-sink', type=str, help='comma separated Kafka brokers to publish the results to')
+    parser.add_argument('--kafka-topic', type=str, default='avro.internal.platformtesting', \
+                            help='topic the results are published to, default avro.internal.platformtesting')
+    parser.add_argument('--kafka-linger', type=int, default=100, help='Kafka producer linger.ms, default 100')
+    parser.add_argument('--kafka-compression', choices=['gzip', 'snappy', 'lz4'], default='gzip', \
+                            help='Kafka producer compression, default gzip')
     parser.add_argument('--display', action='store_const', const=True, \
                             help='display results to stdout', default=False)
     parser.add_argument('--extra', type=str, help='arg string for the plugin to run')
-
-    return parser.parse_args()
+    parser.add_argument('--interval', type=float, \
+                            help='daemon mode: keep the plugin loaded and run it every interval seconds')
+    parser.add_argument('--metrics-port', type=int, \
+                            help='daemon mode: serve the latest results on http://host:port/metrics in the Prometheus text format')
+    parser.add_argument('--metrics-host', type=str, default='', help='address the metrics endpoint listens on, default all')
+    parser.add_argument('--delta', action='store_const', const=True, default=False, \
+                            help='daemon mode: only send health events and values which changed since they were last sent')
+    parser.add_argument('--keyframe-every', type=int, default=10, \
+                            help='with --delta, send every event every N runs (and after a SIGUSR1), default 10')
+    parser.add_argument('--deadband', type=float, default=0.0, \
+                            help='with --delta, fraction a float has to move by to be sent, e.g. 0.01')
+    parser.add_argument('--timings', action='store_const', const=True, default=False, \
+                            help='add the plugin runtime, event count and per step timings to the results')
+    parser.add_argument('--profile', type=str, metavar='DIRECTORY', \
+                            help='profile the plugin runs with cProfile and write their reports to DIRECTORY, '
+                            'the threads the plugin starts during a run are profiled too but not those started before it')
+    parser.add_argument('--profile-every', type=int, default=1, \
+                            help='with --profile in daemon mode, only profile every Nth run, default 1')
+    parser.add_argument('--profile-memory', action='store_const', const=True, default=False, \
+                            help='with --profile, also trace the allocations of the profiled runs with tracemalloc')
+    parser.add_argument('--profile-top', type=int, default=25, \
+                            help='with --profile-memory, allocation sites listed per run, default 25')
+    parser.add_argument('--profile-keep', type=int, default=10, \
+                            help='with --profile, reports of the last N profiled runs kept, default 10')
+    parser.add_argument('--format', choices=PAYLOAD_FORMATS, default='json', \
+                            help='payload format: json (data collector specification) or compact (events grouped per source)')
+
+    args = parser.parse_args()
+    if args.metrics_port is not None and args.interval is None:
+        parser.error('--metrics-port needs --interval')
+    if args.delta and args.interval is None:
+        parser.error('--delta needs --interval')
+    return args
 
 
 class TestbotCollector(object):
@@ -79,6 +197,29 @@ class TestbotCollector(object):
 
     def __init__(self, opts):
         self._options = opts
+        self._sinks = []
+        if opts.postjson or opts.opentsdb or opts.kafka_sink or opts.metrics_port is not None:
+            from sinks import HttpJsonSink, OpenTsdbSink, KafkaSink, PrometheusSink
+        if opts.postjson is not None:
+            self._sinks.append(HttpJsonSink(opts.postjson, opts.format, opts.post_compression,
+                                            (opts.post_connect_timeout, opts.post_read_timeout)))
+        if opts.opentsdb is not None:
+            self._sinks.append(OpenTsdbSink(opts.opentsdb, opts.opentsdb_batch, opts.opentsdb_workers))
+        if opts.kafka_sink is not None:
+            self._sinks.append(KafkaSink(opts.kafka_sink, opts.kafka_topic, AVRO_SCHEMA,
+                                         opts.kafka_linger, opts.kafka_compression))
+        if opts.metrics_port is not None:
+            # in delta mode an unchanged series is only sent again by the next keyframe
+            stale_after = opts.keyframe_every if opts.delta else 1
+            self._sinks.append(PrometheusSink(opts.metrics_port, opts.metrics_host, stale_after))
+        self._delta = None
+        if opts.delta and opts.interval is not None:
+            self._delta = DeltaFilter(max(opts.keyframe_every, 1), opts.deadband)
+        self._profiler = None
+        if opts.profile is not None:
+            from profiling import RunProfiler
+            self._profiler = RunProfiler(opts.profile, opts.profile_every, opts.profile_memory,
+                                         opts.profile_top, opts.profile_keep)
 
     def runner(self):
         '''
@@ -87,71 +228,114 @@ class TestbotCollector(object):
         plugin = load_plugin('plugins.%s' % self._options.plugin)
 
         if plugin is not None:
-            LOGGER.debug('Plugin %s starting', self._options.plugin)
-
-            events = []
             try:
+                if self._options.interval is None:
+                    self._run_plugin(plugin)
+                    return
+
+                # daemon mode, the same plugin instance is reused so it can keep
+                # state (cached endpoints, connections...) between runs
+                LOGGER.info('Plugin %s running every %ss', self._options.plugin, self._options.interval)
+                if self._delta is not None:
+                    signal.signal(signal.SIGUSR1, lambda signum, frame: self._delta.request_keyframe())
+                while True:
+                    started = time.time()
+                    try:
+                        self._run_plugin(plugin)
+                    except Exception: # pylint: disable=broad-except
+                        LOGGER.exception('Plugin %s run failed', self._options.plugin)
+                    time.sleep(max(0, self._options.interval - (time.time() - started)))
+            finally:
+                # flushes what the sinks still hold (the Kafka producer)
+                for sink in self._sinks:
+                    sink.close()
+
+    def _run_plugin(self, plugin):
+        '''
+        Run the plugin once and send the events it returns
+        '''
+        LOGGER.debug('Plugin %s starting', self._options.plugin)
+
+        events = []
+        # a timer of its own for each run, so nothing timed in a run is reported with another
+        timer = StepTimer() if self._options.timings else None
+        set_run_timer(timer)
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            if self._profiler is not None:
+                events = self._profiler.run(self._options.plugin, plugin.runner, self._options.extra, self._options.display)
+            else:
                 events = plugin.runner(self._options.extra, self._options.display)
-            except PluginException as ex:
-                logging.error('Plugin threw exception %s', ex)
-                import traceback
-                traceback.print_exc()
-
-            if self._options.postjson is not None:
-                self._send(events)
+        except PluginException as ex:
+            logging.error('Plugin threw exception %s', ex)
+            import traceback
+            traceback.print_exc()
+        finally:
+            set_run_timer(None)
+        if timer is not None:
+            events = self._add_timings(events, timer, started, time.perf_counter() - start)
+
+        if self._sinks:
+            if self._delta is not None:
+                # a failed send leaves a sink out of date, it is caught up by a keyframe
+                if not self._send(self._delta.filter(events), timer):
+                    self._delta.request_keyframe()
             else:
-                LOGGER.debug('postjson not enabled, not sending')
+                self._send(events, timer)
+            if timer is not None:
+                # the sends can only be timed once the events of the run are built, their
+                # timings follow them as more events of the same run
+                self._send(timer.events(SELF_SOURCE, self._timings_prefix()), more=True)
+        else:
+            LOGGER.debug('no output enabled, not sending')
 
-            LOGGER.debug('Plugin %s finished', self._options.plugin)
+        LOGGER.debug('Plugin %s finished', self._options.plugin)
 
-    def _send(self, events):
+    def _timings_prefix(self):
         '''
-        Send all the events in one pass in one payload
+        Prefix of the metrics of the timings of the plugin
+        '''
+        return '%s.%s' % (SELF_SOURCE, self._options.plugin)
+
+    def _add_timings(self, events, timer, started, seconds):
+        '''
+        Add the runtime and event count of the plugin run which started at started and
+        lasted seconds, then the steps timer timed during the run, to its events
+        '''
+        # a plugin may hand back a list it keeps between runs
+        if not isinstance(events, EventBatch):
+            events = list(events or [])
+        prefix = self._timings_prefix()
+        timestamp = int(started * 1000)
+        count = len(events)
+        events.append(Event(timestamp, SELF_SOURCE, '%s.runtime.ms' % prefix, [], round(seconds * 1000.0, 3)))
+        events.append(Event(timestamp, SELF_SOURCE, '%s.events' % prefix, [], count))
+        events.extend(timer.events(SELF_SOURCE, prefix))
+        return events
+
+    def _send(self, events, timer=None, more=False):
+        '''
+        Send all the events to every sink, timing each send on timer if there is one, returns
+        False if one of them failed. more events are sent as part of the run last sent
         '''
 
         LOGGER.debug("_send started")
+        sent = True
 
         if events:
-
-            json_datas = [{
-                "data": [(lambda ev: {
-                    "source": "%s" % ev.source,
-                    "metric": "%s" % ev.metric,
-                    "value": ev.value,
-                    "causes": "%s" % json.dumps(ev.causes),
-                    "timestamp": ev.timestamp
-                    })(ev) for ev in events],
-                "timestamp": TIMESTAMP_MILLIS()
-            }]
-
-            # 100kB limit from nodjs body parser https://github.com/expressjs/body-parser#limit-3
-            if len(json.dumps(json_datas[0])) > 102400:
-                json_datas = [{
-                    "data": [{
-                        "source": "%s" % ev.source,
-                        "metric": "%s" % ev.metric,
-                        "value": ev.value,
-                        "causes": "%s" % json.dumps(ev.causes),
-                        "timestamp": ev.timestamp
-                    }],
-                    "timestamp": TIMESTAMP_MILLIS()
-                } for ev in events]
-
-            headers = {'Content-Type': 'application/json', 'Connection':'close'}
-            for json_data in json_datas:
-
-                LOGGER.debug("_send data \n %s", json_data)
-
+            for sink in self._sinks:
                 try:
-                    response = requests.post(self._options.postjson, data=json.dumps(json_data), headers=headers)
-                    if response.status_code != 200:
-                        LOGGER.error("_send failed: %s", response.status_code)
-                except requests.exceptions.RequestException as ex:
-                    LOGGER.error("_send failed: %s", ex)
+                    with timer.step('send.%s' % sink.name) if timer is not None else NO_STEP:
+                        sent = (sink.send_more(events) if more else sink.send(events)) and sent
+                except Exception as ex: # pylint: disable=broad-except
+                    LOGGER.error("_send to %s failed: %s", sink.__class__.__name__, ex)
+                    sent = False
         else:
             LOGGER.debug("_send - no events to send")
 
         LOGGER.debug("_send finished")
+        return sent
 
 
 if __name__ == '__main__':
@@ -0,0 +1,91 @@
+"""
+Copyright (c) 2016 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Apache License, Version 2.0 (the "License").
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+The code, technical concepts, and all information contained herein, are the property of
+Cisco Technology, Inc. and/or its affiliated entities, under various laws including copyright,
+international treaties, patent, and/or contract. Any use of the material herein must be in
+accordance with the terms of the License.
+All rights not expressly granted by the License are reserved.
+
+Unless required by applicable law or agreed to separately in writing, software distributed under
+the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+either express or implied.
+
+Purpose:    Pooled HTTP session and concurrent fetch helpers shared by plugins
+
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+LOGGER = logging.getLogger("TestbotPlugin")
+
+DEFAULT_TIMEOUT = 10.0
+
+def new_session(pool_size=10, auth=None, headers=None):
+    '''
+    Returns a requests session with a connection pool large enough for
+    pool_size concurrent requests to the same host
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if auth is not None:
+        session.auth = auth
+    if headers:
+        session.headers.update(headers)
+    return session
+
+def fetch_all(fetch, keys, max_workers=None):
+    '''
+    Calls fetch(key) for every key on a bounded thread pool.
+    Returns an OrderedDict mapping each key (in input order) to a (result, error)
+    pair, where error is None on success and the raised exception otherwise.
+    '''
+    keys = list(keys)
+    results = OrderedDict()
+    if not keys:
+        return results
+
+    workers = min(max_workers or len(keys), len(keys))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(key, executor.submit(fetch, key)) for key in keys]
+        for key, future in futures:
+            try:
+                results[key] = (future.result(), None)
+            except Exception as ex: # pylint: disable=broad-except
+                LOGGER.error("fetch of %s failed: %s", key, ex)
+                results[key] = (None, ex)
+    return results
+
+class RateLimiter(object):
+    '''
+    Thread safe limiter spacing calls to acquire() so that no more than rate
+    of them go through per second (no limit if rate is 0)
+    '''
+    def __init__(self, rate):
+        self._interval = 1.0 / rate if rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def acquire(self):
+        '''
+        Block until the caller is allowed to make its call
+        '''
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.time()
+            wait = self._next - now
+            self._next = max(now, self._next) + self._interval
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,117 @@
+"""
+Copyright (c) 2016 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Apache License, Version 2.0 (the "License").
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+The code, technical concepts, and all information contained herein, are the property of
+Cisco Technology, Inc. and/or its affiliated entities, under various laws including copyright,
+international treaties, patent, and/or contract. Any use of the material herein must be in
+accordance with the terms of the License.
+All rights not expressly granted by the License are reserved.
+
+Unless required by applicable law or agreed to separately in writing, software distributed under
+the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+either express or implied.
+
+Purpose:    Light weight scan of the namenode LiveNodes / DeadNodes JSON strings
+
+"""
+
+import re
+import json
+import math
+from array import array
+from collections import namedtuple
+
+NodeStats = namedtuple('NodeStats', ['count', 'names', 'fields'])
+
+# per datanode details of LiveNodes used for the derived checks
+DATANODE_FIELDS = ('lastContact', 'remaining', 'xceiverCount')
+
+class _Compact(tuple):
+    '''
+    What remains of a decoded JSON object: only the wanted fields and nested objects
+    '''
+    pass
+
+def node_key(node):
+    '''
+    Metric path element of a node (host or host:port): dots and colons replaced so nodes
+    sharing a host do not collide and the host name does not add levels to the path
+    '''
+    return re.sub(r'[^A-Za-z0-9_-]', '_', node)
+
+def _compact_hook(wanted):
+    '''
+    Returns an object_pairs_hook which drops every member except the wanted fields,
+    so each node object is released as soon as the decoder is done with it instead
+    of the whole tree of per node details being built
+    '''
+    def hook(pairs):
+        return _Compact([pair for pair in pairs
+                         if pair[0] in wanted or isinstance(pair[1], _Compact)])
+    return hook
+
+def scan_nodes(text, fields=()):
+    '''
+    Count the keys of the top level JSON object in text without keeping its values,
+    which are expected to be objects as in the LiveNodes / DeadNodes attributes.
+    For each numeric field requested, the value found in every node object is collected
+    into an array('d'), aligned with names (NaN where the node does not have it).
+    Raises ValueError if text is not a JSON object.
+    '''
+    wanted = frozenset(fields)
+    nodes = json.JSONDecoder(object_pairs_hook=_compact_hook(wanted)).decode(text)
+    if not isinstance(nodes, _Compact):
+        raise ValueError('expected a JSON object')
+
+    names = []
+    collected = dict((field, array('d')) for field in fields)
+    if wanted:
+        for name, node in nodes:
+            names.append(name)
+            values = dict(node) if isinstance(node, _Compact) else {}
+            for field in fields:
+                try:
+                    collected[field].append(float(values.get(field, 'nan')))
+                except (TypeError, ValueError):
+                    collected[field].append(float('nan'))
+    return NodeStats(len(nodes), names, collected)
+
+def _median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+def find_above(stats, field, threshold):
+    '''
+    Names of the nodes whose field is above threshold
+    '''
+    return [name for name, value in zip(stats.names, stats.fields[field])
+            if not math.isnan(value) and value > threshold]
+
+def find_skewed(stats, field, tolerance):
+    '''
+    Names of the nodes whose field deviates from the median across all nodes
+    by more than tolerance (a fraction of the median). A skew relative to a median
+    of 0 (most nodes idle) is meaningless, so then no node is reported
+    '''
+    present = [value for value in stats.fields[field] if not math.isnan(value)]
+    if len(present) < 2:
+        return []
+    median = _median(present)
+    if median <= 0:
+        return []
+    return [name for name, value in zip(stats.names, stats.fields[field])
+            if not math.isnan(value) and abs(value - median) > tolerance * median]
+
+def datanode_outliers(stats, stale_secs, skew):
+    '''
+    Derived datanode checks on the stats of a LiveNodes scan done with DATANODE_FIELDS.
+    Returns a list of (metric, names of the offending datanodes) pairs
+    '''
+    return [('stale_datanodes', find_above(stats, 'lastContact', stale_secs)),
+            ('remaining_skewed_datanodes', find_skewed(stats, 'remaining', skew)),
+            ('xceiver_skewed_datanodes', find_skewed(stats, 'xceiverCount', skew))]
@@ -0,0 +1,44 @@
+"""
+Copyright (c) 2016 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Apache License, Version 2.0 (the "License").
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+The code, technical concepts, and all information contained herein, are the property of
+Cisco Technology, Inc. and/or its affiliated entities, under various laws including copyright,
+international treaties, patent, and/or contract. Any use of the material herein must be in
+accordance with the terms of the License.
+All rights not expressly granted by the License are reserved.
+
+Unless required by applicable law or agreed to separately in writing, software distributed under
+the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+either express or implied.
+
+Purpose:    Small statistics helpers used to summarise latency samples
+
+"""
+
+import math
+
+PERCENTILES = (50, 95, 99)
+
+def percentile(samples, pct):
+    '''
+    Nearest rank percentile of a sequence of samples, None if there are none
+    '''
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+def summarize(samples, percentiles=PERCENTILES):
+    '''
+    Returns a list of (name, value) pairs: count, min, max and the percentiles (p50...)
+    of the samples, or an empty list if there are none
+    '''
+    if not samples:
+        return []
+    ordered = sorted(samples)
+    summary = [('count', len(ordered)), ('min', ordered[0]), ('max', ordered[-1])]
+    summary.extend(('p%d' % pct, percentile(ordered, pct)) for pct in percentiles)
+    return summary
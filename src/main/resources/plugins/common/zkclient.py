@@ -23,12 +23,12 @@ import socket
 import logging
 import re
 
-from kafka.client import KafkaClient
 from kazoo.client import KazooClient
 from kazoo.exceptions import NoNodeError
 from kazoo.handlers.threading import KazooTimeoutError
 
 from plugins.common.defcom import ZkPartitions, KkBrokers, KkBrokersHealth
+from pnda_plugin import timed
 
 LOGGER = logging.getLogger("TestbotPlugin")
 
@@ -110,6 +110,7 @@ class ZkClient(object):
                 "zookeeper root node timeout (%s:%d)", self.host, self.port)
         return False
 
+    @timed('zk.topics')
     def topics(self):
         '''
         Returns a list of ZkPartitions tuples, where each tuple represents
@@ -159,6 +160,7 @@ class ZkClient(object):
                 break
         return found
 
+    @timed('zk.brokers')
     def brokers(self):
         '''
         Returns a list of KkBrokers tuples, where each tuple represents
@@ -180,6 +182,7 @@ class ZkClient(object):
                         bconnect += ","
                     bconnect += "%s:%d" % (host, port)
                     try:
+                        from kafka.client import KafkaClient
                         k = KafkaClient(bootstrap_servers="%s:%d" % (host, port))
                         if k is not None:
                             seq.append(KkBrokers(kkey, host, port, jmx, True))
@@ -18,19 +18,30 @@ Purpose:    Runs a series of tests on HDFS to check health
 """
 
 import time
-import threading
+from functools import partial
+from contextlib import ExitStack
 import argparse
 import logging
 import traceback
-import subprocess
-import happybase
+# happybase loads the Hbase_thrift module AlreadyExists comes from
+import happybase # pylint: disable=unused-import
 from Hbase_thrift import AlreadyExists
 from pnda_plugin import PndaPlugin
 from pnda_plugin import Event
+from pnda_plugin import HealthAggregator
+from pnda_plugin import MonitorStatus
+from plugins.hadoop_blackbox.hbase_bench import HBaseBench
+from plugins.common.httpclient import new_session
+from plugins.hadoop_blackbox.hbase_pool import HBasePool
+from plugins.hadoop_blackbox.webhdfs_probe import WebHdfsProbe, datanode_latencies
+from plugins.hadoop_blackbox.sql_probe import SqlSession, CREATE_TABLE, DROP_TABLE, INVALIDATE_METADATA, SELECT_ROW
+from plugins.hadoop_blackbox.stages import StageRunner, StageFailure, set_socket_timeout
 
 LOGGER = logging.getLogger("TESTBOTPLUGIN")
 TIMESTAMP_MILLIS = lambda: int(time.time() * 1000)
 TESTBOTPLUGIN = lambda: HadoopBlackboxPlugin()
+TEST_TABLE = 'blackbox_test_table'
+PROBE_TABLE = 'blackbox_probe_table'
 
 class HadoopBlackboxPlugin(PndaPlugin):
     '''
@@ -39,6 +50,17 @@ class HadoopBlackboxPlugin(PndaPlugin):
     the results of the explicit tests and in the case of problems, the list of causes from
     the blackbox tests and HDFS combined
     '''
+    def __init__(self):
+        self._runs = 0
+        # TTL the probe table was checked to have, None until it is
+        self._probe_ttl = None
+        self._pool = None
+        self._pool_key = None
+        self._sql_sessions = {}
+        self._hive_tables = set()
+        self._impala_tables = set()
+        self._webhdfs_session = None
+
     def read_args(self, args):
         '''
         This class argument parser.
@@ -53,12 +75,211 @@ class HadoopBlackboxPlugin(PndaPlugin):
         parser.add_argument('--hivehost', default="localhost", help='Hive host e.g. 10.0.0.2')
         parser.add_argument('--hiveport', default=10001, help='Hive port e.g. 10001')
         parser.add_argument('--impalaport', default=21050, help='Impala port e.g. 21050')
+        parser.add_argument('--hive', action='store_true', default=False,
+                            help='read the row written to HBase back through a Hive table mapped on the HBase table')
+        parser.add_argument('--hive-auth', default='PLAIN', help='HiveServer2 auth mechanism e.g. PLAIN')
+        parser.add_argument('--hive-http-path', default='cliservice',
+                            help='HiveServer2 HTTP path, empty for the binary transport e.g. cliservice')
+        parser.add_argument('--impalahost', default=None,
+                            help='Impala daemon to read the Hive table through instead of Hive e.g. 10.0.0.3')
+        parser.add_argument('--impala-auth', default='NOSASL', help='Impala auth mechanism e.g. NOSASL')
+        parser.add_argument('--timeout', default=60, type=float,
+                            help='overall time budget in seconds of the test sequence e.g. 60')
+        parser.add_argument('--stage-timeout', default=20, type=float,
+                            help='time budget in seconds of each step of the test sequence e.g. 20')
+        parser.add_argument('--webhdfs', default=None,
+                            help='namenode HTTP address to probe the HDFS data path through WebHDFS e.g. localhost:50070')
+        parser.add_argument('--webhdfs-user', default='hdfs', help='user the WebHDFS probe runs as e.g. hdfs')
+        parser.add_argument('--webhdfs-dir', default='/tmp/platform-testing',
+                            help='HDFS directory of the WebHDFS probe files e.g. /tmp/platform-testing')
+        parser.add_argument('--webhdfs-files', default=4, type=int,
+                            help='files written, appended to, read and deleted by the WebHDFS probe e.g. 4')
+        parser.add_argument('--webhdfs-size', default=1048576, type=int,
+                            help='bytes written to each WebHDFS probe file, and appended again e.g. 1048576')
+        parser.add_argument('--webhdfs-workers', default=4, type=int,
+                            help='concurrent WebHDFS probe requests e.g. 4')
+        parser.add_argument('--pool-size', default=1, type=int,
+                            help='HBase Thrift connections kept open between runs e.g. 1')
+        parser.add_argument('--pool-max-idle', default=50, type=float,
+                            help='seconds a pooled HBase connection may stay idle before it is reopened, keep it '
+                                 'below hbase.thrift.server.socket.read.timeout e.g. 50')
+        parser.add_argument('--ddl-every', default=1, type=int,
+                            help='run the create / drop table cycle every N runs, the other runs write '
+                                 'to a long lived probe table e.g. 20 (default: every run)')
+        parser.add_argument('--ddl', action='store_true', default=False,
+                            help='force the create / drop table cycle on this run')
+        parser.add_argument('--probe-ttl', default=3600, type=int,
+                            help='TTL in seconds of the rows written to the probe table e.g. 3600')
+        parser.add_argument('--bench-rows', default=0, type=int,
+                            help='rows written by the HBase benchmark, 0 to disable it e.g. 10000')
+        parser.add_argument('--bench-batch-size', default=100, type=int,
+                            help='rows per batch put in the HBase benchmark e.g. 100')
+        parser.add_argument('--bench-gets', default=100, type=int,
+                            help='random gets in the HBase benchmark e.g. 100')
+        parser.add_argument('--bench-scan-limit', default=1000, type=int,
+                            help='maximum rows scanned in the HBase benchmark e.g. 1000')
 
         return parser.parse_args(args)
 
+    @staticmethod
+    def _test_table(hbase):
+        '''
+        Table created and dropped again by the create / drop table cycles
+        '''
+        try:
+            hbase.create_table(TEST_TABLE, {'cf': dict()})
+            LOGGER.debug("test table created")
+        except AlreadyExists:
+            LOGGER.debug("test table exists")
+        return hbase.table(TEST_TABLE)
+
+    @staticmethod
+    def _drop_test_table(hbase):
+        hbase.disable_table(TEST_TABLE)
+        hbase.delete_table(TEST_TABLE)
+
+    def _acquire(self, options, stack):
+        '''
+        Connection from the pool kept across runs, (re)created when the options change
+        '''
+        key = (options.hbasehost, int(options.hbaseport), options.pool_size)
+        if self._pool is None or self._pool_key != key:
+            if self._pool is not None:
+                self._pool.close()
+            self._pool = HBasePool(options.pool_size, options.pool_max_idle,
+                                   host=options.hbasehost, port=int(options.hbaseport),
+                                   timeout=int(options.stage_timeout * 1000))
+            self._pool_key = key
+        return stack.enter_context(self._pool.connection(timeout=options.stage_timeout))
+
+    def _sql_session(self, name, **kwargs):
+        '''
+        HiveServer2 protocol session kept across runs, replaced when the options change
+        '''
+        session = self._sql_sessions.get(name)
+        if session is None or session.kwargs != kwargs:
+            if session is not None:
+                session.reset()
+            session = self._sql_sessions[name] = SqlSession(**kwargs)
+        return session
+
+    def _sql_steps(self, stages, options, hbase_table, row_key, test_value, ddl_cycle):
+        '''
+        Map a Hive table on the HBase table of the run and read the row written to it back,
+        through Impala when an Impala daemon is given, through Hive otherwise.
+        Returns the StageRunner holding the events of these steps
+        '''
+        sql = StageRunner('HIVE', options.timeout, options.stage_timeout)
+        sql.after(stages)
+        hive = self._sql_session('hive', host=options.hivehost, port=int(options.hiveport),
+                                 timeout=options.stage_timeout, auth_mechanism=options.hive_auth,
+                                 use_http_transport=bool(options.hive_http_path),
+                                 http_path=options.hive_http_path)
+        impala = None
+        if options.impalahost:
+            impala = self._sql_session('impala', host=options.impalahost, port=int(options.impalaport),
+                                       timeout=options.stage_timeout, auth_mechanism=options.impala_auth)
+        select = SELECT_ROW % (hbase_table, row_key)
+
+        def create_metadata():
+            hive.execute(CREATE_TABLE % (hbase_table, hbase_table))
+            # the mapping of the probe table is long lived like the table itself
+            if not ddl_cycle:
+                self._hive_tables.add(hbase_table)
+
+        def invalidate_metadata():
+            impala.execute(INVALIDATE_METADATA % hbase_table)
+            if not ddl_cycle:
+                self._impala_tables.add(hbase_table)
+
+        def check_row(rows):
+            if not rows or rows[0][0] != test_value:
+                raise StageFailure('Row read back through %s does not match the value written to HBase' %
+                                   ('Impala' if impala is not None else 'Hive'))
+
+        try:
+            sql.run('connection', 'connect to Hive', 'Failed to connect to HiveServer2', hive.open, required=True)
+            if ddl_cycle or hbase_table not in self._hive_tables:
+                sql.run('create_metadata', 'create Hive Metastore table',
+                        'CREATE EXTERNAL TABLE statement failed on Hive Metastore', create_metadata, required=True)
+
+            if impala is not None:
+                sql.run('connection', 'connect to Impala', 'Failed to connect to Impala',
+                        impala.open, required=True, source='IMPALA')
+                if ddl_cycle or hbase_table not in self._impala_tables:
+                    sql.run('invalidate_metadata', 'invalidate Impala metadata', 'INVALIDATE METADATA failed on Impala',
+                            invalidate_metadata, required=True, source='IMPALA')
+                sql.run('read', 'SELECT from Impala', 'Failed to SELECT from Impala',
+                        lambda: check_row(impala.query(select)), source='IMPALA')
+            else:
+                sql.run('read', 'SELECT from Hive', 'Failed to SELECT from Hive',
+                        lambda: check_row(hive.query(select)), source='HQUERY')
+
+            if ddl_cycle:
+                sql.run('drop_table', 'DROP table in Hive Metastore', 'Failed to DROP table in Hive Metastore',
+                        lambda: hive.execute(DROP_TABLE % hbase_table))
+        finally:
+            # a failed statement may leave the server side session or the connection unusable
+            for session in (hive, impala):
+                if session is not None:
+                    if sql.failures:
+                        session.reset()
+                    else:
+                        session.close_cursor()
+        return sql
+
+    def _webhdfs_steps(self, options, run_tag):
+        '''
+        Data path probe through WebHDFS, its events are kept out of the health fold below so
+        they do not override hadoop.HDFS.health from the HDFS plugin, it has its own health
+        '''
+        if self._webhdfs_session is None:
+            self._webhdfs_session = new_session(pool_size=max(options.webhdfs_workers, 1))
+        probe = WebHdfsProbe(self._webhdfs_session, options.webhdfs, options.webhdfs_user,
+                             options.webhdfs_dir, options.stage_timeout)
+        results, datanodes, errors = probe.run(run_tag, options.webhdfs_files, options.webhdfs_size,
+                                               options.webhdfs_workers)
+
+        events = [Event(TIMESTAMP_MILLIS(), 'HDFS', 'hadoop.HDFS.webhdfs.%s' % metric, [], value)
+                  for metric, value in results]
+        events.extend(Event(TIMESTAMP_MILLIS(), 'HDFS',
+                            'hadoop.HDFS.webhdfs.datanodes.%s.%s_ms' % (datanode, operation), [], value)
+                      for datanode, operation, value in datanode_latencies(datanodes))
+        events.append(Event(TIMESTAMP_MILLIS(), 'HDFS', 'hadoop.HDFS.webhdfs.health', errors,
+                            MonitorStatus["red"] if errors else MonitorStatus["green"]))
+        return events
+
+    def _probe_table(self, hbase, ttl):
+        '''
+        Long lived table used outside of the create / drop table cycles, created with a TTL
+        on its column family the first time it is needed so probe rows expire on their own.
+        The TTL of a table already there is checked then and whenever --probe-ttl changes:
+        Thrift cannot alter a column family, so a table with another TTL is created again
+        '''
+        if self._probe_ttl != ttl:
+            if PROBE_TABLE.encode() in hbase.tables():
+                current = hbase.table(PROBE_TABLE).families().get(b'cf', {}).get('time_to_live')
+                if current != ttl:
+                    LOGGER.warning("probe table TTL is %s instead of %d, creating it again", current, ttl)
+                    hbase.disable_table(PROBE_TABLE)
+                    hbase.delete_table(PROBE_TABLE)
+                    self._create_probe_table(hbase, ttl)
+            else:
+                self._create_probe_table(hbase, ttl)
+            self._probe_ttl = ttl
+        return hbase.table(PROBE_TABLE)
+
+    @staticmethod
+    def _create_probe_table(hbase, ttl):
+        try:
+            hbase.create_table(PROBE_TABLE, {'cf': dict(time_to_live=ttl, max_versions=1)})
+            LOGGER.debug("probe table created")
+        except AlreadyExists:
+            LOGGER.debug("probe table exists")
+
+
     def runner(self, args, display=True):
         values = []
-        health_values = []
 
         plugin_args = args.split() \
                     if args is not None and args.strip() \
@@ -66,409 +287,109 @@ class HadoopBlackboxPlugin(PndaPlugin):
 
         options = self.read_args(plugin_args)
 
+        # table create / drop are expensive HBase master operations, only run them every
+        # ddl_every runs (or on demand) and otherwise probe the data path on a long lived table
+        ddl_cycle = options.ddl or options.ddl_every <= 1 or self._runs % options.ddl_every == 0
+        self._runs += 1
+        values.append(Event(TIMESTAMP_MILLIS(),
+                            'HBASE',
+                            "hadoop.HBASE.ddl_cycle",
+                            [],
+                            ddl_cycle))
+
+        test_value = 'un1eqV4lu3'
+        run_tag = '%d' % TIMESTAMP_MILLIS()
+        row_key = 'row_key-%s' % run_tag
+
+        # every blocking call on the Thrift socket is bounded by the deadline of the stage it
+        # belongs to, so a stuck master or region server fails that stage instead of hanging
+        stages = StageRunner('HBASE', options.timeout, options.stage_timeout)
         hbase = None
 
-        def run_test_sequence():
-            test_value = 'un1eqV4lu3'
-            # pylint: disable=too-many-return-statements
-            hbase = happybase.Connection(host=options.hbasehost, port=int(options.hbaseport))
-            if abort_test_sequence is True:
-                return
-            reason = []
-            try:
-                start = TIMESTAMP_MILLIS()
-
-                try:
-                    hbase.create_table('blackbox_test_table', {'cf': dict()})
-                    logging.debug("test table created")
-                except AlreadyExists:
-                    logging.debug("test table exists")
-
-                table = hbase.table('blackbox_test_table')
-                end = TIMESTAMP_MILLIS()
-                create_table_ok = True
-                create_table_ms = end-start
+        def read_row():
+            row = table.row(row_key, columns=['cf:column'])
+            LOGGER.debug(row)
+            if row.get(b'cf:column', b'').decode() != test_value:
+                raise StageFailure('Row read back from HBase does not match the value written')
+
+        def run_bench():
+            bench = HBaseBench(table, run_tag, options.bench_rows,
+                               batch_size=options.bench_batch_size,
+                               gets=options.bench_gets,
+                               scan_limit=options.bench_scan_limit)
+            bench_results, missing = bench.run()
+            for metric, value in bench_results:
                 values.append(Event(TIMESTAMP_MILLIS(),
                                     'HBASE',
-                                    "hadoop.HBASE.create_table_time_ms",
+                                    "hadoop.HBASE.bench.%s" % metric,
                                     [],
-                                    create_table_ms))
-            except:
-                LOGGER.error(traceback.format_exc())
-                create_table_ok = False
-                reason = ['Create HBase table operation failed']
-            health_values.append(Event(TIMESTAMP_MILLIS(),
-                                       'HBASE',
-                                       "hadoop.HBASE.create_table_succeeded",
-                                       reason,
-                                       create_table_ok))
-
-            #write some data to it
-            if abort_test_sequence is True:
-                return
-            reason = []
-            try:
-                start = TIMESTAMP_MILLIS()
-                table.put('row_key', {'cf:column': test_value})
-                end = TIMESTAMP_MILLIS()
-                write_hbase_ok = True
-                write_hbase_ms = end-start
+                                    value))
+            if missing:
+                raise StageFailure('%d benchmark rows could not be read back from HBase' % missing)
+
+        stack = ExitStack()
+        try:
+            # acquisition (pool creation on the first run, reopening a stale connection) is
+            # reported on its own so it does not blur the timings of the operations below
+            acquired = stages.run('acquire_connection', 'connect to HBase', 'Failed to connect to HBase Thrift server',
+                                  lambda: self._acquire(options, stack), required=True)
+            if acquired is not None:
+                hbase, reused = acquired
+                stages.set_timeout = partial(set_socket_timeout, hbase)
                 values.append(Event(TIMESTAMP_MILLIS(),
                                     'HBASE',
-                                    "hadoop.HBASE.write_time_ms",
+                                    "hadoop.HBASE.connection_reused",
                                     [],
-                                    write_hbase_ms))
-            except:
-                LOGGER.error(traceback.format_exc())
-                write_hbase_ok = False
-                reason = ['Failed to insert row in HBase table']
-            health_values.append(Event(TIMESTAMP_MILLIS(),
-                                       'HBASE',
-                                       "hadoop.HBASE.write_succeeded",
-                                       reason,
-                                       write_hbase_ok))
+                                    reused))
+
+            if ddl_cycle:
+                table = stages.run('create_table', 'create HBase table', 'Create HBase table operation failed',
+                                   lambda: self._test_table(hbase), required=True)
+            else:
+                table = stages.run('probe_table', 'open HBase probe table', 'Unable to open the HBase probe table',
+                                   lambda: self._probe_table(hbase, options.probe_ttl), required=True)
+
+            #write some data to it
+            stages.run('write', 'write to HBase', 'Failed to insert row in HBase table',
+                       lambda: table.put(row_key, {'cf:column': test_value}))
 
             #read some data from it
-            if abort_test_sequence is True:
-                return
-            reason = []
-            try:
-                start = TIMESTAMP_MILLIS()
-                row = table.row('row_key', columns=['cf:column'])
-                end = TIMESTAMP_MILLIS()
-                read_hbase_ms = end-start
-                print(row)
-                read_hbase_ok = row[b'cf:column'].decode() == test_value
-                values.append(Event(TIMESTAMP_MILLIS(),
-                                    'HBASE',
-                                    "hadoop.HBASE.read_time_ms",
-                                    [],
-                                    read_hbase_ms))
-            except:
-                LOGGER.error(traceback.format_exc())
-                # hbase_fix_output = subprocess.check_output(['sudo',
-                #                                             '-u',
-                #                                             'hbase',
-                #                                             'hbase',
-                #                                             'hbck',
-                #                                             '-repair',
-                #                                             'blackbox_test_table'])
-                # for line in hbase_fix_output.splitlines():
-                #     if 'Status:' in line or 'inconsistencies detected' in line:
-                #         LOGGER.debug(line)
-                # subprocess.check_output(['sudo',
-                #                          '-u',
-                #                          'hbase',
-                #                          'hbase',
-                #                          'zkcli',
-                #                          'rmr',
-                #                          '/hbase/table/blackbox_test_table'])
-                # subprocess.check_output(['sudo',
-                #                          '-u',
-                #                          'hdfs',
-                #                          'hadoop',
-                #                          'fs',
-                #                          '-rm',
-                #                          '-r',
-                #                          '-f',
-                #                          '-skipTrash',
-                #                          '/hbase/data/default/blackbox_test_table'])
-
-                read_hbase_ok = False
-                reason = ['Failed to fetch row by row key from HBase']
-
-            health_values.append(Event(TIMESTAMP_MILLIS(),
-                                       'HBASE',
-                                       "hadoop.HBASE.read_succeeded",
-                                       reason,
-                                       read_hbase_ok))
-
-            #create some hive metadata
-            if abort_test_sequence is True:
-                return
-            # reason = []
-            # try:
-            #     start = TIMESTAMP_MILLIS()
-            #     create_table = """CREATE EXTERNAL TABLE blackbox_test_table (key STRING, value STRING)
-            #                       STORED BY \"org.apache.hadoop.hive.hbase.HBaseStorageHandler\"
-            #                       WITH SERDEPROPERTIES (\"hbase.columns.mapping\" = \":key,cf:column\") TBLPROPERTIES(\"hbase.table.name\" = \"blackbox_test_table\")"""
-            #     hive_output = run_hive_query(create_table)
-            #     logging.debug("hive metadata created")
-            #     end = TIMESTAMP_MILLIS()
-            #     create_metadata_ms = end-start
-            #     create_metadata_ok = True
-            #     values.append(Event(TIMESTAMP_MILLIS(),
-            #                         cdh.get_name('HIVE'),
-            #                         "hadoop.HIVE.create_metadata_time_ms",
-            #                         [],
-            #                         create_metadata_ms))
-            # except:
-            #     LOGGER.error(traceback.format_exc())
-            #     create_metadata_ok = False
-            #     reason = ['CREATE EXTERNAL TABLE statement failed on Hive Metastore']
-            # health_values.append(Event(TIMESTAMP_MILLIS(),
-            #                            cdh.get_name('HIVE'),
-            #                            "hadoop.HIVE.create_metadata_succeeded",
-            #                            reason,
-            #                            create_metadata_ok))
-
-            # #read some data via impala using it
-            # if abort_test_sequence is True:
-            #     return
-
-            # if cdh.get_impala_endpoint() is not None:
-            #     reason = []
-            #     try:
-            #         start = TIMESTAMP_MILLIS()
-            #         impala = connect(host=cdh.get_impala_endpoint(), port=options.impalaport)
-            #         end = TIMESTAMP_MILLIS()
-            #         impala.cursor().execute("invalidate metadata")
-            #         connect_to_impala_ms = end-start
-            #         connect_to_impala_ok = True
-            #         values.append(Event(TIMESTAMP_MILLIS(),
-            #                             cdh.get_name('IMPALA'),
-            #                             "hadoop.IMPALA.connection_time_ms",
-            #                             [],
-            #                             connect_to_impala_ms))
-            #     except:
-            #         LOGGER.error(traceback.format_exc())
-            #         connect_to_impala_ok = False
-            #         reason = ['Failed to connect to Impala']
-            #     health_values.append(Event(TIMESTAMP_MILLIS(),
-            #                                cdh.get_name('IMPALA'),
-            #                                "hadoop.IMPALA.connection_succeeded",
-            #                                reason,
-            #                                connect_to_impala_ok))
-
-            #     if abort_test_sequence is True:
-            #         return
-            #     reason = []
-            #     try:
-            #         start = TIMESTAMP_MILLIS()
-            #         impala_cursor = impala.cursor()
-            #         impala_cursor.execute("SELECT * FROM blackbox_test_table")
-            #         table_contents = impala_cursor.fetchall()
-            #         end = TIMESTAMP_MILLIS()
-            #         read_impala_ms = end-start
-            #         read_impala_ok = table_contents[0][1] == test_value
-            #         values.append(Event(TIMESTAMP_MILLIS(),
-            #                             cdh.get_name('IMPALA'),
-            #                             "hadoop.IMPALA.read_time_ms",
-            #                             [],
-            #                             read_impala_ms))
-            #     except:
-            #         LOGGER.error(traceback.format_exc())
-            #         read_impala_ok = False
-            #         reason = ['Failed to SELECT from Impala']
-            #     health_values.append(Event(TIMESTAMP_MILLIS(),
-            #                                cdh.get_name('IMPALA'),
-            #                                "hadoop.IMPALA.read_succeeded",
-            #                                reason,
-            #                                read_impala_ok))
-            # else:
-            #     reason = []
-            #     try:
-            #         start = TIMESTAMP_MILLIS()
-            #         hive_output = run_hive_query("SELECT * FROM blackbox_test_table")
-            #         end = TIMESTAMP_MILLIS()
-            #         read_hive_ms = end-start
-            #         read_hive_ok = test_value in hive_output
-            #         values.append(Event(TIMESTAMP_MILLIS(),
-            #                             cdh.get_name('HQUERY'),
-            #                             "hadoop.HQUERY.read_time_ms",
-            #                             [],
-            #                             read_hive_ms))
-            #     except:
-            #         LOGGER.error(traceback.format_exc())
-            #         read_hive_ok = False
-            #         reason = ['Failed to SELECT from Hive']
-            #     health_values.append(Event(TIMESTAMP_MILLIS(),
-            #                                cdh.get_name('HQUERY'),
-            #                                "hadoop.HQUERY.read_succeeded",
-            #                                reason,
-            #                                read_hive_ok))
-
-            # #delete metadata
-            # if abort_test_sequence is True:
-            #     return
-            # reason = []
-            # try:
-            #     start = TIMESTAMP_MILLIS()
-            #     hive_output = run_hive_query("DROP TABLE blackbox_test_table")
-            #     end = TIMESTAMP_MILLIS()
-            #     drop_metadata_ms = end-start
-            #     drop_metadata_ok = True
-            #     values.append(Event(TIMESTAMP_MILLIS(),
-            #                         cdh.get_name('HIVE'),
-            #                         "hadoop.HIVE.drop_table_time_ms",
-            #                         [],
-            #                         drop_metadata_ms))
-            # except:
-            #     LOGGER.error(traceback.format_exc())
-            #     drop_metadata_ok = False
-            #     reason = ['Failed to DROP table in Hive Metastore']
-            # health_values.append(Event(TIMESTAMP_MILLIS(),
-            #                            cdh.get_name('HIVE'),
-            #                            "hadoop.HIVE.drop_table_succeeded",
-            #                            reason,
-            #                            drop_metadata_ok))
+            stages.run('read', 'read from HBase', 'Failed to fetch row by row key from HBase', read_row)
+
+            #run the multi row benchmark, bounded by the overall budget rather than the stage one
+            if options.bench_rows > 0:
+                stages.run('bench', 'benchmark HBase', 'HBase multi row benchmark failed', run_bench,
+                           timeout=options.timeout)
+
+            #read it back through Hive or Impala
+            if options.hive:
+                sql = self._sql_steps(stages, options, TEST_TABLE if ddl_cycle else PROBE_TABLE,
+                                      row_key, test_value, ddl_cycle)
+                stages.values.extend(sql.values)
+                stages.health_values.extend(sql.health_values)
 
             #delete hbase table
-            if abort_test_sequence is True:
-                return
-            reason = []
-            try:
-                start = TIMESTAMP_MILLIS()
-                # Disabled deleting table to work around apparent hbase bug (see VPP-17) but leaving
-                # test step in so it can be easily re-enabled for testing.
-                hbase.disable_table('blackbox_test_table')
-                hbase.delete_table('blackbox_test_table')
-                end = TIMESTAMP_MILLIS()
-                drop_table_ms = end-start
-                drop_table_ok = True
-                values.append(Event(TIMESTAMP_MILLIS(),
-                                    'HBASE',
-                                    "hadoop.HBASE.drop_table_time_ms",
-                                    [],
-                                    drop_table_ms))
-            except:
-                LOGGER.error(traceback.format_exc())
-                drop_table_ok = False
-                reason = ['Failed to drop table in HBase']
-            health_values.append(Event(TIMESTAMP_MILLIS(),
-                                       'HBASE',
-                                       "hadoop.HBASE.drop_table_succeeded",
-                                       reason,
-                                       drop_table_ok))
-
-        def run_hive_query(query):
-            beeline_output = subprocess.check_output([
-                "beeline",
-                "-u", "jdbc:hive2://%s:%s/;transportMode=http;httpPath=cliservice" % (options.hivehost, options.hiveport),
-                "-e",
-                query])
-            logging.debug(beeline_output)
-            return beeline_output
-
-        def to_status(flag):
-            '''
-            Convert True to OK and False to ERROR
-            '''
-            if flag in [True, False]:
-                status = 'OK' if flag is True else 'ERROR'
-            else:
-                status = flag
-
-            return status
-
-        def default_health_value(name, service, operation, failed_step):
-            '''
-            Check health value
-            '''
-            result = False
-            if not ([event for event in health_values if event.metric == name]):
-                if failed_step is not None:
-                    message = 'Did not attempt to %s due to timeout waiting for: %s' % (operation,
-                                                                                        failed_step)
-                else:
-                    message = 'Timed out waiting for %s to complete' % operation
-
-                health_values.append(Event(TIMESTAMP_MILLIS(),
-                                           service,
-                                           name,
-                                           [message],
-                                           False))
-                result = True
-            return result
-
-        test_thread = threading.Thread(target=run_test_sequence)
-        test_thread.daemon = True
-        abort_test_sequence = False
-        test_thread.start()
-        test_thread.join(60.0)
-        abort_test_sequence = True
-        if hbase is not None:
-            hbase.close()
-        failed_step = None
-        if default_health_value("hadoop.HBASE.create_table_succeeded",
-                                "HBASE",
-                                "create HBase table",
-                                failed_step) and failed_step is None:
-            failed_step = "create HBase table"
-        if default_health_value("hadoop.HBASE.write_succeeded",
-                                "HBASE",
-                                "write to HBase",
-                                failed_step) and failed_step is None:
-            failed_step = "write to HBase"
-        if default_health_value("hadoop.HBASE.read_succeeded",
-                                "HBASE",
-                                "read from HBase",
-                                failed_step) and failed_step is None:
-            failed_step = "read from HBase"
-        # if default_health_value("hadoop.HIVE.create_metadata_succeeded",
-        #                         "HIVE",
-        #                         "create Hive Metastore table", failed_step) and failed_step is None:
-        #     failed_step = "create Hive Metastore table"
-        # if cdh.get_impala_endpoint() is not None:
-        #     if default_health_value("hadoop.IMPALA.connection_succeeded",
-        #                             "IMPALA",
-        #                             "connect to Impala", failed_step) and failed_step is None:
-        #         failed_step = "connect to Impala"
-        #     if default_health_value("hadoop.IMPALA.read_succeeded",
-        #                             "IMPALA",
-        #                             "SELECT from Impala", failed_step) and failed_step is None:
-        #         failed_step = "SELECT from Impala"
-        # else:
-        #     if default_health_value("hadoop.HQUERY.read_succeeded",
-        #                             "HQUERY",
-        #                             "SELECT from Hive", failed_step) and failed_step is None:
-        #         failed_step = "SELECT from Hive"
-        # if default_health_value("hadoop.HIVE.drop_table_succeeded",
-        #                         "HIVE",
-        #                         "DROP table in Hive Metastore",
-        #                         failed_step) and failed_step is None:
-        #     failed_step = "DROP table in Hive Metastore"
-        if default_health_value("hadoop.HBASE.drop_table_succeeded",
-                                "HBASE",
-                                "drop table in HBase", failed_step) and failed_step is None:
-            failed_step = "drop table in HBase"
+            if ddl_cycle:
+                stages.run('drop_table', 'drop table in HBase', 'Failed to drop table in HBase',
+                           lambda: self._drop_test_table(hbase))
+        finally:
+            stack.close()
+            if hbase is not None and stages.tainted:
+                self._pool.discard(hbase)
+
+        #probe the HDFS data path
+        if options.webhdfs:
+            values.extend(self._webhdfs_steps(options, run_tag))
+
+        values.extend(stages.values)
+        values.extend(stages.health_values)
 
         # cdh_status_indicators = cdh.get_status_indicators()
         # health_values.extend(cdh_status_indicators)
-        overall = {}
-        for health_val in health_values:
-            try:
-                current = overall[health_val.source]
-                current_val = to_status(current.value)
-                current_causes = current.causes
-            except KeyError:
-                current_val = 'OK'
-                current_causes = []
-
-            update = to_status(health_val.value)
-
-            # If current is ERROR, output is ERROR, regardless
-            # If current is WARN, output is WARN if update is OK but ERROR if further WARN or ERROR
-            # If update is OK, output is OK if OK, WARN if WARN and ERROR if ERROR
-
-            out = 'ERROR'
-            if current_val != "ERROR":
-                if current_val == 'WARN':
-                    if update == 'OK':
-                        out = 'WARN'
-                if current_val == 'OK':
-                    out = update
-            current_val = out
-            current_causes.extend(health_val.causes)
-
-            overall[health_val.source] = Event(health_val.timestamp,
-                                               health_val.source,
-                                               'hadoop.%s.health' % health_val.source,
-                                               current_causes,
-                                               current_val)
-
-        values.extend(health_values)
-        values.extend(overall.values())
+        # two warnings make an error, an ERROR stays an ERROR
+        overall = HealthAggregator(repeated_warn_is_error=True)
+        overall.add_events(stages.health_values)
+        values.extend(overall.events('hadoop.%s.health'))
 
         if display:
             self._do_display(values)
@@ -0,0 +1,124 @@
+"""
+Copyright (c) 2016 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Apache License, Version 2.0 (the "License").
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+The code, technical concepts, and all information contained herein, are the property of
+Cisco Technology, Inc. and/or its affiliated entities, under various laws including copyright,
+international treaties, patent, and/or contract. Any use of the material herein must be in
+accordance with the terms of the License.
+All rights not expressly granted by the License are reserved.
+
+Unless required by applicable law or agreed to separately in writing, software distributed under
+the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+either express or implied.
+
+Purpose:    Multi row HBase throughput benchmark for the hadoop blackbox plugin
+
+"""
+
+import time
+import random
+import logging
+
+from plugins.common.stats import summarize
+
+LOGGER = logging.getLogger("TestbotPlugin")
+COLUMN = 'cf:bench'
+ELAPSED_MS = lambda start: (time.time() - start) * 1000.0
+
+class HBaseBench(object):
+    '''
+    Writes rows in batches, then reads a random sample of them back and scans a
+    bounded range, recording throughput and per operation latencies.
+
+    Row keys are prefixed with one of a fixed number of salt buckets so the rows
+    of a run spread over the regions of a table split on those prefixes instead
+    of all landing in the region holding the current run tag.
+    '''
+    def __init__(self, table, run_tag, rows, batch_size=100, gets=100, scan_limit=1000,
+                 value_size=100, buckets=16):
+        self.table = table
+        self.run_tag = run_tag
+        self.rows = rows
+        self.batch_size = max(1, batch_size)
+        self.gets = min(gets, rows)
+        self.scan_limit = scan_limit
+        self.value = b'x' * value_size
+        self.buckets = buckets
+
+    def row_key(self, index):
+        '''
+        Salted row key of the index-th benchmark row
+        '''
+        return '%02x:%s:%08d' % (index % self.buckets, self.run_tag, index)
+
+    def write(self):
+        '''
+        Write all rows in batches, returns the per batch latencies in ms and rows/s
+        '''
+        latencies = []
+        started = time.time()
+        for first in range(0, self.rows, self.batch_size):
+            batch = self.table.batch()
+            for index in range(first, min(first + self.batch_size, self.rows)):
+                batch.put(self.row_key(index), {COLUMN: self.value})
+            sent = time.time()
+            batch.send()
+            latencies.append(ELAPSED_MS(sent))
+        return latencies, self.rows / max(time.time() - started, 1e-6)
+
+    def read(self):
+        '''
+        Get a random sample of the rows one by one, returns the per get latencies in ms,
+        rows/s and the number of rows not found or not matching
+        '''
+        latencies = []
+        missing = 0
+        started = time.time()
+        for index in random.sample(range(self.rows), self.gets):
+            sent = time.time()
+            row = self.table.row(self.row_key(index), columns=[COLUMN])
+            latencies.append(ELAPSED_MS(sent))
+            if row.get(COLUMN.encode()) != self.value:
+                missing += 1
+        return latencies, self.gets / max(time.time() - started, 1e-6), missing
+
+    def scan(self):
+        '''
+        Scan the rows of the first salt bucket up to scan_limit rows, returns the
+        time to the first row and the total scan time in ms, and rows/s
+        '''
+        first_row_ms = None
+        count = 0
+        started = time.time()
+        for _ in self.table.scan(row_prefix=('%02x:%s:' % (0, self.run_tag)).encode(),
+                                 columns=[COLUMN], limit=self.scan_limit,
+                                 batch_size=min(self.scan_limit, 1000)):
+            if first_row_ms is None:
+                first_row_ms = ELAPSED_MS(started)
+            count += 1
+        scan_ms = ELAPSED_MS(started)
+        return first_row_ms, scan_ms, count / max(scan_ms / 1000.0, 1e-6)
+
+    def run(self):
+        '''
+        Run the whole benchmark, returns a list of (metric, value) pairs and the
+        number of rows that could not be read back
+        '''
+        results = []
+        write_ms, write_rate = self.write()
+        results.append(('write_rows_per_sec', round(write_rate, 1)))
+        results.extend(('write_batch_ms.%s' % name, value) for name, value in summarize(write_ms))
+
+        get_ms, get_rate, missing = self.read()
+        results.append(('get_rows_per_sec', round(get_rate, 1)))
+        results.extend(('get_ms.%s' % name, value) for name, value in summarize(get_ms))
+
+        first_row_ms, scan_ms, scan_rate = self.scan()
+        results.append(('scan_rows_per_sec', round(scan_rate, 1)))
+        results.append(('scan_first_row_ms', first_row_ms))
+        results.append(('scan_ms', scan_ms))
+
+        LOGGER.debug("HBase benchmark of %d rows finished, %d missing", self.rows, missing)
+        return results, missing
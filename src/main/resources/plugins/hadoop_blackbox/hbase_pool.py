@@ -0,0 +1,95 @@
+"""
+Copyright (c) 2016 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Apache License, Version 2.0 (the "License").
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+The code, technical concepts, and all information contained herein, are the property of
+Cisco Technology, Inc. and/or its affiliated entities, under various laws including copyright,
+international treaties, patent, and/or contract. Any use of the material herein must be in
+accordance with the terms of the License.
+All rights not expressly granted by the License are reserved.
+
+Unless required by applicable law or agreed to separately in writing, software distributed under
+the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+either express or implied.
+
+Purpose:    Health checked HBase Thrift connections kept open between blackbox runs
+
+"""
+
+import time
+import socket
+import logging
+import contextlib
+
+import happybase
+from plugins.hadoop_blackbox.stages import thrift_socket
+
+LOGGER = logging.getLogger("TESTBOTPLUGIN")
+
+def peer_closed(sock):
+    '''
+    True if the other end closed the socket, or sent something nobody is waiting for,
+    checked without blocking nor consuming any data
+    '''
+    timeout = sock.gettimeout()
+    sock.settimeout(0.0)
+    try:
+        sock.recv(1, socket.MSG_PEEK)
+        return True
+    except (BlockingIOError, InterruptedError):
+        return False
+    except socket.error:
+        return True
+    finally:
+        sock.settimeout(timeout)
+
+class HBasePool(object):
+    '''
+    happybase connection pool whose connections are checked before being handed out:
+    a connection idle for longer than max_idle (the Thrift server drops idle clients after
+    hbase.thrift.server.socket.read.timeout) or closed by the server is reopened first.
+    '''
+    def __init__(self, size, max_idle, **kwargs):
+        self.max_idle = max_idle
+        self._last_used = {}
+        self._pool = happybase.ConnectionPool(size, **kwargs)
+
+    def _healthy(self, connection):
+        last_used = self._last_used.get(connection)
+        if last_used is None or time.time() - last_used > self.max_idle:
+            return False
+        sock = thrift_socket(connection)
+        return sock is not None and not peer_closed(sock)
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        '''
+        Yields an open connection and whether it is one kept open since an earlier use.
+        timeout is how long to wait for a free connection, as in happybase
+        '''
+        with self._pool.connection(timeout) as connection:
+            reused = self._healthy(connection)
+            if not reused and connection in self._last_used:
+                LOGGER.debug("reopening stale HBase connection")
+                connection.close()
+                connection.open()
+            try:
+                yield connection, reused
+            finally:
+                self._last_used[connection] = time.time()
+
+    def close(self):
+        '''
+        Close the connections opened by the pool, for a pool being replaced
+        '''
+        for connection in list(self._last_used):
+            connection.close()
+        self._last_used.clear()
+
+    def discard(self, connection):
+        '''
+        Close a connection left in an unknown state, the pool reopens it on its next use
+        '''
+        self._last_used.pop(connection, None)
+        connection.close()
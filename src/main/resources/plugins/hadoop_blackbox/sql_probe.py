@@ -0,0 +1,104 @@
+"""
+Copyright (c) 2016 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Apache License, Version 2.0 (the "License").
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+The code, technical concepts, and all information contained herein, are the property of
+Cisco Technology, Inc. and/or its affiliated entities, under various laws including copyright,
+international treaties, patent, and/or contract. Any use of the material herein must be in
+accordance with the terms of the License.
+All rights not expressly granted by the License are reserved.
+
+Unless required by applicable law or agreed to separately in writing, software distributed under
+the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+either express or implied.
+
+Purpose:    HiveServer2 / Impala connections kept open between blackbox runs
+
+"""
+
+import logging
+
+LOGGER = logging.getLogger("TESTBOTPLUGIN")
+
+# Hive table over the HBase table the blackbox rows are written to, read back through Hive or Impala
+CREATE_TABLE = ("CREATE EXTERNAL TABLE IF NOT EXISTS %s (key STRING, value STRING) "
+                "STORED BY 'org.apache.hadoop.hive.hbase.HBaseStorageHandler' "
+                "WITH SERDEPROPERTIES ('hbase.columns.mapping' = ':key,cf:column') "
+                "TBLPROPERTIES ('hbase.table.name' = '%s')")
+DROP_TABLE = "DROP TABLE IF EXISTS %s"
+INVALIDATE_METADATA = "INVALIDATE METADATA %s"
+# a row key predicate is pushed down to HBase as a get, instead of scanning the whole table
+SELECT_ROW = "SELECT value FROM %s WHERE key = '%s'"
+
+def impyla_connect(**kwargs):
+    '''
+    DB-API connection to a HiveServer2 protocol endpoint, impyla is only imported
+    when the Hive / Impala steps are enabled
+    '''
+    from impala.dbapi import connect
+    return connect(**kwargs)
+
+class SqlSession(object):
+    '''
+    Connection to HiveServer2 or an Impala daemon kept open across runs. Opening a cursor
+    opens a server side session, which doubles as the check that a kept connection still
+    works; the connection is made again when it does not or after reset().
+    '''
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self._conn = None
+        self._cursor = None
+
+    def open(self):
+        '''
+        Open a cursor for this run, returns whether an existing connection was used
+        '''
+        self.close_cursor()
+        if self._conn is not None:
+            try:
+                self._cursor = self._conn.cursor()
+                return True
+            except Exception as ex: # pylint: disable=broad-except
+                LOGGER.info("reconnecting to %s:%s after %s", self.kwargs.get('host'), self.kwargs.get('port'), ex)
+                self.reset()
+        self._conn = impyla_connect(**self.kwargs)
+        self._cursor = self._conn.cursor()
+        return False
+
+    def execute(self, statement):
+        '''
+        Run statement on the cursor of this run
+        '''
+        LOGGER.debug(statement)
+        self._cursor.execute(statement)
+
+    def query(self, statement):
+        '''
+        Run statement on the cursor of this run and return all its rows
+        '''
+        self.execute(statement)
+        return self._cursor.fetchall()
+
+    def close_cursor(self):
+        '''
+        Close the cursor of the run, ending its server side session
+        '''
+        if self._cursor is not None:
+            try:
+                self._cursor.close()
+            except Exception as ex: # pylint: disable=broad-except
+                LOGGER.debug("failed to close cursor: %s", ex)
+            self._cursor = None
+
+    def reset(self):
+        '''
+        Drop the connection, a new one is made on the next open()
+        '''
+        self.close_cursor()
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception as ex: # pylint: disable=broad-except
+                LOGGER.debug("failed to close connection: %s", ex)
+            self._conn = None
@@ -0,0 +1,167 @@
+"""
+Copyright (c) 2016 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Apache License, Version 2.0 (the "License").
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+The code, technical concepts, and all information contained herein, are the property of
+Cisco Technology, Inc. and/or its affiliated entities, under various laws including copyright,
+international treaties, patent, and/or contract. Any use of the material herein must be in
+accordance with the terms of the License.
+All rights not expressly granted by the License are reserved.
+
+Unless required by applicable law or agreed to separately in writing, software distributed under
+the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+either express or implied.
+
+Purpose:    Deadline aware sequence of blackbox test stages
+
+"""
+
+import time
+import socket
+import logging
+import traceback
+
+from thriftpy2.thrift import TException
+from thriftpy2.transport import TTransportException
+from pnda_plugin import Event
+
+LOGGER = logging.getLogger("TESTBOTPLUGIN")
+TIMESTAMP_MILLIS = lambda: int(time.time() * 1000)
+# smallest socket timeout applied, a zero timeout would make the socket non blocking
+MIN_SOCKET_TIMEOUT = 0.01
+
+class StageFailure(Exception):
+    '''
+    Raised by a stage to fail it with its own cause instead of the stage default one
+    '''
+    pass
+
+def is_timeout(ex):
+    '''
+    True if ex is a socket or Thrift transport timeout
+    '''
+    return isinstance(ex, socket.timeout) or \
+        (isinstance(ex, TTransportException) and ex.type == TTransportException.TIMED_OUT)
+
+def thrift_socket(connection):
+    '''
+    The socket under an open happybase connection, whichever Thrift transport (cython or
+    pure python) wraps it, or None if the connection is not open
+    '''
+    transport = getattr(connection, 'transport', None)
+    sock = getattr(transport, 'sock', None)
+    if sock is None:
+        sock = getattr(getattr(transport, '_trans', None), 'sock', None)
+    return sock
+
+def set_socket_timeout(connection, seconds):
+    '''
+    Apply a timeout to every following blocking call on the socket of an open happybase connection
+    '''
+    sock = thrift_socket(connection)
+    if sock is not None:
+        sock.settimeout(seconds)
+
+class StageRunner(object):
+    '''
+    Runs the stages of a test sequence one after the other within an overall time budget,
+    each of them bounded by its own deadline through set_timeout (called with the seconds
+    left for the stage before it starts).
+
+    Every stage attempted records a <name>_time_ms event, even when it fails or times out,
+    and a <name>_succeeded health event. After a timeout the connection is in an unknown
+    state so none of the following stages are attempted, they are reported as failed with
+    the stage that timed out as cause; the same goes after a failed required stage.
+    tainted tells whether a stage failed in the Thrift or socket layer, failures counts the
+    stages which raised.
+    '''
+    def __init__(self, source, budget, stage_timeout, set_timeout=None):
+        self.source = source
+        self.stage_timeout = stage_timeout
+        self.set_timeout = set_timeout
+        self.deadline = time.time() + budget
+        self.failed_step = None
+        self.timed_out = False
+        self.tainted = False
+        self.failures = 0
+        self.values = []
+        self.health_values = []
+
+    def _event(self, name, causes, value, source=None):
+        source = source or self.source
+        return Event(TIMESTAMP_MILLIS(), source, 'hadoop.%s.%s' % (source, name), causes, value)
+
+    def after(self, other):
+        '''
+        Continue the sequence of another runner: same deadline, and nothing is attempted
+        if it was stopped
+        '''
+        self.deadline = other.deadline
+        self.failed_step = other.failed_step
+        self.timed_out = other.timed_out
+
+    def skip(self, name, operation, source=None):
+        '''
+        Report a stage which cannot be attempted because of an earlier one
+        '''
+        if self.timed_out:
+            message = 'Did not attempt to %s due to timeout waiting for: %s' % (operation, self.failed_step)
+        else:
+            message = 'Did not attempt to %s due to failure to: %s' % (operation, self.failed_step)
+        self.health_values.append(self._event('%s_succeeded' % name, [message], False, source))
+
+    def run(self, name, operation, cause, stage, required=False, timeout=None, source=None):
+        '''
+        Run stage() as the step name of the sequence and return its result, or None if it
+        raised or was not attempted (a stage overrunning its deadline is reported as failed
+        but its result is still returned). cause is reported when stage raises anything
+        other than a StageFailure, a required stage failing stops the sequence. timeout
+        defaults to the stage timeout and is capped by what is left of the overall budget.
+        source overrides the source of the events of this stage.
+        '''
+        if self.failed_step is not None:
+            self.skip(name, operation, source)
+            return None
+
+        left = self.deadline - time.time()
+        if left <= 0:
+            self.failed_step = operation
+            self.timed_out = True
+            self.health_values.append(self._event('%s_succeeded' % name,
+                                                  ['Timed out waiting for %s to complete' % operation],
+                                                  False, source))
+            return None
+
+        allowed = min(timeout or self.stage_timeout, left)
+        if self.set_timeout is not None:
+            self.set_timeout(max(allowed, MIN_SOCKET_TIMEOUT))
+
+        result = None
+        causes = []
+        failed = True
+        start = time.time()
+        try:
+            result = stage()
+            failed = False
+        except StageFailure as ex:
+            causes = [str(ex)]
+        except Exception as ex:
+            LOGGER.error(traceback.format_exc())
+            # same rule as the happybase pool, the connection may not be usable any more
+            self.tainted = self.tainted or isinstance(ex, (TException, socket.error))
+            if is_timeout(ex):
+                self.timed_out = True
+                causes = ['%s (timed out after %.2fs)' % (cause, allowed)]
+            else:
+                causes = [cause]
+        elapsed = time.time() - start
+        if not causes and elapsed > allowed:
+            causes = ['%s took %.2fs, over its %.2fs deadline' % (operation, elapsed, allowed)]
+
+        self.values.append(self._event('%s_time_ms' % name, [], int(elapsed * 1000), source))
+        self.health_values.append(self._event('%s_succeeded' % name, causes, not causes, source))
+        self.failures += failed
+        if failed and (required or self.timed_out):
+            self.failed_step = operation
+        return None if failed else result
@@ -0,0 +1,442 @@
+"""
+Copyright (c) 2016 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Apache License, Version 2.0 (the "License").
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+The code, technical concepts, and all information contained herein, are the property of
+Cisco Technology, Inc. and/or its affiliated entities, under various laws including copyright,
+international treaties, patent, and/or contract. Any use of the material herein must be in
+accordance with the terms of the License.
+All rights not expressly granted by the License are reserved.
+
+Unless required by applicable law or agreed to separately in writing, software distributed under
+the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+either express or implied.
+
+Purpose:    Unit testing
+
+"""
+
+import time
+import socket
+import unittest
+
+import requests
+from mock import patch, MagicMock
+
+from plugins.hadoop_blackbox.hbase_bench import HBaseBench
+from plugins.hadoop_blackbox.TestbotPlugin import HadoopBlackboxPlugin
+
+class FakeBatch(object):
+    def __init__(self, table):
+        self.table = table
+        self.mutations = {}
+
+    def put(self, row, data):
+        self.mutations[row] = data
+
+    def send(self):
+        self.table.batches += 1
+        for row, data in self.mutations.items():
+            self.table.rows[row.encode()] = dict((column.encode(), value) for column, value in data.items())
+
+class FakeTable(object):
+    '''
+    In memory stand in for a happybase table
+    '''
+    def __init__(self):
+        self.rows = {}
+        self.batches = 0
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def row(self, row, columns=None):
+        return self.rows.get(row.encode(), {})
+
+    def scan(self, row_prefix=None, columns=None, limit=None, batch_size=None):
+        keys = sorted(key for key in self.rows if key.startswith(row_prefix))[:limit]
+        for key in keys:
+            yield key, self.rows[key]
+
+class TestHBaseBench(unittest.TestCase):
+    '''
+    Set of unit tests designed to validate the HBase benchmark
+    '''
+    def test_bench(self):
+        '''
+        Rows are written in batches, read back and scanned within the limit
+        '''
+        table = FakeTable()
+        bench = HBaseBench(table, 'run1', 1000, batch_size=100, gets=50, scan_limit=20)
+        results, missing = bench.run()
+        results = dict(results)
+
+        self.assertEqual(0, missing)
+        self.assertEqual(10, table.batches)
+        self.assertEqual(1000, len(table.rows))
+        self.assertEqual(16, len(set(key[:2] for key in table.rows)))
+        self.assertEqual(10, results['write_batch_ms.count'])
+        self.assertEqual(50, results['get_ms.count'])
+        self.assertIn('get_ms.p99', results)
+        self.assertIsNotNone(results['scan_first_row_ms'])
+
+    def test_missing_rows(self):
+        '''
+        Rows which cannot be read back are counted
+        '''
+        table = FakeTable()
+        bench = HBaseBench(table, 'run2', 10, batch_size=3, gets=10, scan_limit=5)
+        bench.write()
+        table.rows.clear()
+        _, _, missing = bench.read()
+
+        self.assertEqual(10, missing)
+
+class StubCursor(object):
+    '''
+    DB-API cursor of StubConnection
+    '''
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def execute(self, statement):
+        self.conn.statements.append(statement)
+        time.sleep(self.conn.delay)
+        if self.conn.error is not None and statement.startswith(self.conn.error):
+            raise RuntimeError('%s failed' % self.conn.error)
+        self.rows = [('un1eqV4lu3',)] if statement.startswith('SELECT') else []
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+class StubConnection(object):
+    '''
+    Local stand in for a HiveServer2 / Impala DB-API connection
+    '''
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.statements = []
+        self.delay = 0
+        self.error = None
+        self.closed = False
+
+    def cursor(self):
+        return StubCursor(self)
+
+    def close(self):
+        self.closed = True
+
+class FakeResponse(object):
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError('%d error' % self.status_code)
+
+class FakeWebHdfs(object):
+    '''
+    In memory namenode redirecting to one of the datanodes, the file path picks which one
+    '''
+    def __init__(self, datanodes, down=()):
+        self.files = {}
+        self.datanodes = datanodes
+        self.down = down
+        self.requests = []
+
+    def request(self, method, uri, data=None, **kwargs):
+        self.requests.append((method, uri))
+        url, query = uri.split('?')
+        path = url.split('/webhdfs/v1')[1]
+        operation = dict(param.split('=') for param in query.split('&'))['op']
+        host = url.split('/')[2].split(':')[0]
+        if host == 'nn':
+            if operation == 'DELETE':
+                return FakeResponse(200, b'{"boolean": %s}' % (b'true' if self.files.pop(path, None) else b'false'))
+            datanode = self.datanodes[int(path[-1]) % len(self.datanodes)]
+            return FakeResponse(307, headers={'Location': 'http://%s:50075%s' % (datanode, uri.split(':50070')[1])})
+        if host in self.down:
+            raise requests.exceptions.ConnectionError('%s is down' % host)
+        if operation == 'CREATE':
+            self.files[path] = data
+            return FakeResponse(201)
+        if operation == 'APPEND':
+            self.files[path] += data
+            return FakeResponse(200)
+        return FakeResponse(200, self.files[path])
+
+def mocked_connection():
+    hbase = MagicMock()
+    hbase.tables.return_value = []
+    hbase.table.return_value.row.return_value = {b'cf:column': b'un1eqV4lu3'}
+    # nothing waiting on the socket of a healthy idle connection
+    hbase.transport.sock.recv.side_effect = BlockingIOError
+    return hbase
+
+class TestHadoopBlackboxPlugin(unittest.TestCase):
+    '''
+    Set of unit tests designed to validate the hadoop blackbox plugin
+    '''
+    @patch('happybase.pool.Connection')
+    def test_probe_table(self, connection_mock):
+        '''
+        The create / drop table cycle only runs every ddl-every runs, other runs
+        use the probe table created once with a TTL
+        '''
+        hbase = mocked_connection()
+        connection_mock.return_value = hbase
+        plugin = HadoopBlackboxPlugin()
+
+        values = plugin.runner("--ddl-every 3 --probe-ttl 600", False)
+        metrics = dict((value.metric, value) for value in values)
+        self.assertEqual(True, metrics['hadoop.HBASE.ddl_cycle'].value)
+        self.assertEqual('OK', metrics['hadoop.HBASE.health'].value)
+        hbase.create_table.assert_called_once_with('blackbox_test_table', {'cf': dict()})
+        hbase.delete_table.assert_called_once_with('blackbox_test_table')
+
+        hbase.reset_mock()
+        for _ in range(2):
+            values = plugin.runner("--ddl-every 3 --probe-ttl 600", False)
+            metrics = dict((value.metric, value) for value in values)
+            self.assertEqual(False, metrics['hadoop.HBASE.ddl_cycle'].value)
+            self.assertEqual(True, metrics['hadoop.HBASE.probe_table_succeeded'].value)
+            self.assertNotIn('hadoop.HBASE.drop_table_succeeded', metrics)
+            self.assertEqual('OK', metrics['hadoop.HBASE.health'].value)
+        hbase.create_table.assert_called_once_with('blackbox_probe_table',
+                                                   {'cf': dict(time_to_live=600, max_versions=1)})
+        hbase.delete_table.assert_not_called()
+
+    @patch('happybase.pool.Connection')
+    def test_probe_table_ttl(self, connection_mock):
+        '''
+        An existing probe table is kept with the right TTL and created again with another one
+        '''
+        hbase = mocked_connection()
+        hbase.tables.return_value = [b'blackbox_probe_table']
+        hbase.table.return_value.families.return_value = {b'cf': {'time_to_live': 600, 'max_versions': 1}}
+        connection_mock.return_value = hbase
+        plugin = HadoopBlackboxPlugin()
+
+        # the first run is a create / drop table cycle, the second checks the probe table TTL once
+        for _ in range(2):
+            plugin.runner("--ddl-every 10 --probe-ttl 600", False)
+        hbase.table.return_value.families.assert_called_once_with()
+        hbase.reset_mock()
+        plugin.runner("--ddl-every 10 --probe-ttl 600", False)
+        hbase.table.return_value.families.assert_not_called()
+        hbase.delete_table.assert_not_called()
+
+        values = plugin.runner("--ddl-every 10 --probe-ttl 60", False)
+        metrics = dict((value.metric, value) for value in values)
+        self.assertEqual(True, metrics['hadoop.HBASE.probe_table_succeeded'].value)
+        hbase.disable_table.assert_called_once_with('blackbox_probe_table')
+        hbase.delete_table.assert_called_once_with('blackbox_probe_table')
+        hbase.create_table.assert_called_once_with('blackbox_probe_table',
+                                                   {'cf': dict(time_to_live=60, max_versions=1)})
+
+    @patch('happybase.pool.Connection')
+    def test_stage_timeout(self, connection_mock):
+        '''
+        A stage timing out is timed and reported, the following stages are not attempted
+        and the connection is still closed
+        '''
+        hbase = mocked_connection()
+        hbase.table.return_value.put.side_effect = socket.timeout('timed out')
+        connection_mock.return_value = hbase
+        plugin = HadoopBlackboxPlugin()
+
+        values = plugin.runner("--stage-timeout 5", False)
+        metrics = dict((value.metric, value) for value in values)
+
+        self.assertEqual(5000, connection_mock.call_args[1]['timeout'])
+        hbase.transport.sock.settimeout.assert_called_with(5)
+        self.assertIn('hadoop.HBASE.write_time_ms', metrics)
+        self.assertEqual(False, metrics['hadoop.HBASE.write_succeeded'].value)
+        self.assertIn('timed out', metrics['hadoop.HBASE.write_succeeded'].causes[0])
+        self.assertEqual(['Did not attempt to read from HBase due to timeout waiting for: write to HBase'],
+                         metrics['hadoop.HBASE.read_succeeded'].causes)
+        self.assertEqual(False, metrics['hadoop.HBASE.drop_table_succeeded'].value)
+        self.assertNotIn('hadoop.HBASE.read_time_ms', metrics)
+        hbase.table.return_value.row.assert_not_called()
+        hbase.delete_table.assert_not_called()
+        hbase.close.assert_called_once_with()
+        self.assertEqual('ERROR', metrics['hadoop.HBASE.health'].value)
+
+    @patch('happybase.pool.Connection')
+    def test_connection_pool(self, connection_mock):
+        '''
+        The connection is kept open between runs, reopened once idle for too long,
+        and its acquisition is timed apart from the operations
+        '''
+        hbase = mocked_connection()
+        connection_mock.return_value = hbase
+        plugin = HadoopBlackboxPlugin()
+
+        reused = []
+        for _ in range(3):
+            values = plugin.runner("--ddl-every 10 --pool-max-idle 50", False)
+            metrics = dict((value.metric, value) for value in values)
+            self.assertIn('hadoop.HBASE.acquire_connection_time_ms', metrics)
+            self.assertIn('hadoop.HBASE.write_time_ms', metrics)
+            self.assertEqual('OK', metrics['hadoop.HBASE.health'].value)
+            reused.append(metrics['hadoop.HBASE.connection_reused'].value)
+        self.assertEqual([False, True, True], reused)
+        connection_mock.assert_called_once()
+        hbase.close.assert_not_called()
+
+        plugin._pool._last_used[hbase] -= 60
+        values = plugin.runner("--ddl-every 10 --pool-max-idle 50", False)
+        metrics = dict((value.metric, value) for value in values)
+        self.assertEqual(False, metrics['hadoop.HBASE.connection_reused'].value)
+        hbase.close.assert_called_once_with()
+        connection_mock.assert_called_once()
+
+        # a pool replaced because the options changed is closed
+        hbase.reset_mock()
+        plugin.runner("--ddl-every 10 --pool-max-idle 50 --pool-size 2", False)
+        hbase.close.assert_called_once_with()
+        # the connection of the first pool, then the two of the new one
+        self.assertEqual(3, connection_mock.call_count)
+
+    @patch('plugins.hadoop_blackbox.sql_probe.impyla_connect')
+    @patch('happybase.pool.Connection')
+    def test_hive_impala(self, connection_mock, impyla_mock):
+        '''
+        The row written to HBase is read back through Impala on connections kept across runs,
+        the Hive table over the probe table and its Impala metadata are only set up once
+        '''
+        connection_mock.return_value = mocked_connection()
+        stubs = []
+        impyla_mock.side_effect = lambda **kwargs: stubs.append(StubConnection(**kwargs)) or stubs[-1]
+        plugin = HadoopBlackboxPlugin()
+        args = "--ddl-every 10 --hive --hivehost hs2 --impalahost impalad"
+
+        values = plugin.runner(args, False)
+        metrics = dict((value.metric, value) for value in values)
+        hive, impala = stubs
+        self.assertEqual('hs2', hive.kwargs['host'])
+        self.assertEqual('impalad', impala.kwargs['host'])
+        self.assertIn('hadoop.HIVE.connection_time_ms', metrics)
+        self.assertIn('hadoop.IMPALA.connection_time_ms', metrics)
+        self.assertIn('hadoop.IMPALA.invalidate_metadata_time_ms', metrics)
+        self.assertIn('hadoop.IMPALA.read_time_ms', metrics)
+        self.assertTrue(hive.statements[0].startswith('CREATE EXTERNAL TABLE IF NOT EXISTS blackbox_test_table'))
+        self.assertEqual('DROP TABLE IF EXISTS blackbox_test_table', hive.statements[-1])
+        self.assertIn("WHERE key = 'row_key-", impala.statements[-1])
+        for source in ('HBASE', 'HIVE', 'IMPALA'):
+            self.assertEqual('OK', metrics['hadoop.%s.health' % source].value)
+
+        # the mapping of the probe table is created on its first use only
+        for run in range(2):
+            values = plugin.runner(args, False)
+            metrics = dict((value.metric, value) for value in values)
+            self.assertEqual(run == 0, 'hadoop.HIVE.create_metadata_succeeded' in metrics)
+            self.assertEqual(run == 0, 'hadoop.IMPALA.invalidate_metadata_succeeded' in metrics)
+            self.assertNotIn('hadoop.HIVE.drop_table_succeeded', metrics)
+            self.assertEqual(True, metrics['hadoop.IMPALA.read_succeeded'].value)
+        self.assertEqual(2, impyla_mock.call_count)
+        self.assertIn('blackbox_probe_table', hive.statements[-1])
+        self.assertEqual(['SELECT', 'SELECT'], [statement.split()[0] for statement in impala.statements[-2:]])
+
+    @patch('plugins.hadoop_blackbox.sql_probe.impyla_connect')
+    @patch('happybase.pool.Connection')
+    def test_hive_errors(self, connection_mock, impyla_mock):
+        '''
+        A failing statement is timed and reported, later steps are skipped and the
+        connection is made again on the next run; a slow one fails its deadline
+        '''
+        connection_mock.return_value = mocked_connection()
+        stubs = []
+        delay = []
+        def connect(**kwargs):
+            stubs.append(StubConnection(**kwargs))
+            if len(stubs) == 1:
+                stubs[0].error = 'CREATE'
+            stubs[-1].delay = sum(delay)
+            return stubs[-1]
+        impyla_mock.side_effect = connect
+        plugin = HadoopBlackboxPlugin()
+
+        values = plugin.runner("--hive", False)
+        metrics = dict((value.metric, value) for value in values)
+        self.assertIn('hadoop.HIVE.create_metadata_time_ms', metrics)
+        self.assertEqual(['CREATE EXTERNAL TABLE statement failed on Hive Metastore'],
+                         metrics['hadoop.HIVE.create_metadata_succeeded'].causes)
+        self.assertEqual(['Did not attempt to SELECT from Hive due to failure to: create Hive Metastore table'],
+                         metrics['hadoop.HQUERY.read_succeeded'].causes)
+        self.assertEqual('ERROR', metrics['hadoop.HIVE.health'].value)
+        self.assertEqual(True, metrics['hadoop.HBASE.drop_table_succeeded'].value)
+        self.assertTrue(stubs[0].closed)
+
+        values = plugin.runner("--hive", False)
+        metrics = dict((value.metric, value) for value in values)
+        self.assertEqual(2, impyla_mock.call_count)
+        self.assertEqual(True, metrics['hadoop.HQUERY.read_succeeded'].value)
+        self.assertEqual('OK', metrics['hadoop.HIVE.health'].value)
+
+        # a different stage timeout makes a new connection, which answers slowly
+        delay.append(0.1)
+        values = plugin.runner("--hive --stage-timeout 0.05", False)
+        metrics = dict((value.metric, value) for value in values)
+        self.assertGreaterEqual(metrics['hadoop.HQUERY.read_time_ms'].value, 100)
+        cause, = metrics['hadoop.HQUERY.read_succeeded'].causes
+        self.assertTrue(cause.startswith('SELECT from Hive took 0.1'))
+        self.assertTrue(cause.endswith('over its 0.05s deadline'))
+        self.assertEqual('ERROR', metrics['hadoop.HQUERY.health'].value)
+
+    @patch('requests.Session.request')
+    @patch('happybase.pool.Connection')
+    def test_webhdfs(self, connection_mock, request_mock):
+        '''
+        Files are created, appended to, read and deleted through WebHDFS, with the
+        latencies broken down per datanode
+        '''
+        connection_mock.return_value = mocked_connection()
+        webhdfs = FakeWebHdfs(['dn-0', 'dn-1'])
+        request_mock.side_effect = webhdfs.request
+        plugin = HadoopBlackboxPlugin()
+
+        values = plugin.runner("--webhdfs nn:50070 --webhdfs-files 4 --webhdfs-size 1000 --webhdfs-workers 2", False)
+        metrics = dict((value.metric, value) for value in values)
+
+        for operation in ('create', 'append', 'read', 'delete'):
+            self.assertEqual(4, metrics['hadoop.HDFS.webhdfs.%s_ms.count' % operation].value)
+        self.assertIn('hadoop.HDFS.webhdfs.read_mb_per_sec', metrics)
+        self.assertNotIn('hadoop.HDFS.webhdfs.delete_mb_per_sec', metrics)
+        for datanode in ('dn-0', 'dn-1'):
+            self.assertIn('hadoop.HDFS.webhdfs.datanodes.%s.append_ms' % datanode, metrics)
+        self.assertEqual('OK', metrics['hadoop.HDFS.webhdfs.health'].value)
+        self.assertNotIn('hadoop.HDFS.health', metrics)
+        self.assertEqual({}, webhdfs.files)
+        self.assertTrue(all('user.name=hdfs' in uri for _, uri in webhdfs.requests))
+
+    @patch('requests.Session.request')
+    @patch('happybase.pool.Connection')
+    def test_webhdfs_datanode_down(self, connection_mock, request_mock):
+        '''
+        Files on a datanode which is down are reported and skipped, but still deleted
+        '''
+        connection_mock.return_value = mocked_connection()
+        webhdfs = FakeWebHdfs(['dn-0', 'dn-1'], down=('dn-1',))
+        request_mock.side_effect = webhdfs.request
+        plugin = HadoopBlackboxPlugin()
+
+        values = plugin.runner("--webhdfs nn:50070 --webhdfs-files 4 --webhdfs-size 1000", False)
+        metrics = dict((value.metric, value) for value in values)
+
+        self.assertEqual(2, metrics['hadoop.HDFS.webhdfs.read_ms.count'].value)
+        self.assertEqual(4, metrics['hadoop.HDFS.webhdfs.delete_ms.count'].value)
+        self.assertNotIn('hadoop.HDFS.webhdfs.datanodes.dn-1.create_ms', metrics)
+        self.assertEqual('ERROR', metrics['hadoop.HDFS.webhdfs.health'].value)
+        self.assertEqual(2, len(metrics['hadoop.HDFS.webhdfs.health'].causes))
+        self.assertIn('WebHDFS create of /tmp/platform-testing/blackbox-', metrics['hadoop.HDFS.webhdfs.health'].causes[0])
+
+if __name__ == '__main__':
+    unittest.main()
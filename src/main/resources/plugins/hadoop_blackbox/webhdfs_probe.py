@@ -0,0 +1,152 @@
+"""
+Copyright (c) 2016 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Apache License, Version 2.0 (the "License").
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+The code, technical concepts, and all information contained herein, are the property of
+Cisco Technology, Inc. and/or its affiliated entities, under various laws including copyright,
+international treaties, patent, and/or contract. Any use of the material herein must be in
+accordance with the terms of the License.
+All rights not expressly granted by the License are reserved.
+
+Unless required by applicable law or agreed to separately in writing, software distributed under
+the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+either express or implied.
+
+Purpose:    Parallel WebHDFS create / append / read / delete probe of the HDFS data path
+
+"""
+
+import time
+import logging
+from collections import defaultdict
+from urllib.parse import urlparse
+
+from plugins.common.httpclient import fetch_all
+from plugins.common.stats import summarize, percentile
+
+LOGGER = logging.getLogger("TestbotPlugin")
+ELAPSED_MS = lambda start: (time.time() - start) * 1000.0
+# operations in the order they run, each one on all files before the next one starts
+OPERATIONS = ('create', 'append', 'read', 'delete')
+
+class WebHdfsProbe(object):
+    '''
+    Writes, appends to, reads back and deletes a set of files through WebHDFS with
+    concurrent workers, timing each operation end to end.
+
+    Create, append and read are redirected by the namenode to a datanode, which is
+    taken from the redirect so the latencies can also be broken down per datanode.
+    '''
+    def __init__(self, session, namenode, user, directory, timeout):
+        self.session = session
+        self.base = 'http://%s/webhdfs/v1' % namenode
+        self.user = user
+        self.directory = directory.rstrip('/')
+        self.timeout = timeout
+
+    def _uri(self, path, operation, **params):
+        params.update(op=operation, **{'user.name': self.user})
+        return '%s%s?%s' % (self.base, path, '&'.join('%s=%s' % item for item in sorted(params.items())))
+
+    def _redirected(self, method, path, operation, data=None, **params):
+        '''
+        Two step WebHDFS call: the namenode answers with a redirect to the datanode
+        the request (and its data) is then sent to. Returns the datanode response and host
+        '''
+        response = self.session.request(method, self._uri(path, operation, **params),
+                                        allow_redirects=False, timeout=self.timeout)
+        response.raise_for_status()
+        location = response.headers['Location']
+        response = self.session.request(method, location, data=data, timeout=self.timeout)
+        response.raise_for_status()
+        return response, urlparse(location).hostname
+
+    def create(self, path, data):
+        '''
+        Create (or overwrite) path with data, returns the datanode written to
+        '''
+        _, datanode = self._redirected('PUT', path, 'CREATE', data=data, overwrite='true')
+        return datanode
+
+    def append(self, path, data):
+        '''
+        Append data to path, returns the datanode written to
+        '''
+        _, datanode = self._redirected('POST', path, 'APPEND', data=data)
+        return datanode
+
+    def read(self, path, expected):
+        '''
+        Read path back and check it holds expected bytes, returns the datanode read from
+        '''
+        response, datanode = self._redirected('GET', path, 'OPEN')
+        if len(response.content) != expected:
+            raise ValueError('read %d bytes of %s instead of %d' % (len(response.content), path, expected))
+        return datanode
+
+    def delete(self, path):
+        '''
+        Delete path, only the namenode is involved
+        '''
+        response = self.session.delete(self._uri(path, 'DELETE'), timeout=self.timeout)
+        response.raise_for_status()
+
+    def run(self, run_tag, files, size, workers):
+        '''
+        Run every operation on files files of size bytes (2 * size once appended to).
+        Returns a list of (metric, value) pairs, the per datanode latency samples as
+        {datanode: {operation: [ms]}} and the list of errors
+        '''
+        data = b'x' * size
+        paths = ['%s/blackbox-%s-%d' % (self.directory, run_tag, index) for index in range(files)]
+        calls = {
+            'create': lambda path: self.create(path, data),
+            'append': lambda path: self.append(path, data),
+            'read': lambda path: self.read(path, 2 * size),
+            'delete': self.delete,
+        }
+        moved = {'create': size, 'append': size, 'read': 2 * size}
+
+        results = []
+        datanodes = defaultdict(lambda: defaultdict(list))
+        failed = set()
+        errors = []
+        for operation in OPERATIONS:
+            def timed(path, operation=operation):
+                start = time.time()
+                datanode = calls[operation](path)
+                return ELAPSED_MS(start), datanode
+
+            # files which could not be created are not worth appending to or reading,
+            # but every path is deleted so a partial run does not leave files behind
+            targets = paths if operation == 'delete' else [path for path in paths if path not in failed]
+            started = time.time()
+            outcome = fetch_all(timed, targets, max_workers=workers)
+            elapsed = max(time.time() - started, 1e-6)
+
+            latencies = []
+            for path, (result, error) in outcome.items():
+                if error is not None:
+                    if path not in failed:
+                        failed.add(path)
+                        errors.append('WebHDFS %s of %s failed: %s' % (operation, path, error))
+                    continue
+                latency, datanode = result
+                latencies.append(latency)
+                if datanode is not None:
+                    datanodes[datanode][operation].append(latency)
+
+            results.extend(('%s_ms.%s' % (operation, name), value) for name, value in summarize(latencies))
+            if operation in moved and latencies:
+                results.append(('%s_mb_per_sec' % operation,
+                                round(moved[operation] * len(latencies) / elapsed / 1048576.0, 3)))
+        return results, datanodes, errors
+
+def datanode_latencies(datanodes):
+    '''
+    Median latency of each operation served by each datanode, as (datanode, operation, ms)
+    '''
+    return [(datanode, operation, percentile(samples, 50))
+            for datanode, operations in sorted(datanodes.items())
+            for operation, samples in sorted(operations.items())]
@@ -19,12 +19,15 @@ Purpose:    hdfs-namenode whitebox tests
 
 import argparse
 import time
-import json
-import requests
-from pnda_plugin import Event, PndaPlugin
+import logging
+from plugins.common.nodescan import scan_nodes, datanode_outliers, node_key, DATANODE_FIELDS
+from plugins.common.httpclient import new_session, fetch_all, DEFAULT_TIMEOUT
+from pnda_plugin import Event, PndaPlugin, MonitorStatus
 
 TESTBOTPLUGIN = lambda: HDFSPlugin()
 TIMESTAMP_MILLIS = lambda: int(time.time() * 1000)
+LOGGER = logging.getLogger("TESTBOTPLUGIN")
+STATUS_SECTION = "Hadoop:service=NameNode,name=NameNodeStatus"
 
 class HDFSPlugin(PndaPlugin): # pylint: disable=too-few-public-methods
     '''
@@ -44,13 +47,16 @@ class HDFSPlugin(PndaPlugin): # pylint: disable=too-few-public-methods
                 "total_dfs_capacity_across_datanodes": "Total",
                 "total_dfs_capacity_used_across_datanodes": "Used"
             },
-            "Hadoop:service=NameNode,name=NameNodeStatus": {
+            STATUS_SECTION: {
                 "health": "State"
             },
             "Hadoop:service=NameNode,name=JvmMetrics": {
                 "jvm_heap_used_mb": "MemHeapUsedM"
             }
         }
+        self._session = new_session(pool_size=len(self._metrics))
+        # active namenode found on a previous run, tried first on the next one
+        self._active = None
 
 
     def _read_args(self, args):
@@ -62,9 +68,56 @@ class HDFSPlugin(PndaPlugin): # pylint: disable=too-few-public-methods
                                          description='Key metrics from hdfs-namenode')
         parser.add_argument('--host', default='localhost', help='hdfs-namenode host e.g. localhost')
         parser.add_argument('--port', default='50070', help='hdfs-namenode port e.g. 8080')
+        parser.add_argument('--namenodes', default=None,
+                            help='comma separated host:port pairs of the namenodes of an HA pair, '
+                                 'overrides --host / --port e.g. nn1:50070,nn2:50070')
+        parser.add_argument('--stale-secs', default=30, type=float,
+                            help='datanodes not heard of for longer than this are reported as stale e.g. 30')
+        parser.add_argument('--skew', default=0.5, type=float,
+                            help='datanodes whose remaining space or xceiver count deviate from the '
+                                 'median by more than this fraction are reported as skewed e.g. 0.5')
+        parser.add_argument('--timeout', default=DEFAULT_TIMEOUT, type=float,
+                            help='connect / read timeout in seconds for each JMX query e.g. 10')
 
         return parser.parse_args(args)
 
+    def _fetch_section(self, namenode, section, timeout):
+        '''
+        Query a single JMX bean from a namenode
+        '''
+        uri = 'http://%s/jmx?qry=%s' % (namenode, section)
+        response = self._session.get(uri, timeout=timeout)
+        response.raise_for_status()
+        beans = response.json()['beans']
+        if not beans:
+            raise ValueError('bean not found')
+        return beans[0]
+
+    def _scrape(self, namenode, sections, timeout):
+        '''
+        Query the given JMX sections from a namenode concurrently
+        '''
+        return fetch_all(lambda section: self._fetch_section(namenode, section, timeout), sections)
+
+    def _find_active(self, namenodes, timeout, events, causes):
+        '''
+        Query the HA state of every namenode concurrently, reporting each
+        one, and return the list of namenodes claiming to be active
+        '''
+        states = fetch_all(lambda namenode: self._fetch_section(namenode, STATUS_SECTION,
+                                                                timeout)['State'], namenodes)
+        active = []
+        for namenode, (state, error) in states.items():
+            if error is not None:
+                causes.append('NameNode %s unreachable (%s)' % (namenode, error))
+                state = 'unreachable'
+            elif state == 'active':
+                active.append(namenode)
+            events.append(Event(TIMESTAMP_MILLIS(),
+                                'HDFS',
+                                'hadoop.HDFS.namenodes.%s.state' % node_key(namenode), [], state))
+        return active
+
     def runner(self, args, display=True):
         '''
         Main section.
@@ -73,23 +126,95 @@ class HDFSPlugin(PndaPlugin): # pylint: disable=too-few-public-methods
 
         options = self._read_args(plugin_args)
 
+        if options.namenodes:
+            namenodes = [namenode.strip() for namenode in options.namenodes.split(',')]
+        else:
+            namenodes = ['%s:%s' % (options.host, options.port)]
+
         events = []
-        for section in self._metrics:
-            uri = 'http://%s:%s/jmx?qry=%s' % (options.host, options.port, section)
-            metrics_data = requests.get(uri).json()
-            metrics_values = metrics_data['beans'][0]
+        health = MonitorStatus["green"]
+        causes = []
+
+        # steady state: only the namenode known to be active is queried
+        fetched = None
+        active = self._active if self._active in namenodes else None
+        if active is not None:
+            fetched = self._scrape(active, self._metrics, options.timeout)
+            status, error = fetched[STATUS_SECTION]
+            if error is None and status.get('State') == 'active':
+                events.append(Event(TIMESTAMP_MILLIS(),
+                                    'HDFS',
+                                    'hadoop.HDFS.namenodes.%s.state' % node_key(active), [],
+                                    status['State']))
+            else:
+                LOGGER.warning("NameNode %s no longer active, checking %s", active, namenodes)
+                fetched = None
+
+        # first run or failover: find the active namenode among all of them
+        if fetched is None:
+            active_list = self._find_active(namenodes, options.timeout, events, causes)
+            if not active_list:
+                health = MonitorStatus["red"]
+                causes.append('No active NameNode found among %s' % ','.join(namenodes))
+                active = None
+                fetched = {}
+            else:
+                if len(active_list) > 1:
+                    health = MonitorStatus["red"]
+                    causes.append('More than one active NameNode (%s)' % ','.join(active_list))
+                elif causes:
+                    health = MonitorStatus["amber"]
+                active = active_list[0]
+                fetched = self._scrape(active, [section for section in self._metrics
+                                                if section != STATUS_SECTION], options.timeout)
+        self._active = active
+
+        if active is not None:
+            events.append(Event(TIMESTAMP_MILLIS(),
+                                'HDFS',
+                                'hadoop.HDFS.active_namenode', [], active))
+
+        live_stats = None
+        for section, (metrics_values, error) in fetched.items():
+            if error is not None:
+                health = MonitorStatus["red"]
+                causes.append('Failed to query %s from %s (%s)' % (section, active, error))
+                continue
+            if section == STATUS_SECTION:
+                continue
 
             for metric in self._metrics[section]:
-                value = metrics_values[self._metrics[section][metric]]
-                if metric == 'live_datanodes' or metric == 'dead_datanodes':
-                    # special handling to count the number of live / dead datanodes
-                    value = len(json.loads(metrics_values[self._metrics[section][metric]]))
-                if metric == 'health':
-                    value = 'OK' if value == 'active' else 'ERROR'
+                try:
+                    value = metrics_values[self._metrics[section][metric]]
+                    if metric == 'live_datanodes':
+                        # special handling to count the number of live datanodes and
+                        # keep the few per datanode details used for the derived checks
+                        live_stats = scan_nodes(value, DATANODE_FIELDS)
+                        value = live_stats.count
+                    elif metric == 'dead_datanodes':
+                        value = scan_nodes(value).count
+                except (KeyError, ValueError) as ex:
+                    health = MonitorStatus["red"]
+                    causes.append('Unable to read %s from %s (%s)' % (metric, section, ex))
+                    continue
                 events.append(Event(TIMESTAMP_MILLIS(),
                                     'HDFS',
                                     'hadoop.%s.%s' % ('HDFS', metric), [], value))
 
+        if live_stats is not None:
+            for metric, datanodes in datanode_outliers(live_stats, options.stale_secs, options.skew):
+                events.append(Event(TIMESTAMP_MILLIS(),
+                                    'HDFS',
+                                    'hadoop.%s.%s' % ('HDFS', metric), datanodes, len(datanodes)))
+                if metric == 'stale_datanodes' and datanodes:
+                    if health == MonitorStatus["green"]:
+                        health = MonitorStatus["amber"]
+                    causes.append('%d stale datanode(s)' % len(datanodes))
+
+        events.append(Event(TIMESTAMP_MILLIS(),
+                            'HDFS',
+                            'hadoop.%s.%s' % ('HDFS', 'health'), causes, health))
+
         if display:
             self._do_display(events)
 
@@ -0,0 +1,188 @@
+"""
+Copyright (c) 2016 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Apache License, Version 2.0 (the "License").
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+The code, technical concepts, and all information contained herein, are the property of
+Cisco Technology, Inc. and/or its affiliated entities, under various laws including copyright,
+international treaties, patent, and/or contract. Any use of the material herein must be in
+accordance with the terms of the License.
+All rights not expressly granted by the License are reserved.
+
+Unless required by applicable law or agreed to separately in writing, software distributed under
+the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+either express or implied.
+
+Purpose:    Unit testing
+
+"""
+
+import json
+import unittest
+
+import requests
+from mock import patch
+
+from plugins.common.nodescan import scan_nodes, find_skewed, node_key
+from plugins.hdfs.TestbotPlugin import HDFSPlugin
+
+BEANS = {
+    "Hadoop:name=NameNodeInfo,service=NameNode": {
+        "Free": 14460960934,
+        "NonDfsUsedSpace": 2824994612,
+        "TotalFiles": 838,
+        "LiveNodes": json.dumps({
+            "dn-0:50010": {"lastContact": 1, "remaining": 14460960934, "xceiverCount": 4},
+            "dn-1:50010": {"lastContact": 2, "remaining": 14460960934, "xceiverCount": 5},
+            "dn-2:50010": {"lastContact": 120, "remaining": 1446096093, "xceiverCount": 4}
+        }),
+        "DeadNodes": "{}",
+        "TotalBlocks": 730,
+        "Total": 19914805248,
+        "Used": 1399910604
+    },
+    "Hadoop:service=NameNode,name=NameNodeStatus": {
+        "State": "active"
+    },
+    "Hadoop:service=NameNode,name=JvmMetrics": {
+        "MemHeapUsedM": 305.80264
+    }
+}
+
+class MockResponse(object):
+    def __init__(self, json_data, status_code):
+        self.json_data = json_data
+        self.status_code = status_code
+
+    def json(self):
+        return self.json_data
+
+    def raise_for_status(self):
+        if self.status_code != 200:
+            raise requests.exceptions.HTTPError('%d error' % self.status_code)
+
+# This method will be used by the mock to replace requests.Session.get
+# pylint: disable=unused-argument
+def mocked_session_get(uri, **kwargs):
+    section = uri.split('qry=')[1]
+    if section in BEANS:
+        return MockResponse({"beans": [BEANS[section]]}, 200)
+    return MockResponse(None, 404)
+
+def timed_out_session_get(uri, **kwargs):
+    if 'JvmMetrics' in uri:
+        raise requests.exceptions.ReadTimeout('read timed out')
+    return mocked_session_get(uri, **kwargs)
+
+def ha_session_get(uri, **kwargs):
+    if uri.startswith('http://nn1:50070/') and 'NameNodeStatus' in uri:
+        return MockResponse({"beans": [{"State": "standby"}]}, 200)
+    return mocked_session_get(uri, **kwargs)
+
+class TestHDFSPlugin(unittest.TestCase):
+    '''
+    Set of unit tests designed to validate HDFS Plugin
+    '''
+    @patch('requests.Session.get', side_effect=mocked_session_get)
+    # pylint: disable=unused-argument
+    def test_normal_use(self, requests_mock):
+        '''
+        Mock the namenode JMX API with known data and check process output is what we expect
+        '''
+        plugin = HDFSPlugin()
+        values = plugin.runner("--host 10.60.18.144 --port 50070 --stale-secs 300", False)
+        metrics = dict((value.metric, value) for value in values)
+
+        self.assertEqual(838, metrics['hadoop.HDFS.files_total'].value)
+        self.assertEqual(3, metrics['hadoop.HDFS.live_datanodes'].value)
+        self.assertEqual(0, metrics['hadoop.HDFS.dead_datanodes'].value)
+        self.assertEqual('OK', metrics['hadoop.HDFS.health'].value)
+        self.assertEqual([], metrics['hadoop.HDFS.health'].causes)
+        for call in requests_mock.call_args_list:
+            self.assertIsNotNone(call[1]['timeout'])
+
+    @patch('requests.Session.get', side_effect=mocked_session_get)
+    # pylint: disable=unused-argument
+    def test_datanode_outliers(self, requests_mock):
+        '''
+        Stale and skewed datanodes found in LiveNodes are reported as derived events
+        '''
+        plugin = HDFSPlugin()
+        values = plugin.runner("--host 10.60.18.144 --port 50070", False)
+        metrics = dict((value.metric, value) for value in values)
+
+        self.assertEqual(1, metrics['hadoop.HDFS.stale_datanodes'].value)
+        self.assertEqual(['dn-2:50010'], metrics['hadoop.HDFS.stale_datanodes'].causes)
+        self.assertEqual(['dn-2:50010'], metrics['hadoop.HDFS.remaining_skewed_datanodes'].causes)
+        self.assertEqual(0, metrics['hadoop.HDFS.xceiver_skewed_datanodes'].value)
+        self.assertEqual('WARN', metrics['hadoop.HDFS.health'].value)
+
+    def test_skew_of_idle_datanodes(self):
+        '''
+        No datanode is skewed from a median of 0
+        '''
+        stats = scan_nodes(json.dumps({
+            "dn-0:50010": {"xceiverCount": 0},
+            "dn-1:50010": {"xceiverCount": 0},
+            "dn-2:50010": {"xceiverCount": 1}
+        }), ('xceiverCount',))
+
+        self.assertEqual([], find_skewed(stats, 'xceiverCount', 0.5))
+
+    @patch('requests.Session.get', side_effect=timed_out_session_get)
+    # pylint: disable=unused-argument
+    def test_timeout(self, requests_mock):
+        '''
+        A section that times out is reported as an ERROR health event with a cause
+        '''
+        plugin = HDFSPlugin()
+        values = plugin.runner("--host 10.60.18.144 --port 50070 --timeout 1 --stale-secs 300", False)
+        metrics = dict((value.metric, value) for value in values)
+
+        self.assertNotIn('hadoop.HDFS.jvm_heap_used_mb', metrics)
+        self.assertEqual(838, metrics['hadoop.HDFS.files_total'].value)
+        self.assertEqual('ERROR', metrics['hadoop.HDFS.health'].value)
+        self.assertEqual(1, len(metrics['hadoop.HDFS.health'].causes))
+        self.assertIn('JvmMetrics', metrics['hadoop.HDFS.health'].causes[0])
+
+    @patch('requests.Session.get', side_effect=ha_session_get)
+    def test_ha_pair(self, requests_mock):
+        '''
+        The active namenode of an HA pair is found, then cached for the following runs
+        '''
+        plugin = HDFSPlugin()
+        values = plugin.runner("--namenodes nn1:50070,nn2:50070 --stale-secs 300", False)
+        metrics = dict((value.metric, value) for value in values)
+
+        self.assertEqual('standby', metrics['hadoop.HDFS.namenodes.nn1_50070.state'].value)
+        self.assertEqual('active', metrics['hadoop.HDFS.namenodes.nn2_50070.state'].value)
+        self.assertEqual('nn2:50070', metrics['hadoop.HDFS.active_namenode'].value)
+        self.assertEqual(838, metrics['hadoop.HDFS.files_total'].value)
+        self.assertEqual('OK', metrics['hadoop.HDFS.health'].value)
+        for call in requests_mock.call_args_list:
+            if 'NameNodeStatus' not in call[0][0]:
+                self.assertTrue(call[0][0].startswith('http://nn2:50070/'))
+
+        requests_mock.reset_mock()
+        values = plugin.runner("--namenodes nn1:50070,nn2:50070 --stale-secs 300", False)
+        metrics = dict((value.metric, value) for value in values)
+
+        self.assertEqual(3, requests_mock.call_count)
+        for call in requests_mock.call_args_list:
+            self.assertTrue(call[0][0].startswith('http://nn2:50070/'))
+        self.assertNotIn('hadoop.HDFS.namenodes.nn1_50070.state', metrics)
+        self.assertEqual('OK', metrics['hadoop.HDFS.health'].value)
+
+    def test_namenode_key(self):
+        '''
+        Namenodes sharing a host get distinct, single level metric path elements
+        '''
+        first = node_key('nn.example.com:50070')
+        second = node_key('nn.example.com:50071')
+
+        self.assertEqual('nn_example_com_50070', first)
+        self.assertNotEqual(first, second)
+        self.assertNotIn('.', second)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,12 +19,15 @@ Purpose:    HDP whitebox tests, proxied through Ambari API
 
 import argparse
 import time
-import json
+import logging
 import requests
-from pnda_plugin import Event, PndaPlugin
+from plugins.common.httpclient import new_session, fetch_all, RateLimiter, DEFAULT_TIMEOUT
+from plugins.common.nodescan import scan_nodes, datanode_outliers, node_key, DATANODE_FIELDS
+from pnda_plugin import Event, PndaPlugin, MonitorStatus, HealthAggregator
 
 TESTBOTPLUGIN = lambda: HDPPlugin()
 TIMESTAMP_MILLIS = lambda: int(time.time() * 1000)
+LOGGER = logging.getLogger("TESTBOTPLUGIN")
 
 class HDPPlugin(PndaPlugin): # pylint: disable=too-few-public-methods
     '''
@@ -54,6 +57,37 @@ class HDPPlugin(PndaPlugin): # pylint: disable=too-few-public-methods
             }
         }
 
+        # per host metrics scraped in host component mode:
+        # component -> (service, metric group, {metric: field path})
+        self._host_components = {
+            "DATANODE": ("HDFS", "datanodes", {
+                "disk_free_gb": "/metrics/disk/disk_free",
+                "disk_total_gb": "/metrics/disk/disk_total",
+                "gc_time_ms": "/metrics/jvm/gcTimeMillis",
+                "bytes_written": "/metrics/dfs/datanode/bytes_written",
+                "bytes_read": "/metrics/dfs/datanode/bytes_read"
+            }),
+            "NODEMANAGER": ("YARN", "nodemanagers", {
+                "disk_free_gb": "/metrics/disk/disk_free",
+                "gc_time_ms": "/metrics/jvm/gcTimeMillis",
+                "containers_running": "/metrics/yarn/ContainersRunning",
+                "containers_failed": "/metrics/yarn/ContainersFailed",
+                "allocated_gb": "/metrics/yarn/AllocatedGB"
+            })
+        }
+
+        # field paths compiled once into key sequences walked directly in the response
+        self._lookups = dict((section, [(metric, tuple(path.split('/')[1:]))
+                                        for metric, path in self._metrics[section].items()])
+                             for section in self._metrics)
+        self._host_lookups = dict((component, [(metric, tuple(path.split('/')[1:]))
+                                               for metric, path in fields.items()])
+                                  for component, (_, _, fields) in self._host_components.items())
+        self._session = None
+        self._session_auth = None
+        # uri -> (ETag, Last-Modified, payload) of the last response, to revalidate with Ambari
+        self._cache = {}
+
 
     def _read_args(self, args):
         '''
@@ -67,9 +101,143 @@ class HDPPlugin(PndaPlugin): # pylint: disable=too-few-public-methods
         parser.add_argument('--cmuser', default='admin', help='CM user e.g. admin')
         parser.add_argument('--cmpassword', default='admin', help='CM password e.g. admin')
         parser.add_argument('--cluster_name', default='cluster', help='Cluster name e.g. cluster')
+        parser.add_argument('--timeout', default=DEFAULT_TIMEOUT, type=float,
+                            help='connect / read timeout in seconds for each Ambari query e.g. 10')
+        parser.add_argument('--host-components', action='store_true', default=False,
+                            help='also scrape per host DataNode and NodeManager metrics')
+        parser.add_argument('--page-size', default=100, type=int,
+                            help='host components per Ambari request in host component mode e.g. 100')
+        parser.add_argument('--workers', default=4, type=int,
+                            help='concurrent Ambari requests in host component mode e.g. 4')
+        parser.add_argument('--rps', default=10.0, type=float,
+                            help='Ambari requests per second budget in host component mode, 0 for no limit')
+        parser.add_argument('--stale-secs', default=30, type=float,
+                            help='datanodes not heard of for longer than this are reported as stale e.g. 30')
+        parser.add_argument('--skew', default=0.5, type=float,
+                            help='datanodes whose remaining space or xceiver count deviate from the '
+                                 'median by more than this fraction are reported as skewed e.g. 0.5')
 
         return parser.parse_args(args)
 
+    def _get_session(self, options):
+        '''
+        Pooled, authenticated session to Ambari, kept between runs
+        '''
+        auth = (options.cmuser, options.cmpassword)
+        if self._session is None or self._session_auth != auth:
+            self._session = new_session(pool_size=max(len(self._metrics), options.workers), auth=auth,
+                                        headers={'X-Requested-By': options.cmuser})
+            self._session_auth = auth
+            self._cache = {}
+        return self._session
+
+    def _fetch(self, session, uri, timeout):
+        '''
+        GET an Ambari resource, revalidating a previously seen payload with
+        If-None-Match / If-Modified-Since so unchanged ones are not transferred again.
+        A 304 for a payload which is not cached (the conditional headers were added on the
+        way) is requested again, uncached, and fails the query if it is still a 304
+        '''
+        headers = {}
+        cached = self._cache.get(uri)
+        if cached is not None:
+            if cached[0]:
+                headers['If-None-Match'] = cached[0]
+            if cached[1]:
+                headers['If-Modified-Since'] = cached[1]
+
+        response = session.get(uri, headers=headers, timeout=timeout)
+        if response.status_code == 304:
+            if cached is not None:
+                LOGGER.debug("%s not modified", uri)
+                return cached[2]
+            LOGGER.warning("%s not modified but not cached, requesting it again", uri)
+            response = session.get(uri, headers={'Cache-Control': 'no-cache'}, timeout=timeout)
+            if response.status_code == 304:
+                raise requests.exceptions.HTTPError('304 Not Modified for %s, which is not cached' % uri)
+        response.raise_for_status()
+        payload = response.json()
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            self._cache[uri] = (etag, last_modified, payload)
+        return payload
+
+    def _scrape_host_components(self, session, options, health):
+        '''
+        Scrape the per host metrics of every host component, one page of hosts per
+        request with only the needed fields, on a bounded pool of workers and within
+        the requests per second budget so Ambari itself is not overloaded. A page which
+        cannot be fetched is a WARN cause of the scrape health of its service
+        '''
+        limiter = RateLimiter(options.rps)
+        base_uri = 'http://%s:%s/api/v1/clusters/%s/host_components' % (options.cmhost,
+                                                                         options.cmport,
+                                                                         options.cluster_name)
+
+        def fetch_page(page):
+            component, start = page
+            fields = ','.join(['HostRoles/host_name'] +
+                              [path[1:] for path in self._host_components[component][2].values()])
+            uri = '%s?HostRoles/component_name=%s&fields=%s&from=%d&page_size=%d' % (
+                base_uri, component, fields, start, options.page_size)
+            limiter.acquire()
+            return self._fetch(session, uri, options.timeout)
+
+        # the first page of each component tells how many hosts there are
+        pages = fetch_all(fetch_page, [(component, 0) for component in self._host_components],
+                          max_workers=options.workers)
+        remaining = []
+        for (component, _), (payload, error) in list(pages.items()):
+            if error is not None:
+                continue
+            if payload.get('itemTotal') is not None:
+                remaining.extend((component, start) for start in
+                                 range(options.page_size, int(payload['itemTotal']), options.page_size))
+                continue
+            # no total reported, follow the pages one after the other
+            start = options.page_size
+            while len(payload.get('items', [])) >= options.page_size:
+                try:
+                    payload = fetch_page((component, start))
+                except Exception as ex: # pylint: disable=broad-except
+                    pages[(component, start)] = (None, ex)
+                    break
+                pages[(component, start)] = (payload, None)
+                start += options.page_size
+        pages.update(fetch_all(fetch_page, remaining, max_workers=options.workers))
+
+        events = []
+        for (component, start), (payload, error) in pages.items():
+            service, group, _ = self._host_components[component]
+            if error is not None:
+                LOGGER.error("Unable to query %s hosts from %d: %s", component, start, error)
+                health.add(service, MonitorStatus["amber"],
+                           ['Unable to query %s hosts from %d (%s)' % (component, start, error)])
+                continue
+            for item in payload.get('items', []):
+                host = node_key(item['HostRoles']['host_name'])
+                for metric, keys in self._host_lookups[component]:
+                    try:
+                        value = self._lookup(item, keys)
+                    except (KeyError, TypeError):
+                        continue
+                    events.append(Event(TIMESTAMP_MILLIS(),
+                                        service,
+                                        'hadoop.%s.%s.%s.%s' % (service, group, host, metric), [], value))
+        return events
+
+    @staticmethod
+    def _lookup(payload, keys):
+        '''
+        Walk a compiled field path in an Ambari response
+        '''
+        value = payload
+        for key in keys:
+            value = value[key]
+        return value
+
     def runner(self, args, display=True):
         '''
         Main section.
@@ -78,46 +246,59 @@ class HDPPlugin(PndaPlugin): # pylint: disable=too-few-public-methods
 
         options = self._read_args(plugin_args)
 
-        def flatten(json_obj, flat_values=None, cur_key=None):
-            '''
-            Flatten value for the json_obj
-            '''
-            if cur_key is None:
-                cur_key = ''
-            if flat_values is None:
-                flat_values = {}
-
-            for key in json_obj:
-                full_key = cur_key + '/' + key
-                value = json_obj[key]
-                if isinstance(value, dict):
-                    flatten(value, flat_values, full_key)
-                else:
-                    flat_values[full_key] = value
-            return flat_values
-
-        events = []
+        session = self._get_session(options)
+        uris = {}
         for section in self._metrics:
             uri = '%s/clusters/%s/services/%s?fields=' % ('http://%s:%s/api/v1' % (options.cmhost,
                                                                                    options.cmport),
                                                           options.cluster_name, section)
             for metric in self._metrics[section]:
                 uri += "%s," % self._metrics[section][metric][1:]
-            metrics_data = requests.get(uri,
-                                        auth=(options.cmuser, options.cmpassword),
-                                        headers={'X-Requested-By': options.cmuser}).json()
-            metrics_values = flatten(metrics_data)
-            for metric in self._metrics[section]:
-                value = metrics_values[self._metrics[section][metric]]
-                if metric == 'live_datanodes' or metric == 'dead_datanodes':
-                    # special handling to count the number of live / dead datanodes
-                    value = len(json.loads(metrics_values[self._metrics[section][metric]]))
-                service = section.split('/')[0]
-                source = service
+            uris[section] = uri
+
+        fetched = fetch_all(lambda section: self._fetch(session, uris[section], options.timeout),
+                            self._metrics)
+
+        events = []
+        live_stats = None
+        # scrape health of each service: a section Ambari could not be queried for is an ERROR
+        health = HealthAggregator()
+        for section, (metrics_data, error) in fetched.items():
+            service = section.split('/')[0]
+            source = service
+            health.add(service, MonitorStatus["green"])
+            if error is not None:
+                LOGGER.error("Unable to query %s from Ambari: %s", section, error)
+                health.add(service, MonitorStatus["red"], ['Unable to query %s from Ambari (%s)' % (section, error)])
+                continue
+            for metric, keys in self._lookups[section]:
+                try:
+                    value = self._lookup(metrics_data, keys)
+                    if metric == 'live_datanodes':
+                        # special handling to count the number of live datanodes and
+                        # keep the few per datanode details used for the derived checks
+                        live_stats = scan_nodes(value, DATANODE_FIELDS)
+                        value = live_stats.count
+                    elif metric == 'dead_datanodes':
+                        value = scan_nodes(value).count
+                except (KeyError, TypeError, ValueError) as ex:
+                    LOGGER.error("Unable to read %s from %s: %s", metric, section, ex)
+                    health.add(service, MonitorStatus["amber"], ['Unable to read %s from %s (%s)' % (metric, section, ex)])
+                    continue
                 events.append(Event(TIMESTAMP_MILLIS(),
                                     source,
                                     'hadoop.%s.%s' % (service, metric), [], value))
 
+        if options.host_components:
+            events.extend(self._scrape_host_components(session, options, health))
+        events.extend(health.events('hadoop.%s.scrape.health', TIMESTAMP_MILLIS()))
+
+        if live_stats is not None:
+            for metric, datanodes in datanode_outliers(live_stats, options.stale_secs, options.skew):
+                events.append(Event(TIMESTAMP_MILLIS(),
+                                    'HDFS',
+                                    'hadoop.HDFS.%s' % metric, datanodes, len(datanodes)))
+
         if display:
             self._do_display(events)
 
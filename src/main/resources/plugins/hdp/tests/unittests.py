@@ -20,6 +20,7 @@ Purpose:    Unit testing
 import json
 import unittest
 
+import requests
 from mock import patch
 
 from plugins.hdp.TestbotPlugin import HDPPlugin
@@ -74,30 +75,72 @@ YARN_RESPONSE = json.loads('''{
             }
         }''')
 
-# This method will be used by the mock to replace requests.get
+class MockResponse(object):
+    def __init__(self, json_data, status_code, headers=None):
+        self.json_data = json_data
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def json(self):
+        return self.json_data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError('%d error' % self.status_code)
+
+def host_components_page(uri):
+    query = dict(param.split('=', 1) for param in uri.split('?', 1)[1].split('&'))
+    component = query['HostRoles/component_name']
+    total = 250 if component == 'DATANODE' else 2
+    start = int(query['from'])
+    items = [{"HostRoles": {"host_name": "%s-%d.example.com" % (component.lower(), index)},
+              "metrics": {"jvm": {"gcTimeMillis": index},
+                          "yarn": {"ContainersRunning": 3}}}
+             for index in range(start, min(start + int(query['page_size']), total))]
+    return MockResponse({"items": items, "itemTotal": str(total)}, 200)
+
+# This method will be used by the mock to replace requests.Session.get
 # pylint: disable=unused-argument
 def mocked_requests_get(*args, **kwargs):
-    class MockResponse(object):
-        def __init__(self, json_data, status_code):
-            self.json_data = json_data
-            self.status_code = status_code
-
-        def json(self):
-            return self.json_data
-    print args[0]
+    print(args[0])
     if args[0].startswith('http://10.60.18.144:8080/api/v1/clusters/hdp-test/services/HDFS/components/NAMENODE'):
-        return MockResponse(HDFS_RESPONSE, 200)
+        if kwargs['headers'].get('If-None-Match') == '"hdfs-1"':
+            return MockResponse(None, 304)
+        return MockResponse(HDFS_RESPONSE, 200, {'ETag': '"hdfs-1"'})
     elif args[0].startswith('http://10.60.18.144:8080/api/v1/clusters/hdp-test/services/YARN/components/RESOURCEMANAGER'):
         return MockResponse(YARN_RESPONSE, 200)
+    elif args[0].startswith('http://10.60.18.144:8080/api/v1/clusters/hdp-test/host_components?'):
+        return host_components_page(args[0])
 
     return MockResponse(None, 404)
 
+# YARN and the second page of datanodes cannot be queried
+# pylint: disable=unused-argument
+def failing_requests_get(*args, **kwargs):
+    if '/services/YARN/' in args[0] or ('component_name=DATANODE' in args[0] and 'from=100&' in args[0]):
+        return MockResponse(None, 500)
+    return mocked_requests_get(*args, **kwargs)
+
+# a NameNode section without the total of files, behind a cache answering 304 to every
+# YARN request and to the HDFS ones which are not explicitly uncached
+# pylint: disable=unused-argument
+def partial_requests_get(*args, **kwargs):
+    if '/services/HDFS/' in args[0]:
+        if kwargs['headers'].get('Cache-Control') != 'no-cache':
+            return MockResponse(None, 304)
+        response = json.loads(json.dumps(HDFS_RESPONSE))
+        del response['metrics']['dfs']['FSNamesystem']['TotalFiles']
+        return MockResponse(response, 200)
+    if '/services/YARN/' in args[0]:
+        return MockResponse(None, 304)
+    return mocked_requests_get(*args, **kwargs)
+
 class TestHDPPlugin(unittest.TestCase):
 
     '''
     Set of unit tests designed to validate HDP Plugin
     '''
-    @patch('requests.get', side_effect=mocked_requests_get)
+    @patch('requests.Session.get', side_effect=mocked_requests_get)
     # pylint: disable=unused-argument
     def test_normal_use(self, requests_mock):
         '''
@@ -112,7 +155,91 @@ class TestHDPPlugin(unittest.TestCase):
             if value[1] == 'HDFS' and value[2] == 'hadoop.HDFS.files_total':
                 self.assertEquals(838, value[4])
                 found_key = True
+            if value[1] == 'HDFS' and value[2] == 'hadoop.HDFS.live_datanodes':
+                self.assertEquals(1, value[4])
+            if value[1] == 'HDFS' and value[2] == 'hadoop.HDFS.stale_datanodes':
+                self.assertEquals(0, value[4])
 
         self.assertEquals(True, found_key)
+
+    @patch('requests.Session.get', side_effect=mocked_requests_get)
+    def test_not_modified(self, requests_mock):
+        '''
+        A payload revalidated by its ETag on the next run is served from the cache
+        '''
+        plugin = HDPPlugin()
+        args = "--cmhost 10.60.18.144 --cmport 8080 --cmuser user --cmpassword password --cluster_name=hdp-test"
+        first = dict((value.metric, value.value) for value in plugin.runner(args, False))
+        second = dict((value.metric, value.value) for value in plugin.runner(args, False))
+
+        self.assertEqual(first, second)
+        self.assertEqual(838, second['hadoop.HDFS.files_total'])
+        self.assertEqual(4, requests_mock.call_count)
+        for call in requests_mock.call_args_list:
+            self.assertIsNotNone(call[1]['timeout'])
+
+    @patch('requests.Session.get', side_effect=mocked_requests_get)
+    # pylint: disable=unused-argument
+    def test_host_components(self, requests_mock):
+        '''
+        Per host component metrics are scraped page by page
+        '''
+        plugin = HDPPlugin()
+        values = plugin.runner(("--cmhost 10.60.18.144 --cmport 8080 --cluster_name=hdp-test "
+                                "--host-components --page-size 100 --workers 2 --rps 0"), False)
+        metrics = dict((value.metric, value) for value in values)
+
+        self.assertEqual(249, metrics['hadoop.HDFS.datanodes.datanode-249_example_com.gc_time_ms'].value)
+        self.assertEqual('HDFS', metrics['hadoop.HDFS.datanodes.datanode-0_example_com.gc_time_ms'].source)
+        self.assertEqual(3, metrics['hadoop.YARN.nodemanagers.nodemanager-1_example_com.containers_running'].value)
+        self.assertEqual(250, len([metric for metric in metrics if metric.startswith('hadoop.HDFS.datanodes.')]))
+        # the dots of the host names do not add levels to the metric paths
+        self.assertEqual(set([5]), set(len(metric.split('.')) for metric in metrics if '.datanodes.' in metric))
+        host_calls = [call[0][0] for call in requests_mock.call_args_list if 'host_components' in call[0][0]]
+        self.assertEqual(4, len(host_calls))
+        for call in host_calls:
+            self.assertIn('fields=HostRoles/host_name,', call)
+        self.assertEqual('OK', metrics['hadoop.HDFS.scrape.health'].value)
+        self.assertEqual('OK', metrics['hadoop.YARN.scrape.health'].value)
+
+    @patch('requests.Session.get', side_effect=failing_requests_get)
+    # pylint: disable=unused-argument
+    def test_failed_sections(self, requests_mock):
+        '''
+        A section or a page of hosts Ambari cannot be queried for is a cause of the scrape health of its service
+        '''
+        plugin = HDPPlugin()
+        values = plugin.runner(("--cmhost 10.60.18.144 --cmport 8080 --cluster_name=hdp-test "
+                                "--host-components --page-size 100 --workers 2 --rps 0"), False)
+        metrics = dict((value.metric, value) for value in values)
+
+        self.assertEqual(838, metrics['hadoop.HDFS.files_total'].value)
+        self.assertEqual(150, len([metric for metric in metrics if metric.startswith('hadoop.HDFS.datanodes.')]))
+        self.assertEqual('WARN', metrics['hadoop.HDFS.scrape.health'].value)
+        self.assertEqual(1, len(metrics['hadoop.HDFS.scrape.health'].causes))
+        self.assertIn('DATANODE hosts from 100', metrics['hadoop.HDFS.scrape.health'].causes[0])
+        self.assertEqual('ERROR', metrics['hadoop.YARN.scrape.health'].value)
+        self.assertIn('Unable to query YARN', metrics['hadoop.YARN.scrape.health'].causes[0])
+        self.assertEqual('YARN', metrics['hadoop.YARN.scrape.health'].source)
+
+    @patch('requests.Session.get', side_effect=partial_requests_get)
+    # pylint: disable=unused-argument
+    def test_missing_data(self, requests_mock):
+        '''
+        A field missing from a section is a WARN cause of the scrape health of its service,
+        a 304 for a payload which is not cached is requested again
+        '''
+        plugin = HDPPlugin()
+        values = plugin.runner("--cmhost 10.60.18.144 --cmport 8080 --cluster_name=hdp-test", False)
+        metrics = dict((value.metric, value) for value in values)
+
+        self.assertNotIn('hadoop.HDFS.files_total', metrics)
+        self.assertEqual(1, metrics['hadoop.HDFS.live_datanodes'].value)
+        self.assertEqual('WARN', metrics['hadoop.HDFS.scrape.health'].value)
+        self.assertEqual(1, len(metrics['hadoop.HDFS.scrape.health'].causes))
+        self.assertIn('Unable to read files_total', metrics['hadoop.HDFS.scrape.health'].causes[0])
+        self.assertEqual('ERROR', metrics['hadoop.YARN.scrape.health'].value)
+        self.assertIn('304 Not Modified', metrics['hadoop.YARN.scrape.health'].causes[0])
+
 if __name__ == '__main__':
     unittest.main()
@@ -29,21 +29,34 @@ import os
 import math
 import logging
 import json
-from decimal import Decimal
+from collections import defaultdict, namedtuple
 import requests
-from prettytable import PrettyTable
 from plugins.common.zkclient import ZkClient, ZkError
-from plugins.kafka.prod2cons import Prod2Cons
+from plugins.common.httpclient import new_session, fetch_all, DEFAULT_TIMEOUT
+from plugins.kafka.rules import compile_rules
 from plugins.common.defcom import MonitorSummary, PartitionState, TestbotResult
 from plugins.common.defcom import ZkNodesHealth, ZkNode, KkBroker
 from pnda_plugin import PndaPlugin
 from pnda_plugin import Event
+from pnda_plugin import EventBatch
 from pnda_plugin import MonitorStatus
+from pnda_plugin import HealthAggregator
+from pnda_plugin import parse_value
+from pnda_plugin import timed_step
 
 sys.path.insert(0, '../..')
 
 TESTBOTPLUGIN = lambda: KafkaWhitebox()
 TIMESTAMP_MILLIS = lambda: int(time.time() * 1000)
+# how often a JMX attribute is read: every run (fast), at most every slow_refresh_seconds of
+# the config (slow) or once per broker start (static)
+FAST, SLOW, STATIC = 'fast', 'slow', 'static'
+REFRESH_CLASSES = (FAST, SLOW, STATIC)
+DEFAULT_SLOW_REFRESH = 300
+# attributes of the Yammer metrics which are set when the metric is registered
+STATIC_METRIC_ATTRIBUTES = ("RateUnit", "EventType", "LatencyUnit")
+START_TIME_PATH = "java.lang:type=Runtime/StartTime"
+CachedResponse = namedtuple('CachedResponse', ['status_code', 'text'])
 HERE = os.path.abspath(os.path.dirname(__file__))
 LOGGER = logging.getLogger("TESTBOTPLUGIN")
 NBTEST = 10
@@ -58,6 +71,24 @@ def get_broker_by_id(brokers, search):
                 search, broker.host, broker.port, broker.jmx_port, broker.alive)
     return None
 
+def get_broker_ids(broker_list, brokers):
+    '''
+    Kafka broker.id of the entries (host:port, the port being the JMX or the listener one) of
+    broker_list, by their index from 1, among the brokers registered in Zookeeper. An entry
+    whose port matches no registered broker is matched on its host alone if that is unambiguous
+    '''
+    registered = brokers.list if brokers else []
+    broker_ids = {}
+    for index, entry in enumerate(broker_list, 1):
+        host, _, port = entry.partition(':')
+        matches = [broker for broker in registered
+                   if broker.host == host and port in (str(broker.jmx_port), str(broker.port))]
+        if not matches:
+            matches = [broker for broker in registered if broker.host == host]
+        if len(matches) == 1:
+            broker_ids[index] = int(matches[0].id)
+    return broker_ids
+
 class ProcessorError(Exception):
     '''
     Processor errors
@@ -77,11 +108,29 @@ class KafkaWhitebox(PndaPlugin):
     def __init__(self):
         self.broker_list = []
         self.display = False
-        self.results = []
+        self.results = EventBatch()
         self.topic_list = []
         self.prod2cons = False
-        self.whitebox_error_code = -1
+        # broker index -> set of the whitebox error codes found on it
+        self.whitebox_errors = defaultdict(set)
         self.activecontrollercount = -1
+        self.controllers = []
+        self.unknown_controllers = []
+        # broker index -> Kafka broker.id, for the brokers found registered in Zookeeper
+        self.broker_ids = {}
+        self.timeout = DEFAULT_TIMEOUT
+        self._session = new_session()
+        # rules are compiled once, those comparing rates or percentiles keep their samples across runs
+        with open("%s/%s" % (HERE, "jmx_config.json")) as config:
+            self.jmx_config = json.load(config)
+        self.rules = compile_rules(self.jmx_config)
+        for mbean in self.jmx_config["mBeans"]:
+            if mbean.get("refresh", FAST) not in REFRESH_CLASSES:
+                raise ValueError("refresh of %s should be one of %s" % (mbean["label"], ', '.join(REFRESH_CLASSES)))
+        self.slow_refresh = self.jmx_config.get("slow_refresh_seconds", DEFAULT_SLOW_REFRESH)
+        # (broker, path) -> (time read, value) of the slow and static attributes, broker -> StartTime
+        self.jmx_cache = {}
+        self.start_times = {}
 
     def read_args(self, args):
         '''
@@ -105,8 +154,76 @@ class KafkaWhitebox(PndaPlugin):
                             'zk host (default: localhost:2181)')
         parser.add_argument('--prod2cons', action='store_const', const=True,
                             help='Run a producer/consumer test')
+        parser.add_argument('--timeout', default=DEFAULT_TIMEOUT, type=float,
+                            help='connect / read timeout in seconds for each jmxproxy query e.g. 10')
         return parser.parse_args(args)
 
+    def broker_names(self, broker_indexes):
+        '''
+        Brokers of broker_list (by their index from 1) as named in the causes: broker.id and
+        host:port, only the host:port of those whose broker.id is not known
+        '''
+        names = []
+        for broker_index in broker_indexes:
+            host = self.broker_list[broker_index - 1]
+            broker_id = self.broker_ids.get(broker_index)
+            names.append(host if broker_id is None else '%d: %s' % (broker_id, host))
+        return ', '.join(names)
+
+    def check_rules(self, broker_id, label, value):
+        '''
+        Evaluate the whitebox rules on the typed value read under label on a broker
+        '''
+        for rule in self.rules.evaluate(broker_id, label, value):
+            LOGGER.debug("broker %d breaks rule %d on %s (%s read)", broker_id, rule.error_code, label, value)
+            self.whitebox_errors[broker_id].add(rule.error_code)
+
+    def check_restart(self, host, broker_index):
+        '''
+        Forget the cached attributes of a broker and the values its rate rules were last
+        evaluated on when it restarted since they were read, seen from its JVM StartTime
+        changing (or not being readable)
+        '''
+        response = self.jmxproxy_get("http://%s/jmxproxy/%s/%s" % (self.jmxproxy, host, START_TIME_PATH))
+        start_time = response.text if response.status_code == 200 else None
+        if start_time is None or start_time != self.start_times.get(host):
+            if host in self.start_times:
+                LOGGER.info("%s started at %s, re-reading its static JMX attributes", host, start_time)
+            for key in [key for key in self.jmx_cache if key[0] == host]:
+                del self.jmx_cache[key]
+            self.rules.forget(broker_index)
+        self.start_times[host] = start_time
+
+    def jmxproxy_get(self, url):
+        '''
+        GET a jmxproxy url on the pooled session within the timeout, a request which fails
+        is returned as a response without a status code
+        '''
+        try:
+            return self._session.get(url, timeout=self.timeout)
+        except requests.exceptions.RequestException as ex:
+            LOGGER.error("%s failed: %s", url, ex)
+            return CachedResponse(None, None)
+
+    def jmx_get(self, host, path, refresh=FAST):
+        '''
+        Read a JMX attribute of a broker through the jmxproxy, or from the cache if its
+        refresh class allows it. Returns the response, status_code and text
+        '''
+        key = (host, path)
+        if refresh != FAST and key in self.jmx_cache:
+            read_at, text = self.jmx_cache[key]
+            if refresh == STATIC or time.time() - read_at < self.slow_refresh:
+                return CachedResponse(200, text)
+
+        url_jmxproxy = "http://%s/jmxproxy/%s/%s" % (self.jmxproxy, host, path)
+        LOGGER.debug(url_jmxproxy)
+        with timed_step('jmx.fetch'):
+            response = self.jmxproxy_get(url_jmxproxy)
+        if refresh != FAST and response.status_code == 200:
+            self.jmx_cache[key] = (time.time(), response.text)
+        return response
+
     def get_brokertopicmetrics(self, host, topic, broker_id):
         '''
         Get brokertopicmetrics
@@ -116,20 +233,19 @@ class KafkaWhitebox(PndaPlugin):
             for jmx_data in ["RateUnit", "OneMinuteRate", \
                              "EventType", "Count", "FifteenMinuteRate",
                              "FiveMinuteRate", "MeanRate"]:
-                url_jmxproxy = ("http://%s/jmxproxy/%s/"
-                                "kafka.server:type=BrokerTopicMetrics,"
-                                "name=%s,topic=%s/%s") % (self.jmxproxy, host, jmx_path_name, topic, jmx_data)
+                jmx_path = ("kafka.server:type=BrokerTopicMetrics,"
+                            "name=%s,topic=%s/%s") % (jmx_path_name, topic, jmx_data)
 
-                response = requests.get(url_jmxproxy)
+                response = self.jmx_get(host, jmx_path, STATIC if jmx_data in STATIC_METRIC_ATTRIBUTES else FAST)
                 if response.status_code == 200:
-                    LOGGER.debug("Getting %s - %s", response.text, url_jmxproxy)
+                    LOGGER.debug("Getting %s - %s", response.text, jmx_path)
                     self.results.append(Event(TIMESTAMP_MILLIS(),
                                               'kafka',
                                               'kafka.brokers.%d.topics.%s.%s.%s' %
                                               (broker_id,
                                                topic,
                                                jmx_path_name,
-                                               jmx_data), [], response.text)
+                                               jmx_data), [], parse_value(response.text))
                                        )
                 elif response.status_code == 404:
                     self.results.append(Event(TIMESTAMP_MILLIS(),
@@ -138,44 +254,73 @@ class KafkaWhitebox(PndaPlugin):
                                               (broker_id,
                                                topic,
                                                jmx_path_name,
-                                               jmx_data), [], '0')
+                                               jmx_data), [], 0)
                                        )
                 else:
-                    LOGGER.error("ERROR for url_jmxproxy: %s", url_jmxproxy)
+                    LOGGER.error("ERROR for url_jmxproxy: %s on %s", jmx_path, host)
 
         return None
 
-    def get_activecontrollercount(self, host, broker_id):
+    def get_activecontrollercount(self, host):
         '''
-        Get activecontrollercount
+        Get activecontrollercount of a broker, None if it could not be read
         '''
         url_jmxproxy = ("http://%s/jmxproxy/%s/"
                         "kafka.controller:type=KafkaController,"
                         "name=ActiveControllerCount/Value") % (self.jmxproxy, host)
 
-        response = requests.get(url_jmxproxy)
+        response = self.jmxproxy_get(url_jmxproxy)
         if response.status_code == 200:
             LOGGER.debug("Getting %s fo %s", response.text, url_jmxproxy)
+            return int(response.text)
+
+        LOGGER.error("ERROR for url_jmxproxy: %s", url_jmxproxy)
+        return None
+
+    def check_controllers(self):
+        '''
+        Cluster wide ActiveControllerCount check: exactly one broker must be the active
+        controller. The brokers are queried in parallel, their counts are summed into
+        self.activecontrollercount and the broker.id of the controller is reported (-1
+        without a single controller or when it is not registered in Zookeeper)
+        '''
+        counts = fetch_all(lambda broker_id: self.get_activecontrollercount(self.broker_list[broker_id - 1]),
+                           range(1, len(self.broker_list) + 1))
+        controllers = []
+        self.unknown_controllers = []
+        for broker_id, (count, _) in counts.items():
+            if count is None:
+                self.unknown_controllers.append(broker_id)
+                continue
             self.results.append(Event(TIMESTAMP_MILLIS(),
                                       'kafka',
                                       'kafka.brokers.%d.ActiveControllerCount' %
-                                      broker_id, [], response.text))
-            if self.activecontrollercount != -1 and response.text == 1:
-                self.activecontrollercount = 1
-            elif self.activecontrollercount == 1 and response.text == 1:
-                self.whitebox_error_code = 102
-
-        else:
-            LOGGER.error("ERROR for url_jmxproxy: %s", url_jmxproxy)
-
-        return None
+                                      broker_id, [], count))
+            if count > 0:
+                controllers.append(broker_id)
+            self.activecontrollercount = max(self.activecontrollercount, 0) + count
+
+        self.controllers = controllers
+        controller = -1
+        if len(controllers) == 1:
+            controller = self.broker_ids.get(controllers[0], -1)
+            if controller == -1:
+                LOGGER.warning("controller %s not found among the brokers registered in Zookeeper",
+                               self.broker_list[controllers[0] - 1])
+        self.results.append(Event(TIMESTAMP_MILLIS(),
+                                  'kafka',
+                                  'kafka.ActiveControllerCount',
+                                  [], self.activecontrollercount))
+        self.results.append(Event(TIMESTAMP_MILLIS(),
+                                  'kafka',
+                                  'kafka.controller',
+                                  [self.broker_list[broker_id - 1] for broker_id in controllers],
+                                  controller))
 
     def get_uncleanleaderelections(self, host, broker_id):
         '''
         Get UncleanLeaderElectionsPerSec
         '''
-        unclean_count = None
-        unclean_rate = None
         for jmx_data in ["RateUnit",
                          "OneMinuteRate",
                          "EventType",
@@ -183,31 +328,21 @@ class KafkaWhitebox(PndaPlugin):
                          "FifteenMinuteRate",
                          "FiveMinuteRate",
                          "MeanRate"]:
-            url_jmxproxy = ("http://%s/jmxproxy/%s/"
-                            "kafka.controller:type=ControllerStats,"
-                            "name=UncleanLeaderElectionsPerSec/%s") % (self.jmxproxy, host, jmx_data)
+            jmx_path = ("kafka.controller:type=ControllerStats,"
+                        "name=UncleanLeaderElectionsPerSec/%s") % jmx_data
 
-            response = requests.get(url_jmxproxy)
+            response = self.jmx_get(host, jmx_path, STATIC if jmx_data in STATIC_METRIC_ATTRIBUTES else FAST)
             if response.status_code == 200:
-                LOGGER.debug("Getting %s fo %s", response.text, url_jmxproxy)
+                LOGGER.debug("Getting %s fo %s", response.text, jmx_path)
+                value = parse_value(response.text)
                 self.results.append(Event(TIMESTAMP_MILLIS(),
                                           'kafka',
                                           ('kafka.brokers.%d.'
                                            'controllerstats.UncleanLeaderElections.%s') %
-                                          (broker_id, jmx_data), [], response.text))
-
-                if jmx_data == "Count":
-                    unclean_count = int(response.text)
-                elif jmx_data == "FifteenMinuteRate":
-                    unclean_rate = Decimal(response.text)
-
+                                          (broker_id, jmx_data), [], value))
+                self.check_rules(broker_id, 'controllerstats.UncleanLeaderElections.%s' % jmx_data, value)
             else:
-                LOGGER.error("ERROR for url_jmxproxy: %s", url_jmxproxy)
-        if unclean_count is not None and unclean_rate is not None:
-            if unclean_rate > 0.0002:
-                LOGGER.debug("broker %d threshold is %f and current rate is %f",
-                             broker_id, 0.0002, unclean_rate)
-                self.whitebox_error_code = 104
+                LOGGER.error("ERROR for url_jmxproxy: %s on %s", jmx_path, host)
 
         return None
 
@@ -340,33 +475,28 @@ class KafkaWhitebox(PndaPlugin):
         I the test flag is not green, put a reason explaining why
         Then return a json
         '''
-        analyse_status = MonitorStatus["green"]
-        analyse_causes = []
-        analyse_metric = 'kafka.health'
+        health = HealthAggregator()
         zk_majority = int(math.ceil(float(len(zk_data.list_zk.split(",")))/2))
 
         if zk_data and zk_data.list_zk_ko:
             if zk_data.num_zk_ok >= zk_majority:
                 LOGGER.warn("analyse_results : at least one zookeeper node failed")
-                analyse_status = MonitorStatus["amber"]
-                analyse_causes.append("zookeeper node(s) unreachable (%s)" % zk_data.list_zk_ko)
+                health.add('kafka', MonitorStatus["amber"],
+                           ["zookeeper node(s) unreachable (%s)" % zk_data.list_zk_ko])
             else:
                 LOGGER.error("analyse_results : at least one zookeeper node failed")
-                analyse_status = MonitorStatus["red"]
-                analyse_causes.append("zookeeper node(s) unreachable (%s)" % zk_data.list_zk_ko)
+                health.add('kafka', MonitorStatus["red"],
+                           ["zookeeper node(s) unreachable (%s)" % zk_data.list_zk_ko])
 
         if zk_data and zk_data.list_brokers_ko:
             LOGGER.error("analyse_results : at least one broker failed")
-            analyse_status = MonitorStatus["red"]
-            analyse_causes.append("broker(s) unreachable (%s)" %
-                                  zk_data.list_brokers_ko)
+            health.add('kafka', MonitorStatus["red"],
+                       ["broker(s) unreachable (%s)" % zk_data.list_brokers_ko])
 
         if zk_data and zk_data.num_part_ko > 0:
             LOGGER.error("analyse_results : at least one topic / partition inconsistency")
-            if analyse_status != MonitorStatus["red"]:
-                analyse_status = MonitorStatus["amber"]
-            analyse_causes.append(
-                "topic / partition inconsistency in zookeeper")
+            health.add('kafka', MonitorStatus["amber"],
+                       ["topic / partition inconsistency in zookeeper"])
 
         if self.prod2cons:
             if test_result.sent == test_result.received \
@@ -374,46 +504,45 @@ class KafkaWhitebox(PndaPlugin):
                 LOGGER.debug("analyse_results - test for messages sent / received is valid")
             else:
                 LOGGER.error("analyse_results - test for messages sent / received failed")
-                analyse_status = MonitorStatus["red"]
-                analyse_causes.append("producer / consumer failed " + \
-                    "(sent %d, rcv_ok %d, rcv_ko %d)" %
-                                      (test_result.sent,
-                                       test_result.received,
-                                       test_result.notvalid))
-
-        # whitebox analysis
-        if self.whitebox_error_code != -1:
-
-            if self.whitebox_error_code == 101:
-                LOGGER.warn("UnderReplicatedPartitions should be 0")
-                if analyse_status != MonitorStatus["red"]:
-                    analyse_status = MonitorStatus["amber"]
-                analyse_causes.append(
-                    "UnderReplicatedPartitions should be 0")
-            elif self.whitebox_error_code == 102:
-                LOGGER.warn(
-                    "ActiveControllerCount only one broker in the cluster should have 1")
-                if analyse_status != MonitorStatus["red"]:
-                    analyse_status = MonitorStatus["amber"]
-                analyse_causes.append(
-                    "ActiveControllerCount only one broker in the cluster should have 1")
-            elif self.whitebox_error_code == 104:
-                LOGGER.warn("analyse_results : Unclean leader election rate, should be 0")
-                if analyse_status != MonitorStatus["red"]:
-                    analyse_status = MonitorStatus["amber"]
-                analyse_causes.append(
-                    "Unclean leader election rate, should be 0")
-
-        return Event(
-            TIMESTAMP_MILLIS(), 'kafka', \
-            analyse_metric, analyse_causes, analyse_status)
+                health.add('kafka', MonitorStatus["red"],
+                           ["producer / consumer failed " + \
+                            "(sent %d, rcv_ok %d, rcv_ko %d)" %
+                            (test_result.sent,
+                             test_result.received,
+                             test_result.notvalid)])
+
+        # whitebox analysis, one cause per error code naming every broker it was found on
+        for code in sorted(set().union(*self.whitebox_errors.values())):
+            rule = self.rules.get(code)
+            message = rule.message if rule else "whitebox check with error code %d failed" % code
+            brokers = sorted(broker_id for broker_id, codes in self.whitebox_errors.items() if code in codes)
+            if brokers:
+                LOGGER.warn("analyse_results : %s on broker(s) %s", message, self.broker_names(brokers))
+                health.add('kafka', rule.severity if rule else MonitorStatus["amber"],
+                           ["%s (broker(s) %s)" % (message, self.broker_names(brokers))])
+
+        # a cluster without an active controller cannot elect leaders, with several it is split
+        if self.activecontrollercount > 1:
+            LOGGER.error("analyse_results : %d active controllers", self.activecontrollercount)
+            health.add('kafka', MonitorStatus["red"],
+                       ["ActiveControllerCount is %d, only one broker in the cluster should have 1 (broker(s) %s)" %
+                        (self.activecontrollercount, self.broker_names(self.controllers))])
+        elif self.activecontrollercount == 0 and not self.unknown_controllers:
+            LOGGER.error("analyse_results : no active controller")
+            health.add('kafka', MonitorStatus["red"], ["No active controller in the cluster"])
+        elif not self.controllers and self.unknown_controllers:
+            LOGGER.warn("analyse_results : no active controller among the brokers which answered")
+            health.add('kafka', MonitorStatus["amber"],
+                       ["No active controller found, ActiveControllerCount unavailable on broker(s) %s" %
+                        self.broker_names(self.unknown_controllers)])
+
+        return health.event('kafka', 'kafka.health')
 
     def process_brokers(self):
         '''
         Process the brokers
         '''
         # todo see brokerID
-        jmx_config = json.load(open("%s/%s" % (HERE, "jmx_config.json")))
         self.results.append(Event(TIMESTAMP_MILLIS(),
                                   'kafka',
                                   'kafka.available.topics',
@@ -422,28 +551,28 @@ class KafkaWhitebox(PndaPlugin):
 
         for broker_index in range(1, len(self.broker_list) + 1):
             broker = self.broker_list[broker_index - 1]
+            self.check_restart(broker, broker_index)
             for topic in self.topic_list:
                 self.get_brokertopicmetrics(broker, topic, broker_index)
-                for jmx_data in jmx_config["mBeans"]:
-                    url_jmxproxy = "http://%s/jmxproxy/%s/%s" % (self.jmxproxy, broker, jmx_data["path"])
-                    LOGGER.info(url_jmxproxy)
-                    response = requests.get(url_jmxproxy)
-                    if response.status_code == 200:
-                        LOGGER.debug("Getting %s fo %s", response.text, url_jmxproxy)
-                        self.results.append(Event(TIMESTAMP_MILLIS(),
-                                                  'kafka',
-                                                  'kafka.brokers.%d.%s' %
-                                                  (broker_index, jmx_data["label"]),
-                                                  [],
-                                                  response.text))
-                        if 'expect_value' in jmx_data and (int(response.text) != jmx_data["expect_value"]):
-                            self.whitebox_error_code = jmx_data["error_code"]
+            for jmx_data in self.jmx_config["mBeans"]:
+                response = self.jmx_get(broker, jmx_data["path"], jmx_data.get("refresh", FAST))
+                if response.status_code == 200:
+                    LOGGER.debug("Getting %s fo %s", response.text, jmx_data["path"])
+                    value = parse_value(response.text)
+                    self.results.append(Event(TIMESTAMP_MILLIS(),
+                                              'kafka',
+                                              'kafka.brokers.%d.%s' %
+                                              (broker_index, jmx_data["label"]),
+                                              [],
+                                              value))
+                    self.check_rules(broker_index, jmx_data["label"], value)
 
-                    else:
-                        LOGGER.error("ERROR for url_jmxproxy: %s", url_jmxproxy)
+                else:
+                    LOGGER.error("ERROR for url_jmxproxy: %s on %s", jmx_data["path"], broker)
 
-            self.get_activecontrollercount(broker, broker_index)
             self.get_uncleanleaderelections(broker, broker_index)
+
+        self.check_controllers()
         return None
 
     def do_display(self, results_summary, zk_data, test_result):
@@ -455,6 +584,7 @@ class KafkaWhitebox(PndaPlugin):
 
         LOGGER.debug("do_display start")
 
+        from prettytable import PrettyTable
         table = PrettyTable(['Broker', 'Port', 'Topic', 'PartId', 'Valid'])
         table.align['broker'] = 'l'
 
@@ -507,11 +637,21 @@ class KafkaWhitebox(PndaPlugin):
 
         options = self.read_args(plugin_args)
 
+        # reset state left over from a previous run in daemon mode
+        self.results = EventBatch()
+        self.topic_list = []
+        self.whitebox_errors = defaultdict(set)
+        self.activecontrollercount = -1
+        self.controllers = []
+        self.unknown_controllers = []
+        self.broker_ids = {}
+
         self.broker_list = options.brokerlist.split(",")
         self.scheme = options.scheme
         self.prod2cons = options.prod2cons
         self.jmxproxy = options.jmxproxy
-        
+        self.timeout = options.timeout
+
         zknodes = self.getzknodes(options.zkconnect)
         LOGGER.debug(zknodes)
         prev_zk_data = None
@@ -572,20 +712,25 @@ class KafkaWhitebox(PndaPlugin):
                 pairbrokers = brokers.connect.split(',')
                 shost, sport = pairbrokers[0].split(':')
                 try:
+                    # kafka-python and avro are only needed by the producer / consumer test
+                    from plugins.kafka.prod2cons import Prod2Cons
                     test_runner = Prod2Cons(shost,
                                             int(sport),
                                             "%s/%s" % (HERE, "dataplatform-raw.avsc"),
                                             "avro.internal.testbot",
                                             NBTEST)
-                    msgsent = test_runner.prod()
+                    with timed_step('prod2cons.prod'):
+                        msgsent = test_runner.prod()
                     LOGGER.debug("prod sent %d messages", msgsent)
-                    test_result = test_runner.cons()
+                    with timed_step('prod2cons.cons'):
+                        test_result = test_runner.cons()
                 except ValueError as error:
                     LOGGER.error("Error on Prod2Cons %s", str(error))
             else:
                 LOGGER.error("No valid broker found for running prod2cons run")
 
 
+        self.broker_ids = get_broker_ids(self.broker_list, brokers)
         LOGGER.debug("Perform white box test on topics %s", \
           '-'.join(self.topic_list))
         self.process_brokers()
@@ -0,0 +1,167 @@
+"""
+Copyright (c) 2016 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Apache License, Version 2.0 (the "License").
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+The code, technical concepts, and all information contained herein, are the property of
+Cisco Technology, Inc. and/or its affiliated entities, under various laws including copyright,
+international treaties, patent, and/or contract. Any use of the material herein must be in
+accordance with the terms of the License.
+All rights not expressly granted by the License are reserved.
+
+Unless required by applicable law or agreed to separately in writing, software distributed under
+the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+either express or implied.
+
+Purpose:    Whitebox rules of the JMX config, compiled once and evaluated on each value read
+
+"""
+
+import re
+import time
+import operator
+from collections import deque, defaultdict
+
+from plugins.common.stats import percentile
+from pnda_plugin import MonitorStatus
+
+OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+SEVERITIES = (MonitorStatus["amber"], MonitorStatus["red"])
+# samples kept per broker for a percentile rule when it does not set its own window
+DEFAULT_WINDOW = 10
+PERCENTILE_OF = re.compile(r'^p(\d{1,2}(\.\d+)?)$')
+
+def is_number(value):
+    '''
+    True for int and float values, bool is not a number here
+    '''
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class Rule(object):
+    '''
+    Raises error_code on a broker when a statistic of the value read under label compares
+    to threshold with the when operator. The statistic ("of") is the value itself, its
+    rate of change per second since the previous value read on the same broker ("rate")
+    or a percentile of the last window values read on that broker ("p95"...)
+    '''
+    def __init__(self, label, when, threshold, severity, error_code, message, of='value', window=DEFAULT_WINDOW):
+        if when not in OPERATORS:
+            raise ValueError("rule on %s: unknown operator %s, one of %s expected" % (label, when, ', '.join(sorted(OPERATORS))))
+        if severity not in SEVERITIES:
+            raise ValueError("rule on %s: severity should be one of %s" % (label, ', '.join(SEVERITIES)))
+        match = PERCENTILE_OF.match(of)
+        if of not in ('value', 'rate') and match is None:
+            raise ValueError("rule on %s: cannot compare the %s, value, rate or pNN expected" % (label, of))
+        if of != 'value' and not is_number(threshold):
+            raise ValueError("rule on %s: the %s can only be compared to a number" % (label, of))
+        self.label = label
+        self.when = when
+        self.compare = OPERATORS[when]
+        self.threshold = threshold
+        self.severity = severity
+        self.error_code = error_code
+        self.message = message
+        self.of = of
+        self.pct = float(match.group(1)) if match else None
+        # broker -> (time, value) last read for a rate, recent values for a percentile
+        self._last = {}
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+
+    def statistic(self, broker, value, now):
+        '''
+        Statistic compared by the rule once value is read on broker, None until there is enough to compute it
+        '''
+        if self.of == 'value':
+            return value
+        if not is_number(value):
+            return None
+        if self.of == 'rate':
+            previous = self._last.get(broker)
+            self._last[broker] = (now, value)
+            if previous is None or now <= previous[0]:
+                return None
+            return (value - previous[1]) / (now - previous[0])
+        samples = self._samples[broker]
+        samples.append(value)
+        return percentile(samples, self.pct)
+
+    def forget(self, broker):
+        '''
+        Drop the value last read on broker, whose counters restarted from 0, so no rate is
+        computed across the restart
+        '''
+        self._last.pop(broker, None)
+
+    def breached(self, broker, value, now):
+        '''
+        True if value read on broker breaks the rule
+        '''
+        observed = self.statistic(broker, value, now)
+        if observed is None:
+            return False
+        # an ordering of a number against a string (an attribute the proxy could not read) is not a breach
+        if self.when not in ('==', '!=') and not (is_number(observed) and is_number(self.threshold)):
+            return False
+        return self.compare(observed, self.threshold)
+
+class Rules(object):
+    '''
+    Rules of a JMX config indexed by the label they watch and by their error code
+    '''
+    def __init__(self, rules):
+        self._by_label = defaultdict(list)
+        self._by_code = {}
+        for rule in rules:
+            if rule.error_code in self._by_code:
+                raise ValueError("error code %d is used by more than one rule" % rule.error_code)
+            self._by_label[rule.label].append(rule)
+            self._by_code[rule.error_code] = rule
+
+    def evaluate(self, broker, label, value, now=None):
+        '''
+        Rules broken by value read under label on broker
+        '''
+        rules = self._by_label.get(label)
+        if not rules:
+            return []
+        now = now or time.time()
+        return [rule for rule in rules if rule.breached(broker, value, now)]
+
+    def forget(self, broker):
+        '''
+        Drop the rate state of every rule for broker, after it restarted
+        '''
+        for rule in self._by_code.values():
+            rule.forget(broker)
+
+    def get(self, error_code):
+        '''
+        Rule raising error_code, None if there is none
+        '''
+        return self._by_code.get(error_code)
+
+def compile_rules(jmx_config):
+    '''
+    Rules of the "rules" section of a JMX config. An mBean with an expect_value and an
+    error_code, as in older configs, is a WARN rule raised when it reads anything else
+    '''
+    rules = []
+    for mbean in jmx_config.get("mBeans", []):
+        if 'expect_value' in mbean:
+            rules.append(Rule(mbean["label"], '!=', mbean["expect_value"], MonitorStatus["amber"], mbean["error_code"],
+                              "%s should be %s" % (mbean["label"], mbean["expect_value"])))
+    for rule in jmx_config.get("rules", []):
+        try:
+            rules.append(Rule(rule["label"], rule["when"], rule["threshold"], rule.get("severity", MonitorStatus["amber"]),
+                              rule["error_code"], rule.get("message", "%s %s %s" % (rule["label"], rule["when"], rule["threshold"])),
+                              rule.get("of", 'value'), rule.get("window", DEFAULT_WINDOW)))
+        except KeyError as missing:
+            raise ValueError("rule on %s has no %s" % (rule.get("label"), missing))
+    return Rules(rules)
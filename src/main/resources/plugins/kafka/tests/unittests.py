@@ -19,11 +19,11 @@ Purpose:    Unit testing
 import unittest
 
 from mock import patch
-from plugins.common.defcom import ZkPartitions
+from plugins.common.defcom import ZkPartitions, MonitorSummary, KkBrokers, KkBrokersHealth
 
 class TestKafkaWhitebox(unittest.TestCase):
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     @patch('plugins.common.zkclient.ZkClient')
     def test_normal_use(self, zk_mock, requests_mock):
         from plugins.kafka.TestbotPlugin import KafkaWhitebox
@@ -73,5 +73,137 @@ class TestKafkaWhitebox(unittest.TestCase):
             self.assertEqual(values[i].value, 0.0)
             i = i + 1
 
+    def test_whitebox_errors(self):
+        '''
+        Every whitebox error of every broker is reported in kafka.health with the broker it was found on
+        '''
+        from plugins.kafka.TestbotPlugin import KafkaWhitebox
+        plugin = KafkaWhitebox()
+        plugin.broker_list = ['b1:9092', 'b2:9092', 'b3:9092']
+        # broker 3 is not registered in Zookeeper
+        plugin.broker_ids = {1: 11, 2: 12}
+        plugin.whitebox_errors[1].update([101, 104])
+        plugin.whitebox_errors[3].add(101)
+        zk_data = MonitorSummary(num_partitions=1, list_brokers='', list_brokers_ko='', num_brokers_ok=3,
+                                 num_brokers_ko=0, list_zk='z1:2181', list_zk_ko='', num_zk_ok=1,
+                                 num_zk_ko=0, num_part_ok=1, num_part_ko=0, partitions=tuple())
+
+        health = plugin.analyse_results(zk_data, None)
+        self.assertEqual('WARN', health.value)
+        self.assertEqual(['UnderReplicatedPartitions should be 0 (broker(s) 11: b1:9092, b3:9092)',
+                          'Unclean leader election rate, should be 0 (broker(s) 11: b1:9092)'], health.causes)
+
+    @patch('requests.Session.get')
+    def test_whitebox_controller(self, requests_mock):
+        '''
+        ActiveControllerCount is checked across the cluster: exactly one broker must have 1
+        '''
+        from plugins.kafka.TestbotPlugin import KafkaWhitebox
+        zk_data = MonitorSummary(num_partitions=1, list_brokers='', list_brokers_ko='', num_brokers_ok=3,
+                                 num_brokers_ko=0, list_zk='z1:2181', list_zk_ko='', num_zk_ok=1,
+                                 num_zk_ko=0, num_part_ok=1, num_part_ko=0, partitions=tuple())
+
+        for counts, status, controller in [({'b1': '0', 'b2': '1', 'b3': '0'}, 'OK', 12),
+                                           ({'b1': '1', 'b2': '0', 'b3': '1'}, 'ERROR', -1),
+                                           ({'b1': '0', 'b2': '0', 'b3': '0'}, 'ERROR', -1)]:
+            requests_mock.side_effect = lambda url, counts=counts, **kwargs: type('obj', (object,), {
+                'status_code': 200, 'text': counts[url.split('/')[4].split(':')[0]]})
+            plugin = KafkaWhitebox()
+            plugin.jmxproxy = 'proxy:8000'
+            plugin.broker_list = ['b1:9092', 'b2:9092', 'b3:9092']
+            plugin.broker_ids = {1: 11, 2: 12, 3: 13}
+            plugin.check_controllers()
+            metrics = dict((value.metric, value) for value in plugin.results)
+
+            self.assertEqual(controller, metrics['kafka.controller'].value)
+            self.assertEqual(sum(int(count) for count in counts.values()), metrics['kafka.ActiveControllerCount'].value)
+            self.assertEqual(status, plugin.analyse_results(zk_data, None).value)
+
+        health = plugin.analyse_results(zk_data, None)
+        self.assertEqual(['No active controller in the cluster'], health.causes)
+        for call in requests_mock.call_args_list:
+            self.assertIsNotNone(call[1]['timeout'])
+
+    def test_whitebox_rules(self):
+        '''
+        Rules of the JMX config are evaluated on typed values, on their rate of change or on a percentile
+        '''
+        from plugins.kafka.TestbotPlugin import KafkaWhitebox
+        from plugins.kafka.rules import compile_rules
+        plugin = KafkaWhitebox()
+        plugin.broker_list = ['b1:9092', 'b2:9092']
+        plugin.check_rules(1, 'UnderReplicatedPartitions', 0)
+        plugin.check_rules(1, 'server.KafkaRequestHandlerPool.RequestHandlerAvgIdlePercent.OneMinuteRate', 0.25)
+        plugin.check_rules(2, 'controller.OfflinePartitionsCount', 3)
+        plugin.check_rules(2, 'controllerstats.UncleanLeaderElections.FifteenMinuteRate', 0.0001)
+        self.assertEqual({1: set([105]), 2: set([106])}, dict(plugin.whitebox_errors))
+        zk_data = MonitorSummary(num_partitions=1, list_brokers='', list_brokers_ko='', num_brokers_ok=2,
+                                 num_brokers_ko=0, list_zk='z1:2181', list_zk_ko='', num_zk_ok=1,
+                                 num_zk_ko=0, num_part_ok=1, num_part_ko=0, partitions=tuple())
+        self.assertEqual('ERROR', plugin.analyse_results(zk_data, None).value)
+
+        rules = compile_rules({'rules': [
+            {'label': 'Count', 'of': 'rate', 'when': '>', 'threshold': 10, 'error_code': 1},
+            {'label': 'TimeMs', 'of': 'p50', 'window': 3, 'when': '>=', 'threshold': 100, 'severity': 'ERROR', 'error_code': 2}]})
+        self.assertEqual([], rules.evaluate(1, 'Count', 100, now=1000.0))
+        self.assertEqual([], rules.evaluate(1, 'Count', 105, now=1001.0))
+        self.assertEqual([1], [rule.error_code for rule in rules.evaluate(1, 'Count', 200, now=1002.0)])
+        self.assertEqual([], rules.evaluate(2, 'Count', 200, now=1002.0))
+        # the counters of a restarted broker start again from 0, no rate across the restart
+        rules.forget(1)
+        self.assertEqual([], rules.evaluate(1, 'Count', 500, now=1003.0))
+        self.assertEqual([], rules.evaluate(1, 'Count', 505, now=1004.0))
+        breaches = [len(rules.evaluate(1, 'TimeMs', value)) for value in [150, 10, 120, 130, 20, 30]]
+        self.assertEqual([1, 0, 1, 1, 1, 0], breaches)
+        self.assertEqual([], rules.evaluate(1, 'TimeMs', 'n/a'))
+        self.assertRaises(ValueError, compile_rules, {'rules': [{'label': 'Count', 'when': '=~', 'threshold': 1, 'error_code': 1}]})
+
+    @patch('requests.Session.get')
+    def test_whitebox_jmx_refresh(self, requests_mock):
+        '''
+        Static JMX attributes are read once per broker start, fast ones on every run
+        '''
+        from plugins.kafka.TestbotPlugin import KafkaWhitebox
+        start = ['1500000000000']
+        urls = []
+        def get(url, **kwargs):
+            urls.append(url)
+            return type('obj', (object,), {'status_code': 200, 'text': start[0] if url.endswith('/StartTime') else '1'})
+        requests_mock.side_effect = get
+        plugin = KafkaWhitebox()
+        plugin.jmxproxy = 'proxy:8000'
+        plugin.broker_list = ['b1:9092']
+        plugin.topic_list = ['t1', 't2']
+        reads = lambda attribute: len([url for url in urls if url.endswith(attribute)])
+
+        forget = patch.object(plugin.rules, 'forget', wraps=plugin.rules.forget).start()
+        self.addCleanup(patch.stopall)
+        for run in range(3):
+            if run == 2:
+                start[0] = '1500000600000'
+            plugin.results = []
+            plugin.process_brokers()
+            # the rate rules of the broker start again on its first run and after it restarted
+            self.assertEqual([1, 1, 2][run], forget.call_count)
+            metrics = dict((value.metric, value.value) for value in plugin.results)
+            self.assertEqual(1, metrics['kafka.brokers.1.system.Arch'])
+            self.assertEqual(1, metrics['kafka.brokers.1.topics.t2.BytesInPerSec.RateUnit'])
+        self.assertEqual(2, reads('OperatingSystem/Arch'))
+        self.assertEqual(3, reads('OperatingSystem/OpenFileDescriptorCount'))
+        self.assertEqual(2, reads('name=BytesInPerSec,topic=t1/RateUnit'))
+        self.assertEqual(3, reads('name=BytesInPerSec,topic=t1/Count'))
+
+    def test_whitebox_broker_ids(self):
+        '''
+        The brokers of the brokerlist are matched to their broker.id registered in Zookeeper
+        '''
+        from plugins.kafka.TestbotPlugin import get_broker_ids
+        brokers = KkBrokersHealth('', '', 3, 0, [KkBrokers('7', 'b1', 9092, 9050, True),
+                                                 KkBrokers('3', 'b2', 9092, 9050, True),
+                                                 KkBrokers('5', 'b2', 9093, 9051, True)])
+
+        self.assertEqual({1: 7, 2: 5, 3: 3}, get_broker_ids(['b1:9999', 'b2:9051', 'b2:9092', 'b2:9999'], brokers))
+        self.assertEqual({}, get_broker_ids(['b1:9050'], None))
+
 if __name__ == '__main__':
     unittest.main()
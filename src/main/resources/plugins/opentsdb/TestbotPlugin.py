@@ -8,8 +8,7 @@ import logging
 import sys
 import requests
 from requests.utils import quote
-from prettytable import PrettyTable
-from pnda_plugin import PndaPlugin, Event, MonitorStatus
+from pnda_plugin import PndaPlugin, Event, MonitorStatus, HealthAggregator
 
 #Constants
 METRIC_NAME = "tsd.host"
@@ -32,6 +31,7 @@ class OpenTSDBWhiteBox(PndaPlugin):
         self.hosts = []
         self.results = []
         self.cause = []
+        self.health = HealthAggregator()
         self.test_start_timestamp = None
 
     def read_args(self, args):
@@ -54,6 +54,7 @@ class OpenTSDBWhiteBox(PndaPlugin):
             metric = "%s.%d.%s" % (METRIC_NAME, index, "health")
             analyse_status = MonitorStatus["red"]
             self.results.append(Event(TIMESTAMP_MILLIS(), "opentsdb", metric, msg, analyse_status))
+            self.health.add(index, analyse_status, msg)
 
     def api_stats(self, host, index):
         """
@@ -266,8 +267,9 @@ class OpenTSDBWhiteBox(PndaPlugin):
                             analyse_status = MonitorStatus["green"]
                             self.results.append(Event(TIMESTAMP_MILLIS(), "opentsdb", \
                             metric, [], analyse_status))
+                            self.health.add(index, analyse_status)
                             LOGGER.debug("Test finished in host %s", host)
-        ok_c, ko_c = self.analyze_results(self.results)
+        ok_c, ko_c = self.analyze_results()
         self.results.append(Event(self.test_start_timestamp, "opentsdb", "tsd.hosts", \
         [], self.hosts))
         self.results.append(Event(self.test_start_timestamp, "opentsdb", "tsd.hosts.ok", \
@@ -286,25 +288,19 @@ class OpenTSDBWhiteBox(PndaPlugin):
         LOGGER.debug("Overall test on all host finished")
         return self.results
 
-    def analyze_results(self, results):
+    def analyze_results(self):
         """
         Analyze ok and ko status on hosts
         """
-        ok_c = 0
-        ko_c = 0
-        for row in results:
-            if "opentsdb.health" not in row[2] and ".health" in row[2]:
-                if row[4] == "ERROR":
-                    ko_c += 1
-                else:
-                    ok_c += 1
-        return ok_c, ko_c
+        ko_c = sum(1 for _, status in self.health.statuses() if status == MonitorStatus["red"])
+        return len(self.health.statuses()) - ko_c, ko_c
 
     def do_display(self, results, hosts):
         """
         Pretty display
         """
         LOGGER.debug("do_display start")
+        from prettytable import PrettyTable
         print("%s%s%s" % ("-"*72, " Status ", "-"*72))
         table = PrettyTable(["Timestamp", "Source", "Metric", "Cause", "Value"])
         table.align = "l"
@@ -315,7 +311,7 @@ class OpenTSDBWhiteBox(PndaPlugin):
             if '.health' not in row[2] and "tsd.hosts" not in row[2]:
                 table.add_row([row[0], row[1], row[2], row[3], row[4]])
         print(table)
-        ok_c, ko_c = self.analyze_results(self.results)
+        ok_c, ko_c = self.analyze_results()
         print("%s%s%s" % ("-"*72, " Summary ", "-"*72))
         row_format = "{0:>1}{1:<30}{2:<40}"
         rows = ""
@@ -342,6 +338,10 @@ class OpenTSDBWhiteBox(PndaPlugin):
             else ""
 
         options = self.read_args(plugin_args)
+        # reset state left over from a previous run in daemon mode
+        self.results = []
+        self.cause = []
+        self.health = HealthAggregator()
         self.hosts = options.hosts.split(",")
         results = self.exec_test()
         if display:
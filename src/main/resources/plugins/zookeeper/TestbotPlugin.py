@@ -23,7 +23,6 @@ import os
 import logging
 import time
 import math
-from prettytable import PrettyTable
 from pnda_plugin import PndaPlugin
 from pnda_plugin import Event
 from pnda_plugin import MonitorStatus
@@ -46,6 +45,7 @@ def do_display(results_summary, zk_data, zknodes=ZkNodesHealth(-1, -1, -1, -1, -
 
     LOGGER.debug("do_display start")
 
+    from prettytable import PrettyTable
     table = PrettyTable(['Zookeeper', 'Port', 'Id', 'other', 'Valid'])
     table.align['zookeeper'] = 'l'
 
@@ -17,11 +17,22 @@ Purpose:    Base class for PNDA test plugins
 
 """
 
+import time
+import json
+import math
+import functools
+from array import array
 from collections import OrderedDict
 from collections import namedtuple
-from prettytable import PrettyTable
+from collections import defaultdict
+
+from plugins.common.stats import summarize
 
 MonitorStatus = OrderedDict([("green", "OK"), ("amber", "WARN"), ("red", "ERROR")]) # pylint: disable=invalid-name
+# rank of each status, from the least to the most severe
+SEVERITY = dict((status, rank) for rank, status in enumerate(MonitorStatus.values()))
+# status of a source nothing was added for yet
+NO_STATUS = object()
 
 Event = namedtuple('Event',
                    [
@@ -32,6 +43,343 @@ Event = namedtuple('Event',
                        'value'
                    ])
 
+def to_status(value):
+    '''
+    Health status of a value: True is OK, False is ERROR, a status is itself
+    '''
+    if value is True:
+        return MonitorStatus["green"]
+    if value is False:
+        return MonitorStatus["red"]
+    return value
+
+def finite_value(value):
+    '''
+    value itself, unless it is a NaN or infinite float which neither JSON nor OpenTSDB
+    accept: that is reported as text, the way Java prints it
+    '''
+    if isinstance(value, float) and not math.isfinite(value):
+        if math.isnan(value):
+            return 'NaN'
+        return 'Infinity' if value > 0 else '-Infinity'
+    return value
+
+def parse_value(text):
+    '''
+    Typed value of a metric read as text: an int, a float, or the text itself
+    (a health status, a name, NaN...) when it is not a finite number
+    '''
+    for parse in (int, float):
+        try:
+            value = parse(text)
+        except (TypeError, ValueError):
+            continue
+        return value if math.isfinite(value) else finite_value(text)
+    return text
+
+class HealthAggregator(object):
+    '''
+    Folds health into one status and one list of causes per source in a single pass.
+    The status of a source is the most severe, in MonitorStatus order, of everything added
+    for it (anything which is not a MonitorStatus value counts as ERROR) and its causes are
+    all the causes added, in order. With repeated_warn_is_error, a source with more than one
+    WARN added is an ERROR, as in the hadoop_blackbox fold it replaces.
+    '''
+    def __init__(self, repeated_warn_is_error=False):
+        self._status = OrderedDict()
+        self._causes = {}
+        self._repeated_warn_is_error = repeated_warn_is_error
+
+    def add(self, source, value, causes=()):
+        '''
+        Add a status (or True / False) with its causes to the health of source
+        '''
+        status = to_status(value)
+        if status not in SEVERITY:
+            causes = list(causes) + ['%r is not a health status' % (value,)]
+            status = MonitorStatus["red"]
+        current = self._status.get(source, NO_STATUS)
+        if self._repeated_warn_is_error and status == current == MonitorStatus["amber"]:
+            status = MonitorStatus["red"]
+        if current is NO_STATUS or SEVERITY[status] > SEVERITY[current]:
+            self._status[source] = status
+        self._causes.setdefault(source, []).extend(causes)
+
+    def add_events(self, events):
+        '''
+        Add the value and causes of each event to the health of its source
+        '''
+        for event in events:
+            self.add(event.source, event.value, event.causes)
+
+    def status(self, source):
+        '''
+        Health of source, OK if nothing was added for it
+        '''
+        return self._status.get(source, MonitorStatus["green"])
+
+    def causes(self, source):
+        '''
+        Causes added for source
+        '''
+        return self._causes.get(source, [])
+
+    def statuses(self):
+        '''
+        (source, status) pairs in the order sources were first added
+        '''
+        return list(self._status.items())
+
+    def event(self, source, metric, timestamp=None):
+        '''
+        Health event of source
+        '''
+        return Event(timestamp or int(time.time() * 1000), source, metric, self.causes(source), self.status(source))
+
+    def events(self, metric_format, timestamp=None):
+        '''
+        Health event of every source, metric_format is applied to the source name
+        '''
+        return [self.event(source, metric_format % source, timestamp) for source in self._status]
+
+class _Step(object):
+    '''
+    Context manager timing one call of a step of the StepTimer it belongs to
+    '''
+    __slots__ = ('_timer', '_name', '_wall', '_start')
+
+    def __init__(self, timer, name):
+        self._timer = timer
+        self._name = name
+
+    def __enter__(self):
+        self._wall = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._timer.record(self._name, self._wall, time.perf_counter() - self._start)
+        return False
+
+class _NoStep(object):
+    '''
+    What a step is timed with when no run is timed: nothing
+    '''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NO_STEP = _NoStep()
+
+class StepTimer(object):
+    '''
+    Durations of the named steps of one plugin run (zk.topics, jmx.fetch, send.post...),
+    kept per step as the wall time the step was first entered and the monotonic duration
+    of each call
+    '''
+    def __init__(self):
+        self._started = {}
+        self._durations = defaultdict(list)
+
+    def step(self, name):
+        '''
+        Context manager timing a call of step name
+        '''
+        return _Step(self, name)
+
+    def record(self, name, wall, seconds):
+        '''
+        Add a call of step name, started at wall time and lasting seconds
+        '''
+        self._started.setdefault(name, wall)
+        self._durations[name].append(seconds * 1000.0)
+
+    def events(self, source, prefix):
+        '''
+        Histogram of every step recorded since the last call, as <prefix>.<step>.ms events
+        holding the total milliseconds spent in the step and <prefix>.<step>.ms.<stat> events
+        for the count, min, max and percentiles of its calls, timestamped when the step was
+        first entered. The steps are forgotten once reported
+        '''
+        events = []
+        for name in sorted(self._durations):
+            durations = self._durations[name]
+            timestamp = int(self._started[name] * 1000)
+            metric = '%s.%s.ms' % (prefix, name)
+            events.append(Event(timestamp, source, metric, [], round(sum(durations), 3)))
+            events.extend(Event(timestamp, source, '%s.%s' % (metric, stat), [], round(value, 3) if stat != 'count' else value)
+                          for stat, value in summarize(durations))
+        self._started.clear()
+        self._durations.clear()
+        return events
+
+# timer of the run in progress, set by monitor.py --timings around each run. The plugins
+# reach it through timed_step() and timed() rather than as an argument of runner() so
+# shared code (zkclient...) can time its steps without every caller passing it down
+_RUN_TIMER = None
+
+def set_run_timer(timer):
+    '''
+    Time the steps of the following calls on timer, None to stop timing them
+    '''
+    global _RUN_TIMER # pylint: disable=global-statement
+    _RUN_TIMER = timer
+
+def timed_step(name):
+    '''
+    Context manager timing a step of the run in progress, a shared no-op one when the run
+    is not timed so instrumented code costs a call
+    '''
+    timer = _RUN_TIMER
+    if timer is None:
+        return NO_STEP
+    return _Step(timer, name)
+
+def timed(name):
+    '''
+    Decorator timing every call of a function as step name of the run in progress
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            timer = _RUN_TIMER
+            if timer is None:
+                return function(*args, **kwargs)
+            with _Step(timer, name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class EventBatch(object):
+    '''
+    Events stored in columns: timestamps in an array, sources and metrics as ids of interned
+    strings, values in one typed column per kind (int, float, bool, anything else) and causes
+    only for the events which have some. Used like the list of events a plugin returns
+    (append, extend, len, iteration and indexing give Event tuples) and serialised straight to
+    the data collector format by json_items(). A slice is an EventBatch of its own
+    '''
+    INT, FLOAT, BOOL, OBJECT = range(4)
+
+    def __init__(self, events=()):
+        self._timestamps = array('q')
+        self._sources = array('l')
+        self._metrics = array('l')
+        # kind of each value and its position in the column of that kind
+        self._kinds = array('b')
+        self._positions = array('q')
+        self._ints = array('q')
+        self._floats = array('d')
+        self._objects = []
+        self._causes = {}
+        # interned strings, their ids and their JSON encoding
+        self._ids = {}
+        self._strings = []
+        self._json = []
+        self.extend(events)
+
+    def _intern(self, string):
+        string = "%s" % string
+        string_id = self._ids.get(string)
+        if string_id is None:
+            string_id = self._ids[string] = len(self._strings)
+            self._strings.append(string)
+            self._json.append(json.dumps(string))
+        return string_id
+
+    def add(self, timestamp, source, metric, causes, value):
+        '''
+        Append an event from its fields, without making an Event of it
+        '''
+        self._timestamps.append(timestamp)
+        self._sources.append(self._intern(source))
+        self._metrics.append(self._intern(metric))
+        value = finite_value(value)
+        if isinstance(value, bool):
+            kind, column, stored = self.BOOL, self._ints, int(value)
+        elif isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+            kind, column, stored = self.INT, self._ints, value
+        elif isinstance(value, float):
+            kind, column, stored = self.FLOAT, self._floats, value
+        else:
+            kind, column, stored = self.OBJECT, self._objects, value
+        self._kinds.append(kind)
+        self._positions.append(len(column))
+        column.append(stored)
+        if causes:
+            self._causes[len(self._timestamps) - 1] = causes
+
+    def append(self, event):
+        '''
+        Append an Event
+        '''
+        self.add(*event)
+
+    def extend(self, events):
+        '''
+        Append Events
+        '''
+        for event in events:
+            self.add(*event)
+
+    def _value(self, index):
+        kind = self._kinds[index]
+        position = self._positions[index]
+        if kind == self.INT:
+            return self._ints[position]
+        if kind == self.FLOAT:
+            return self._floats[position]
+        if kind == self.BOOL:
+            return bool(self._ints[position])
+        return self._objects[position]
+
+    def __len__(self):
+        return len(self._timestamps)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return EventBatch(self[position] for position in range(*index.indices(len(self))))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('event index out of range')
+        return Event(self._timestamps[index],
+                     self._strings[self._sources[index]],
+                     self._strings[self._metrics[index]],
+                     self._causes.get(index, []),
+                     self._value(index))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def _json_value(self, index):
+        kind = self._kinds[index]
+        position = self._positions[index]
+        if kind == self.INT:
+            return '%d' % self._ints[position]
+        if kind == self.BOOL:
+            return 'true' if self._ints[position] else 'false'
+        if kind == self.FLOAT:
+            return json.dumps(self._floats[position], allow_nan=False)
+        return json.dumps(self._objects[position], allow_nan=False)
+
+    def json_items(self):
+        '''
+        Each event as the bytes of its object in the data collector format, causes as a JSON string
+        '''
+        strings = self._json
+        no_causes = json.dumps(json.dumps([]))
+        return [('{"source": %s, "metric": %s, "value": %s, "causes": %s, "timestamp": %d}' % (
+            strings[self._sources[index]],
+            strings[self._metrics[index]],
+            self._json_value(index),
+            json.dumps(json.dumps(self._causes[index])) if index in self._causes else no_causes,
+            self._timestamps[index])).encode('utf8') for index in range(len(self))]
+
 class PluginException(Exception):
     '''
     Exception indicating problem in plugin
@@ -47,6 +395,8 @@ class PndaPlugin(object):
         '''
         Receive event tuples and display on stdout in presentable format
         '''
+        # only imported by the runs displaying their results
+        from prettytable import PrettyTable
 
         table = PrettyTable(['Time', 'Source', 'Metric', 'Causes', 'Value'])
         table.align['Metric'] = 'l'
@@ -0,0 +1,229 @@
+"""
+Copyright (c) 2016 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Apache License, Version 2.0 (the "License").
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+The code, technical concepts, and all information contained herein, are the property of
+Cisco Technology, Inc. and/or its affiliated entities, under various laws including copyright,
+international treaties, patent, and/or contract. Any use of the material herein must be in
+accordance with the terms of the License.
+All rights not expressly granted by the License are reserved.
+
+Unless required by applicable law or agreed to separately in writing, software distributed under
+the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+either express or implied.
+
+Purpose:    cProfile / tracemalloc reports of sampled plugin runs, for monitor.py --profile
+
+"""
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+from collections import defaultdict
+
+LOGGER = logging.getLogger("monitor")
+# stack paths worth less than this many microseconds are left out of the collapsed stacks
+MIN_STACK_US = 1
+MAX_STACK_DEPTH = 128
+# extensions of the files written for each profiled run
+CPU_REPORT = 'collapsed'
+MEMORY_REPORT = 'alloc.txt'
+RAW_PROFILE = 'pstats'
+
+def frame_name(func):
+    '''
+    Frame of a pstats function key (file, line, name) in a collapsed stack
+    '''
+    filename, line, name = func
+    if filename == '~':
+        # built-in functions have no file
+        frame = name
+    else:
+        frame = '%s:%d(%s)' % (os.path.basename(filename), line, name)
+    return frame.replace(';', ',').replace(' ', '_')
+
+def collapsed_stacks(stats):
+    '''
+    Collapsed stacks ("frame;frame;frame microseconds" lines, the flame graph input format)
+    of a pstats.Stats. cProfile only records caller / callee pairs, so the self time of a
+    function is split between the paths reaching it in proportion of the time spent
+    through each of its callers; recursive calls are cut at the first repeated frame
+    '''
+    table = stats.stats
+    callees = defaultdict(list)
+    roots = []
+    for func, (_, _, _, _, callers) in table.items():
+        if not callers:
+            roots.append(func)
+        for caller, edge in callers.items():
+            # edge is (primitive calls, calls, self time, cumulative time) through caller
+            callees[caller].append((func, edge[3]))
+
+    totals = defaultdict(float)
+    # (function, path to it, share of the function time spent on that path)
+    pending = [(func, (func,), 1.0) for func in roots]
+    while pending:
+        func, path, share = pending.pop()
+        _, _, self_time, cumulative, _ = table[func]
+        if cumulative * share * 1e6 < MIN_STACK_US:
+            continue
+        totals[path] += self_time * share
+        if len(path) >= MAX_STACK_DEPTH:
+            continue
+        for callee, through in callees.get(func, ()):
+            callee_cumulative = table[callee][3]
+            if callee in path or not callee_cumulative:
+                continue
+            pending.append((callee, path + (callee,), share * min(through / callee_cumulative, 1.0)))
+
+    lines = []
+    for path, seconds in totals.items():
+        microseconds = int(round(seconds * 1e6))
+        if microseconds >= MIN_STACK_US:
+            lines.append('%s %d' % (';'.join(frame_name(func) for func in path), microseconds))
+    return sorted(lines)
+
+def top_allocations(snapshot, top, peak):
+    '''
+    Report of the top allocation sites (by size) still held in a tracemalloc snapshot
+    '''
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    ))
+    statistics = snapshot.statistics('lineno')
+    lines = ['peak %.1f KiB, %.1f KiB held in %d blocks at the end of the run' %
+             (peak / 1024.0, sum(stat.size for stat in statistics) / 1024.0, sum(stat.count for stat in statistics))]
+    for stat in statistics[:top]:
+        frame = stat.traceback[0]
+        lines.append('%10.1f KiB %8d blocks  %s:%d' % (stat.size / 1024.0, stat.count, frame.filename, frame.lineno))
+    return lines
+
+class ThreadProfiles(object):
+    '''
+    cProfile only profiles the thread it is enabled in: while started, every thread started
+    (the fetch_all workers...) enables a profiler of its own on its first call, whose stats
+    are merged with those of the run. Threads started before, such as a pool kept across
+    runs, are not profiled
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.profiles = []
+
+    def _start_thread(self, frame, event, arg): # pylint: disable=unused-argument
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ profiles every thread from the profiler of the run, and refuses a second one
+            return
+        with self._lock:
+            self.profiles.append(profile)
+
+    def start(self):
+        '''
+        Profile the threads started from now on
+        '''
+        threading.setprofile(self._start_thread)
+
+    def stop(self):
+        '''
+        Stop profiling new threads, returns the profiles of those which were
+        '''
+        threading.setprofile(None)
+        with self._lock:
+            return list(self.profiles)
+
+class RunProfiler(object):
+    '''
+    Runs a plugin under cProfile, its threads included (see ThreadProfiles), and tracemalloc
+    with memory, on the first of every `every` runs. Each profiled run writes to directory,
+    named after the plugin, the time and the run number, its collapsed stacks (.collapsed),
+    its raw profile for pstats or snakeviz (.pstats) and with memory its top allocation
+    sites (.alloc.txt). Only the reports of the last keep profiled runs are kept
+    '''
+    def __init__(self, directory, every=1, memory=False, top=25, keep=10):
+        self.directory = directory
+        self.every = max(every, 1)
+        self.memory = memory
+        self.top = top
+        self.keep = max(keep, 1)
+        self._runs = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def sampled(self):
+        '''
+        Count a run, True if it is one to profile
+        '''
+        self._runs += 1
+        return (self._runs - 1) % self.every == 0
+
+    def run(self, name, function, *args):
+        '''
+        Return function(*args), profiled if this run is sampled
+        '''
+        if not self.sampled():
+            return function(*args)
+
+        tracing = self.memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        profile = cProfile.Profile()
+        threads = ThreadProfiles()
+        started = time.time()
+        threads.start()
+        profile.enable()
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+            thread_profiles = threads.stop()
+            snapshot = None
+            peak = 0
+            if tracing:
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            self._write(name, started, [profile] + thread_profiles, snapshot, peak)
+
+    def _write(self, name, started, profiles, snapshot, peak):
+        '''
+        Write the reports of a profiled run then rotate the older ones out, a failure is
+        logged rather than failing the run
+        '''
+        stem = os.path.join(self.directory, '%s-%s-%06d' % (name, time.strftime('%Y%m%d-%H%M%S', time.localtime(started)), self._runs))
+        try:
+            stats = pstats.Stats(*profiles)
+            stats.dump_stats('%s.%s' % (stem, RAW_PROFILE))
+            with open('%s.%s' % (stem, CPU_REPORT), 'w') as report:
+                report.write('\n'.join(collapsed_stacks(stats)) + '\n')
+            if snapshot is not None:
+                with open('%s.%s' % (stem, MEMORY_REPORT), 'w') as report:
+                    report.write('\n'.join(top_allocations(snapshot, self.top, peak)) + '\n')
+            LOGGER.info('profile of the %s run written to %s.*', name, stem)
+            self._rotate(name)
+        except (OSError, IOError) as ex:
+            LOGGER.error('failed to write the profile of the %s run: %s', name, ex)
+
+    def _rotate(self, name):
+        '''
+        Delete the reports of all but the last keep profiled runs of name
+        '''
+        stems = defaultdict(list)
+        for filename in os.listdir(self.directory):
+            if filename.startswith('%s-' % name):
+                stems[filename.split('.', 1)[0]].append(filename)
+        # stems sort by time then run number
+        for stem in sorted(stems)[:-self.keep]:
+            for filename in stems[stem]:
+                os.remove(os.path.join(self.directory, filename))
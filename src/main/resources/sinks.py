@@ -0,0 +1,473 @@
+"""
+Copyright (c) 2016 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Apache License, Version 2.0 (the "License").
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+The code, technical concepts, and all information contained herein, are the property of
+Cisco Technology, Inc. and/or its affiliated entities, under various laws including copyright,
+international treaties, patent, and/or contract. Any use of the material herein must be in
+accordance with the terms of the License.
+All rights not expressly granted by the License are reserved.
+
+Unless required by applicable law or agreed to separately in writing, software distributed under
+the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+either express or implied.
+
+Purpose:    Outputs the events returned by a plugin are sent to: the console data collector,
+            OpenTSDB, Kafka and a Prometheus endpoint
+
+"""
+
+import io
+import re
+import gzip
+import zlib
+import json
+import math
+import time
+import socket
+import logging
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from plugins.common.httpclient import new_session, fetch_all, DEFAULT_TIMEOUT
+from pnda_plugin import SEVERITY, EventBatch, finite_value
+
+LOGGER = logging.getLogger("monitor")
+TIMESTAMP_MILLIS = lambda: int(time.time() * 1000)
+# 100kB limit from nodjs body parser https://github.com/expressjs/body-parser#limit-3
+MAX_PAYLOAD = 102400
+# Content-Encoding the console payloads can be sent with, level 6 is the zlib default trade off
+COMPRESSORS = {
+    'gzip': lambda body: gzip.compress(body, compresslevel=6),
+    'deflate': lambda body: zlib.compress(body, 6),
+}
+# fields of each event of a compact payload, in order
+COMPACT_FIELDS = ['metric', 'value', 'causes', 'timestamp']
+# characters OpenTSDB does not accept in metric names and tag values
+TSDB_INVALID = re.compile(r'[^a-zA-Z0-9\-_./]')
+# metrics holding the identity of a broker, topic or node in their path, that part is put
+# to OpenTSDB as tags so the series of the same metric can be aggregated across them.
+# The topics and host names can hold dots, the name after them has a fixed number of parts
+TSDB_TAGGED = [
+    (re.compile(r'^kafka\.brokers\.(?P<broker>\d+)\.topics\.(?P<topic>.+)\.(?P<name>[^.]+\.[^.]+)$'),
+     'kafka.brokers.topics.%s'),
+    (re.compile(r'^kafka\.brokers\.(?P<broker>\d+)\.(?P<name>.+)$'), 'kafka.brokers.%s'),
+    (re.compile(r'^hadoop\.HDFS\.namenodes\.(?P<namenode>[^.]+)\.(?P<name>[^.]+)$'), 'hadoop.HDFS.namenodes.%s'),
+    (re.compile(r'^hadoop\.HDFS\.datanodes\.(?P<datanode>[^.]+)\.(?P<name>[^.]+)$'), 'hadoop.HDFS.datanodes.%s'),
+    (re.compile(r'^hadoop\.YARN\.nodemanagers\.(?P<nodemanager>[^.]+)\.(?P<name>[^.]+)$'), 'hadoop.YARN.nodemanagers.%s'),
+    (re.compile(r'^hadoop\.HDFS\.webhdfs\.datanodes\.(?P<datanode>.+)\.(?P<name>[^.]+)$'), 'hadoop.HDFS.webhdfs.datanodes.%s'),
+]
+# characters not allowed in Prometheus metric names
+PROMETHEUS_INVALID = re.compile(r'[^a-zA-Z0-9_:]')
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def json_payloads(events):
+    '''
+    Bodies of the data collector format, causes are sent as a JSON string. The events are
+    packed in as few payloads as fit in MAX_PAYLOAD, measured on the uncompressed bytes since
+    that is what the limit applies to
+    '''
+    if isinstance(events, EventBatch):
+        items = events.json_items()
+    else:
+        items = [json.dumps({
+            "source": "%s" % ev.source,
+            "metric": "%s" % ev.metric,
+            "value": finite_value(ev.value),
+            "causes": "%s" % json.dumps(ev.causes),
+            "timestamp": ev.timestamp
+        }, allow_nan=False).encode('utf8') for ev in events]
+
+    head = b'{"data": ['
+    tail = ('], "timestamp": %d}' % TIMESTAMP_MILLIS()).encode('utf8')
+    bodies = []
+    chunk = []
+    size = len(head) + len(tail)
+    for item in items:
+        # an event too large on its own still goes, alone
+        if chunk and size + len(item) + 2 > MAX_PAYLOAD:
+            bodies.append(head + b', '.join(chunk) + tail)
+            chunk = []
+            size = len(head) + len(tail)
+        chunk.append(item)
+        size += len(item) + 2
+    if chunk:
+        bodies.append(head + b', '.join(chunk) + tail)
+    return bodies
+
+def compact_payloads(events):
+    '''
+    Bodies of the compact format: events grouped per source, each event a row of
+    COMPACT_FIELDS with its typed value and its causes as an array. The events are split
+    in halves until each payload fits in MAX_PAYLOAD
+    '''
+    sources = OrderedDict()
+    for ev in events:
+        sources.setdefault(ev.source, []).append([ev.metric, finite_value(ev.value), list(ev.causes), ev.timestamp])
+    body = json.dumps({
+        "fields": COMPACT_FIELDS,
+        "sources": [{"source": source, "data": rows} for source, rows in sources.items()],
+        "timestamp": TIMESTAMP_MILLIS()
+    }, separators=(',', ':'), allow_nan=False).encode('utf8')
+    if len(body) > MAX_PAYLOAD and len(events) > 1:
+        half = len(events) // 2
+        return compact_payloads(events[:half]) + compact_payloads(events[half:])
+    return [body]
+
+PAYLOADS = {'json': json_payloads, 'compact': compact_payloads}
+
+class Sink(object):
+    '''
+    Output for the events of each run, kept open for the life of the monitor.
+    Sending is timed as the send.<name> step of the run
+    '''
+    name = None
+
+    def send(self, events):
+        '''
+        Send the events of a run, returns False if some of them could not be sent
+        '''
+        raise NotImplementedError()
+
+    def send_more(self, events):
+        '''
+        Send more events of the run last sent (the timings of its sends)
+        '''
+        return self.send(events)
+
+    def close(self):
+        '''
+        Release what the sink holds open
+        '''
+        pass
+
+class HttpJsonSink(Sink):
+    '''
+    POST of the events to the console data collector, in the format of PAYLOADS, on a
+    session kept alive between runs. With compression (gzip or deflate) the payloads are
+    sent compressed with the matching Content-Encoding. timeout is the (connect, read)
+    timeout of each post
+    '''
+    name = 'post'
+
+    def __init__(self, url, payload_format='json', compression=None, timeout=(5.0, DEFAULT_TIMEOUT)):
+        self.url = url
+        self.payloads = PAYLOADS[payload_format]
+        self.compress = COMPRESSORS.get(compression)
+        self.timeout = timeout
+        headers = {'Content-Type': 'application/json'}
+        if self.compress is not None:
+            headers['Content-Encoding'] = compression
+        self.session = new_session(pool_size=1, headers=headers)
+
+    def send(self, events):
+        sent = True
+        raw = compressed = 0
+        for body in self.payloads(events):
+
+            LOGGER.debug("_send data \n %s", body)
+
+            data = body if self.compress is None else self.compress(body)
+            raw += len(body)
+            compressed += len(data)
+            try:
+                response = self.session.post(self.url, data=data, timeout=self.timeout)
+                if response.status_code != 200:
+                    LOGGER.error("_send failed: %s", response.status_code)
+                    sent = False
+            except requests.exceptions.RequestException as ex:
+                LOGGER.error("_send failed: %s", ex)
+                sent = False
+        LOGGER.debug("_send posted %d bytes for %d bytes of payload", compressed, raw)
+        return sent
+
+    def close(self):
+        self.session.close()
+
+def numeric_value(value):
+    '''
+    Numeric value of an event for a time series database, health statuses are ranked
+    (OK 0, WARN 1, ERROR 2), None when there is no number to graph, NaN and the infinities included
+    '''
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    return SEVERITY.get(value)
+
+def tsdb_series(source, metric):
+    '''
+    OpenTSDB metric and tags of an event: its source, and the broker, topic or node
+    its metric is about when TSDB_TAGGED knows where that is in the metric
+    '''
+    tags = {"source": source}
+    for pattern, generic in TSDB_TAGGED:
+        match = pattern.match(metric)
+        if match is not None:
+            parts = match.groupdict()
+            metric = generic % parts.pop('name')
+            tags.update(parts)
+            break
+    return TSDB_INVALID.sub('_', metric), dict((key, TSDB_INVALID.sub('_', value)) for key, value in tags.items())
+
+def datapoints(events):
+    '''
+    OpenTSDB datapoints of the events with a finite numeric value
+    '''
+    points = []
+    series = {}
+    for ev in events:
+        value = numeric_value(ev.value)
+        if value is None:
+            continue
+        key = (ev.source, ev.metric)
+        if key not in series:
+            series[key] = tsdb_series(ev.source, ev.metric)
+        metric, tags = series[key]
+        points.append({
+            "metric": metric,
+            "timestamp": ev.timestamp,
+            "value": value,
+            "tags": tags
+        })
+    return points
+
+class OpenTsdbSink(Sink):
+    '''
+    Datapoints written to OpenTSDB /api/put in batches of batch_size, the batches are
+    posted concurrently on a pooled session
+    '''
+    name = 'opentsdb'
+
+    def __init__(self, host, batch_size=50, workers=4, timeout=DEFAULT_TIMEOUT):
+        self.url = "http://%s/api/put" % host
+        self.batch_size = batch_size
+        self.workers = workers
+        self.timeout = timeout
+        self.session = new_session(pool_size=workers, headers={'Content-Type': 'application/json'})
+
+    def _put(self, batch):
+        response = self.session.post(self.url, data=json.dumps(batch, allow_nan=False), timeout=self.timeout)
+        if response.status_code not in (200, 204):
+            raise ValueError("status %d: %s" % (response.status_code, response.text[:200]))
+
+    def send(self, events):
+        points = datapoints(events)
+        batches = [points[start:start + self.batch_size] for start in range(0, len(points), self.batch_size)]
+        outcome = fetch_all(lambda index: self._put(batches[index]), range(len(batches)), max_workers=self.workers)
+        failed = [index for index, (_, error) in outcome.items() if error is not None]
+        if failed:
+            LOGGER.error("OpenTSDB put of %d of %d batches failed", len(failed), len(batches))
+        LOGGER.debug("%d datapoints of %d events put to OpenTSDB", len(points), len(events))
+        return not failed
+
+    def close(self):
+        self.session.close()
+
+class KafkaSink(Sink):
+    '''
+    Events published to a Kafka topic as Avro records of the PNDA dataplatform schema, the
+    event itself in JSON as the rawdata. The producer is kept for the life of the sink,
+    batching the records of a run (linger_ms) and compressing them
+    '''
+    name = 'kafka'
+
+    def __init__(self, brokers, topic, schema_path, linger_ms=100, compression='gzip', timeout=DEFAULT_TIMEOUT):
+        # only imported when the sink is used, the monitor itself does not depend on them
+        import avro.io
+        import avro.schema
+        from kafka import KafkaProducer
+
+        self.topic = topic
+        self.timeout = timeout
+        with open(schema_path) as schema:
+            self.writer = avro.io.DatumWriter(avro.schema.Parse(schema.read()))
+        self.encoder = avro.io.BinaryEncoder
+        self.host_ip = socket.gethostbyname(socket.gethostname())
+        self.producer = KafkaProducer(bootstrap_servers=brokers.split(','), linger_ms=linger_ms,
+                                      compression_type=compression)
+
+    def _record(self, event):
+        rawdata = json.dumps({"source": event.source, "metric": event.metric, "value": finite_value(event.value),
+                              "causes": event.causes, "timestamp": event.timestamp}, allow_nan=False)
+        bytes_writer = io.BytesIO()
+        self.writer.write({"timestamp": event.timestamp,
+                           "src": event.source,
+                           "host_ip": self.host_ip,
+                           "rawdata": rawdata.encode('utf8')},
+                          self.encoder(bytes_writer))
+        return bytes_writer.getvalue()
+
+    def send(self, events):
+        futures = [self.producer.send(self.topic, self._record(event)) for event in events]
+        self.producer.flush(self.timeout)
+        failed = 0
+        for future in futures:
+            try:
+                future.get(timeout=0)
+            except Exception as ex: # pylint: disable=broad-except
+                LOGGER.debug("Kafka send failed: %s", ex)
+                failed += 1
+        if failed:
+            LOGGER.error("%d of %d events could not be published to %s", failed, len(events), self.topic)
+        return not failed
+
+    def close(self):
+        self.producer.close(self.timeout)
+
+def prometheus_series(source, metric):
+    '''
+    Metric name and series (name and labels) of an event in the Prometheus text format, its source as a label
+    '''
+    name = PROMETHEUS_INVALID.sub('_', metric)
+    if name[:1].isdigit():
+        name = '_' + name
+    source = source.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return name, '%s{source="%s"}' % (name, source)
+
+def prometheus_value(value):
+    '''
+    Sample value in the Prometheus text format, the shortest repr a float round trips with
+    '''
+    if isinstance(value, float):
+        return repr(value)
+    return '%d' % value
+
+class _Family(object):
+    '''
+    Samples of the series of one metric name, {series: [line, run it was last sent in]},
+    and their rendering once joined, None until it is needed again after a change
+    '''
+    __slots__ = ('samples', 'block')
+
+    def __init__(self):
+        self.samples = OrderedDict()
+        self.block = None
+
+class PrometheusSink(Sink):
+    '''
+    Latest value of every series served on http://host:port/metrics in the Prometheus text
+    format, as gauges. Sending only updates the in-memory snapshot: a sample is rendered
+    again when its value changes and the samples of each metric are kept together, joined
+    again by a scrape only when one of them changed, so it never waits on a plugin. A
+    series not sent in the last stale_after runs is dropped, so a host, broker or topic
+    which stopped reporting is not served at its last value forever
+    '''
+    name = 'metrics'
+
+    def __init__(self, port, host='', stale_after=1):
+        self.stale_after = max(stale_after, 1)
+        self._lock = threading.Lock()
+        self._runs = 0
+        # (source, metric) -> (metric name, series)
+        self._series = {}
+        # metric name -> _Family, in the order they were first sent
+        self._families = OrderedDict()
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            '''
+            Serves the snapshot on /metrics
+            '''
+            def do_GET(self): # pylint: disable=invalid-name
+                '''
+                Scrape
+                '''
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                blocks = sink.render()
+                self.send_response(200)
+                self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+                self.send_header('Content-Length', str(sum(len(block) for block in blocks)))
+                self.end_headers()
+                self.wfile.writelines(blocks)
+
+            def log_message(self, format, *args): # pylint: disable=redefined-builtin
+                LOGGER.debug("%s - %s", self.address_string(), format % args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, name='metrics-endpoint')
+        thread.daemon = True
+        thread.start()
+        LOGGER.info("serving metrics on %s:%d/metrics", host or '*', self.server.server_address[1])
+
+    def send(self, events):
+        return self._update(events, True)
+
+    def send_more(self, events):
+        return self._update(events, False)
+
+    def _update(self, events, new_run):
+        '''
+        Update the snapshot with events, of a new run or of the last one
+        '''
+        with self._lock:
+            if new_run:
+                self._runs += 1
+            for ev in events:
+                value = numeric_value(ev.value)
+                if value is None:
+                    continue
+                key = (ev.source, ev.metric)
+                known = self._series.get(key)
+                if known is None:
+                    known = self._series[key] = prometheus_series(ev.source, ev.metric)
+                name, series = known
+                family = self._families.get(name)
+                if family is None:
+                    family = self._families[name] = _Family()
+                line = ('%s %s\n' % (series, prometheus_value(value))).encode('utf8')
+                sample = family.samples.get(series)
+                if sample is None or sample[0] != line:
+                    family.samples[series] = [line, self._runs]
+                    family.block = None
+                else:
+                    sample[1] = self._runs
+            if new_run:
+                self._expire()
+        return True
+
+    def _expire(self):
+        '''
+        Drop the series which were not sent in the last stale_after runs
+        '''
+        oldest = self._runs - self.stale_after
+        expired = False
+        for name, family in list(self._families.items()):
+            stale = [series for series, (_, run) in family.samples.items() if run <= oldest]
+            if not stale:
+                continue
+            expired = True
+            for series in stale:
+                del family.samples[series]
+            family.block = None
+            if not family.samples:
+                del self._families[name]
+        if expired:
+            self._series = dict((key, known) for key, known in self._series.items()
+                                if known[0] in self._families and known[1] in self._families[known[0]].samples)
+
+    def render(self):
+        '''
+        Blocks of the body of a scrape, one per metric, joining again only those with a change since the previous one
+        '''
+        with self._lock:
+            blocks = []
+            for name, family in self._families.items():
+                if family.block is None:
+                    family.block = b''.join([('# TYPE %s gauge\n' % name).encode('utf8')] +
+                                            [line for line, _ in family.samples.values()])
+                blocks.append(family.block)
+            return blocks
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,708 @@
+"""
+Copyright (c) 2016 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Apache License, Version 2.0 (the "License").
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+The code, technical concepts, and all information contained herein, are the property of
+Cisco Technology, Inc. and/or its affiliated entities, under various laws including copyright,
+international treaties, patent, and/or contract. Any use of the material herein must be in
+accordance with the terms of the License.
+All rights not expressly granted by the License are reserved.
+
+Unless required by applicable law or agreed to separately in writing, software distributed under
+the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+either express or implied.
+
+Purpose:    Unit testing of pnda_plugin, monitor.py and the sinks
+
+"""
+
+import io
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import json
+import zlib
+import unittest
+import subprocess
+
+import requests
+from mock import patch, MagicMock
+
+import sinks
+import profiling
+import monitor
+from monitor import AVRO_SCHEMA
+from monitor import DeltaFilter
+from benchmarks.imports import BACKENDS
+from pnda_plugin import HealthAggregator, EventBatch, Event, parse_value
+from plugins.common.httpclient import fetch_all
+from pnda_plugin import StepTimer, NO_STEP, set_run_timer, timed_step, timed
+
+def sample_events(count):
+    '''
+    Events with every kind of value
+    '''
+    values = [1, 2.5, True, 'OK', None, 2 ** 70]
+    return [Event(1000 + index, 'source%d' % (index % 3), 'metric.%d' % index,
+                  ['cause'] if index % 4 == 0 else [], values[index % len(values)]) for index in range(count)]
+
+class TestHealthAggregator(unittest.TestCase):
+    '''
+    Set of unit tests designed to validate the health folding
+    '''
+    def test_most_severe(self):
+        '''
+        The most severe status added wins and every cause is kept
+        '''
+        health = HealthAggregator()
+        health.add('a', 'OK')
+        health.add('a', 'WARN', ['slow'])
+        health.add('a', 'OK')
+        health.add('b', True)
+        health.add('b', False, ['down'])
+        self.assertEqual([('a', 'WARN'), ('b', 'ERROR')], health.statuses())
+        self.assertEqual(['slow'], health.causes('a'))
+        self.assertEqual(['down'], health.causes('b'))
+        self.assertEqual('OK', health.status('c'))
+
+    def test_unknown_status(self):
+        '''
+        Anything which is not a status, None included, is reported as ERROR and not overridden
+        '''
+        health = HealthAggregator()
+        health.add('a', None)
+        health.add('a', 'OK')
+        health.add('b', 'bogus')
+        self.assertEqual([('a', 'ERROR'), ('b', 'ERROR')], health.statuses())
+        self.assertEqual(["'bogus' is not a health status"], health.causes('b'))
+        event = health.event('b', 'b.health', 1)
+        self.assertEqual('ERROR', event.value)
+
+    def test_repeated_warn(self):
+        '''
+        A second WARN makes an ERROR when asked to, an OK does not
+        '''
+        health = HealthAggregator(repeated_warn_is_error=True)
+        health.add('a', 'WARN', ['slow'])
+        health.add('a', 'OK')
+        health.add('b', 'WARN', ['slow'])
+        health.add('b', 'WARN', ['slower'])
+        self.assertEqual([('a', 'WARN'), ('b', 'ERROR')], health.statuses())
+        self.assertEqual(['slow', 'slower'], health.causes('b'))
+
+class TestEventBatch(unittest.TestCase):
+    '''
+    Set of unit tests designed to validate the columnar list of events
+    '''
+    def test_list_behaviour(self):
+        '''
+        Appended events are read back, counted, iterated and indexed as they were given
+        '''
+        events = sample_events(12)
+        batch = EventBatch(events[:6])
+        batch.append(events[6])
+        batch.extend(events[7:])
+        self.assertEqual(12, len(batch))
+        self.assertEqual(events, list(batch))
+        self.assertEqual(events[3], batch[3])
+        self.assertEqual(events[-1], batch[-1])
+        self.assertIs(True, batch[2].value)
+        self.assertRaises(IndexError, lambda: batch[12])
+
+    def test_slice(self):
+        '''
+        A slice is an EventBatch of the events in its range
+        '''
+        events = sample_events(10)
+        batch = EventBatch(events)
+        for part in (slice(None, 5), slice(5, None), slice(2, 8, 3), slice(-3, None), slice(20, 30)):
+            self.assertIsInstance(batch[part], EventBatch)
+            self.assertEqual(events[part], list(batch[part]))
+
+    @patch('sinks.TIMESTAMP_MILLIS', return_value=5000)
+    def test_json_payloads(self, _):
+        '''
+        A batch is serialised to the same payloads as the list of its events
+        '''
+        events = sample_events(20)
+        self.assertEqual(sinks.json_payloads(events), sinks.json_payloads(EventBatch(events)))
+        data = json.loads(sinks.json_payloads(EventBatch(events))[0].decode('utf8'))['data']
+        self.assertEqual({"source": "source0", "metric": "metric.0", "value": 1,
+                          "causes": '["cause"]', "timestamp": 1000}, data[0])
+
+    @patch('sinks.MAX_PAYLOAD', 1024)
+    def test_compact_payloads(self):
+        '''
+        A batch over the payload size is split in payloads which all fit and hold every event once
+        '''
+        events = sample_events(200)
+        bodies = sinks.compact_payloads(EventBatch(events))
+        self.assertGreater(len(bodies), 1)
+        rows = []
+        for body in bodies:
+            self.assertLessEqual(len(body), 1024)
+            payload = json.loads(body.decode('utf8'))
+            self.assertEqual(sinks.COMPACT_FIELDS, payload['fields'])
+            for source in payload['sources']:
+                rows.extend((source['source'], row[0]) for row in source['data'])
+        self.assertEqual(sorted((ev.source, ev.metric) for ev in events), sorted(rows))
+
+def strict_json(body):
+    '''
+    Parse body, failing on the NaN and Infinity constants JSON does not have
+    '''
+    def constant(name):
+        raise ValueError('%s is not JSON' % name)
+    return json.loads(body.decode('utf8'), parse_constant=constant)
+
+class TestNonFiniteValues(unittest.TestCase):
+    '''
+    Set of unit tests designed to validate NaN and infinite values are never sent as numbers
+    '''
+    EVENTS = [Event(1, 's', 'nan', [], float('nan')), Event(2, 's', 'inf', [], float('inf')),
+              Event(3, 's', 'read', [], parse_value('-Infinity')), Event(4, 's', 'ok', [], 0.5)]
+
+    def test_parse_value(self):
+        '''
+        Values which are not finite numbers stay as read
+        '''
+        self.assertEqual(12, parse_value('12'))
+        self.assertEqual(0.25, parse_value('0.25'))
+        self.assertEqual('NaN', parse_value('NaN'))
+        self.assertEqual('Infinity', parse_value('Infinity'))
+        self.assertEqual('-Infinity', parse_value('-Infinity'))
+        self.assertEqual('nan', parse_value('nan'))
+
+    def test_payloads(self):
+        '''
+        The json and compact payloads, of a list or of a batch, are strict JSON
+        '''
+        for events in (self.EVENTS, EventBatch(self.EVENTS)):
+            data = strict_json(sinks.json_payloads(events)[0])['data']
+            self.assertEqual(['NaN', 'Infinity', '-Infinity', 0.5], [item['value'] for item in data])
+            rows = strict_json(sinks.compact_payloads(events)[0])['sources'][0]['data']
+            self.assertEqual(['NaN', 'Infinity', '-Infinity', 0.5], [row[1] for row in rows])
+
+    def test_datapoints(self):
+        '''
+        Only finite values are put to OpenTSDB
+        '''
+        self.assertEqual([0.5], [point['value'] for point in sinks.datapoints(self.EVENTS)])
+
+def metric_values(events):
+    '''
+    {metric: value} of events
+    '''
+    return dict((event.metric, event.value) for event in events)
+
+class TestDeltaFilter(unittest.TestCase):
+    '''
+    Set of unit tests designed to validate the delta mode
+    '''
+    @staticmethod
+    def run_events(count, health='OK', status='OK', rate=0.5):
+        return [Event(1, 'kafka', 'kafka.count', [], count),
+                Event(1, 'kafka', 'kafka.rate', [], rate),
+                Event(1, 'kafka', 'kafka.health', [], health),
+                Event(1, 'kafka', 'kafka.broker.status', [], status)]
+
+    def test_suppression(self):
+        '''
+        Only the changed values, within the deadband for floats, and the health events are sent
+        '''
+        delta = DeltaFilter(10, deadband=0.1)
+        self.assertEqual(4, len(delta.filter(self.run_events(1))))
+        self.assertEqual({'kafka.health': 'OK', 'kafka.broker.status': 'OK'},
+                         metric_values(delta.filter(self.run_events(1, rate=0.52))))
+        self.assertEqual({'kafka.count': 2, 'kafka.rate': 0.6, 'kafka.health': 'WARN', 'kafka.broker.status': 'OK'},
+                         metric_values(delta.filter(self.run_events(2, health='WARN', rate=0.6))))
+
+    def test_causes_change(self):
+        '''
+        A value sent with other causes is sent again
+        '''
+        delta = DeltaFilter(10)
+        delta.filter([Event(1, 's', 'm', [], 1)])
+        self.assertEqual(0, len(delta.filter([Event(2, 's', 'm', [], 1)])))
+        self.assertEqual(1, len(delta.filter([Event(3, 's', 'm', ['broken'], 1)])))
+
+    def test_keyframes(self):
+        '''
+        Everything is sent every keyframe_every runs and on the run after a request
+        '''
+        delta = DeltaFilter(3)
+        sent = [len(delta.filter(self.run_events(1))) for _ in range(7)]
+        self.assertEqual([4, 2, 2, 4, 2, 2, 4], sent)
+        delta.request_keyframe()
+        self.assertEqual(4, len(delta.filter(self.run_events(1))))
+        self.assertEqual(2, len(delta.filter(self.run_events(1))))
+
+    def test_batch(self):
+        '''
+        A batch is filtered to a batch
+        '''
+        delta = DeltaFilter(10)
+        delta.filter(EventBatch(self.run_events(1)))
+        kept = delta.filter(EventBatch(self.run_events(2)))
+        self.assertIsInstance(kept, EventBatch)
+        self.assertEqual(['kafka.count', 'kafka.health', 'kafka.broker.status'], [event.metric for event in kept])
+
+    @patch('sys.stderr', new_callable=io.StringIO)
+    def test_delta_needs_interval(self, _):
+        '''
+        --delta is refused without --interval
+        '''
+        with patch('sys.argv', ['monitor.py', '--plugin', 'kafka', '--delta']):
+            self.assertRaises(SystemExit, monitor.read_args)
+        with patch('sys.argv', ['monitor.py', '--plugin', 'kafka', '--delta', '--interval', '60']):
+            self.assertTrue(monitor.read_args().delta)
+
+class TestOpenTsdbSink(unittest.TestCase):
+    '''
+    Set of unit tests designed to validate the OpenTSDB output
+    '''
+    def test_tags(self):
+        '''
+        Broker, topic and node identities are tags of generic metrics
+        '''
+        self.assertEqual(('kafka.brokers.topics.BytesInPerSec.Count', {'source': 'kafka', 'broker': '1', 'topic': 'avro.internal.test'}),
+                         sinks.tsdb_series('kafka', 'kafka.brokers.1.topics.avro.internal.test.BytesInPerSec.Count'))
+        self.assertEqual(('kafka.brokers.UnderReplicatedPartitions', {'source': 'kafka', 'broker': '3'}),
+                         sinks.tsdb_series('kafka', 'kafka.brokers.3.UnderReplicatedPartitions'))
+        self.assertEqual(('hadoop.HDFS.webhdfs.datanodes.read_ms', {'source': 'hadoop.HDFS', 'datanode': 'dn-0.example.com'}),
+                         sinks.tsdb_series('hadoop.HDFS', 'hadoop.HDFS.webhdfs.datanodes.dn-0.example.com.read_ms'))
+        self.assertEqual(('hadoop.HDFS.datanodes.gc_time_ms', {'source': 'HDFS', 'datanode': 'dn-0_example_com'}),
+                         sinks.tsdb_series('HDFS', 'hadoop.HDFS.datanodes.dn-0_example_com.gc_time_ms'))
+        self.assertEqual(('hadoop.YARN.nodemanagers.containers_running', {'source': 'YARN', 'nodemanager': 'nm-0_example_com'}),
+                         sinks.tsdb_series('YARN', 'hadoop.YARN.nodemanagers.nm-0_example_com.containers_running'))
+        self.assertEqual(('kafka.health_1', {'source': 'my_source'}), sinks.tsdb_series('my source', 'kafka.health#1'))
+
+    @patch('sinks.new_session')
+    def test_put(self, session_mock):
+        '''
+        Finite numeric values and health statuses are put in batches
+        '''
+        session = session_mock.return_value
+        session.post.return_value = MagicMock(status_code=204)
+        events = [Event(1000, 'kafka', 'kafka.brokers.%d.count' % index, [], index) for index in range(5)]
+        events += [Event(2000, 'kafka', 'kafka.health', [], 'WARN'), Event(2000, 'kafka', 'kafka.name', [], 'name'),
+                   Event(2000, 'kafka', 'kafka.rate', [], float('nan'))]
+        sink = sinks.OpenTsdbSink('tsdb:4242', batch_size=4, workers=2)
+        self.assertTrue(sink.send(events))
+
+        self.assertEqual(2, session.post.call_count)
+        points = []
+        for call in session.post.call_args_list:
+            self.assertEqual('http://tsdb:4242/api/put', call[0][0])
+            points.extend(strict_json(call[1]['data'].encode('utf8')))
+        self.assertEqual(6, len(points))
+        self.assertIn({"metric": "kafka.brokers.count", "timestamp": 1000, "value": 2, "tags": {"source": "kafka", "broker": "2"}}, points)
+        self.assertIn({"metric": "kafka.health", "timestamp": 2000, "value": 1, "tags": {"source": "kafka"}}, points)
+
+        session.post.return_value = MagicMock(status_code=400, text='bad')
+        self.assertFalse(sink.send(events))
+
+class TestKafkaSink(unittest.TestCase):
+    '''
+    Set of unit tests designed to validate the Kafka output
+    '''
+    @patch('kafka.KafkaProducer')
+    def test_records(self, producer_mock):
+        '''
+        Each event is published as an Avro record of the dataplatform schema holding it in JSON
+        '''
+        import avro.io
+        import avro.schema
+        sink = sinks.KafkaSink('broker1:9092,broker2:9092', 'avro.internal.platformtesting', AVRO_SCHEMA, linger_ms=50)
+        producer_mock.assert_called_once_with(bootstrap_servers=['broker1:9092', 'broker2:9092'], linger_ms=50,
+                                              compression_type='gzip')
+        events = [Event(1000, 'kafka', 'kafka.health', ['broker down'], 'ERROR'), Event(1001, 'kafka', 'kafka.rate', [], float('inf'))]
+        self.assertTrue(sink.send(events))
+
+        with open(AVRO_SCHEMA) as schema:
+            reader = avro.io.DatumReader(avro.schema.Parse(schema.read()))
+        producer = producer_mock.return_value
+        records = []
+        for call in producer.send.call_args_list:
+            self.assertEqual('avro.internal.platformtesting', call[0][0])
+            records.append(reader.read(avro.io.BinaryDecoder(io.BytesIO(call[0][1]))))
+        self.assertEqual([1000, 1001], [record['timestamp'] for record in records])
+        self.assertEqual('kafka', records[0]['src'])
+        self.assertEqual({"source": "kafka", "metric": "kafka.health", "value": "ERROR", "causes": ["broker down"], "timestamp": 1000},
+                         strict_json(records[0]['rawdata']))
+        self.assertEqual('Infinity', strict_json(records[1]['rawdata'])['value'])
+        producer.flush.assert_called_once_with(sink.timeout)
+
+class TestPrometheusSink(unittest.TestCase):
+    '''
+    Set of unit tests designed to validate the Prometheus endpoint
+    '''
+    def setUp(self):
+        self.sink = sinks.PrometheusSink(0, '127.0.0.1', stale_after=2)
+        self.url = 'http://127.0.0.1:%d/metrics' % self.sink.server.server_address[1]
+
+    def tearDown(self):
+        self.sink.close()
+
+    def scrape(self):
+        response = requests.get(self.url, timeout=5)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.text.splitlines()
+
+    def test_scrape(self):
+        '''
+        Samples are grouped per metric under a gauge TYPE line, floats in their shortest exact form
+        '''
+        self.sink.send([Event(1, 'kafka', 'kafka.rate', [], 0.1), Event(1, 'kafka', 'kafka.health', [], 'WARN'),
+                        Event(1, 'zk', 'kafka.rate', [], 1e-20), Event(1, 'kafka', 'kafka.name', [], 'name'),
+                        Event(1, 'kafka', 'kafka.up', [], True)])
+        self.assertEqual(['# TYPE kafka_rate gauge',
+                          'kafka_rate{source="kafka"} 0.1',
+                          'kafka_rate{source="zk"} 1e-20',
+                          '# TYPE kafka_health gauge',
+                          'kafka_health{source="kafka"} 1',
+                          '# TYPE kafka_up gauge',
+                          'kafka_up{source="kafka"} 1'], self.scrape())
+        self.sink.send([Event(2, 'kafka', 'kafka.rate', [], 0.25)])
+        self.assertIn('kafka_rate{source="kafka"} 0.25', self.scrape())
+
+    def test_stale_series(self):
+        '''
+        A series not sent in the last stale_after runs is not served any more
+        '''
+        self.sink.send([Event(1, 'kafka', 'kafka.brokers.1.count', [], 1), Event(1, 'kafka', 'kafka.brokers.2.count', [], 2)])
+        self.sink.send([Event(2, 'kafka', 'kafka.brokers.1.count', [], 1)])
+        self.assertEqual(4, len(self.scrape()))
+        self.sink.send([Event(3, 'kafka', 'kafka.brokers.1.count', [], 1)])
+        self.assertEqual(['# TYPE kafka_brokers_1_count gauge', 'kafka_brokers_1_count{source="kafka"} 1'], self.scrape())
+        self.sink.send([Event(4, 'kafka', 'kafka.brokers.2.count', [], 5)])
+        self.assertIn('kafka_brokers_2_count{source="kafka"} 5', self.scrape())
+
+    def test_not_found(self):
+        '''
+        Only /metrics is served
+        '''
+        self.assertEqual(404, requests.get(self.url.replace('/metrics', '/'), timeout=5).status_code)
+
+class TestHttpJsonSink(unittest.TestCase):
+    '''
+    Set of unit tests designed to validate the posts to the console data collector
+    '''
+    EVENTS = sample_events(300)
+
+    @patch('sinks.new_session')
+    def test_session_reuse(self, session_mock):
+        '''
+        Every post of every run goes through the one session, with the timeouts given
+        '''
+        session = session_mock.return_value
+        session.post.return_value = MagicMock(status_code=200)
+        sink = sinks.HttpJsonSink('http://console/metrics', timeout=(1.0, 2.0))
+        self.assertTrue(sink.send(self.EVENTS))
+        self.assertTrue(sink.send(self.EVENTS))
+        session_mock.assert_called_once_with(pool_size=1, headers={'Content-Type': 'application/json'})
+        self.assertEqual(2, session.post.call_count)
+        self.assertEqual(('http://console/metrics',), session.post.call_args[0])
+        self.assertEqual((1.0, 2.0), session.post.call_args[1]['timeout'])
+        sink.close()
+        session.close.assert_called_once_with()
+
+    @patch('sinks.new_session')
+    def test_compression(self, session_mock):
+        '''
+        The payloads are posted compressed with the Content-Encoding header of the session
+        '''
+        session = session_mock.return_value
+        session.post.return_value = MagicMock(status_code=200)
+        for compression, decompress in (('gzip', gzip.decompress), ('deflate', zlib.decompress)):
+            sink = sinks.HttpJsonSink('http://console/metrics', 'compact', compression)
+            self.assertEqual(compression, session_mock.call_args[1]['headers']['Content-Encoding'])
+            self.assertTrue(sink.send(self.EVENTS))
+            body = decompress(session.post.call_args[1]['data'])
+            self.assertEqual(300, sum(len(source['data']) for source in strict_json(body)['sources']))
+
+    @patch('sinks.MAX_PAYLOAD', 4096)
+    @patch('sinks.new_session')
+    def test_split(self, session_mock):
+        '''
+        The events are split in as many payloads as needed to fit the limit, before compression
+        '''
+        session = session_mock.return_value
+        session.post.return_value = MagicMock(status_code=200)
+        sink = sinks.HttpJsonSink('http://console/metrics', 'json', 'gzip')
+        self.assertTrue(sink.send(EventBatch(self.EVENTS)))
+        self.assertGreater(session.post.call_count, 1)
+        metrics = []
+        for call in session.post.call_args_list:
+            body = gzip.decompress(call[1]['data'])
+            self.assertLessEqual(len(body), 4096)
+            metrics.extend(item['metric'] for item in strict_json(body)['data'])
+        self.assertEqual([event.metric for event in self.EVENTS], metrics)
+
+    @patch('sinks.new_session')
+    def test_failures(self, session_mock):
+        '''
+        An error status or a failed post is reported as a failed send
+        '''
+        session = session_mock.return_value
+        sink = sinks.HttpJsonSink('http://console/metrics')
+        session.post.return_value = MagicMock(status_code=500)
+        self.assertFalse(sink.send(self.EVENTS))
+        session.post.side_effect = requests.exceptions.ConnectionError('refused')
+        self.assertFalse(sink.send(self.EVENTS))
+
+class TestStepTimer(unittest.TestCase):
+    '''
+    Set of unit tests designed to validate the step timings
+    '''
+    def test_histogram(self):
+        '''
+        Each step is reported as its total and the summary of its calls, then forgotten
+        '''
+        timer = StepTimer()
+        for milliseconds in (10, 20, 30, 40):
+            timer.record('jmx.fetch', 100.0 + milliseconds, milliseconds / 1000.0)
+        timer.record('zk.topics', 99.0, 0.005)
+        events = timer.events('platform-testing', 'platform-testing.kafka')
+        self.assertEqual({'platform-testing.kafka.jmx.fetch.ms': 100.0,
+                          'platform-testing.kafka.jmx.fetch.ms.count': 4,
+                          'platform-testing.kafka.jmx.fetch.ms.min': 10.0,
+                          'platform-testing.kafka.jmx.fetch.ms.max': 40.0,
+                          'platform-testing.kafka.jmx.fetch.ms.p50': 20.0,
+                          'platform-testing.kafka.jmx.fetch.ms.p95': 40.0,
+                          'platform-testing.kafka.jmx.fetch.ms.p99': 40.0,
+                          'platform-testing.kafka.zk.topics.ms': 5.0,
+                          'platform-testing.kafka.zk.topics.ms.count': 1,
+                          'platform-testing.kafka.zk.topics.ms.min': 5.0,
+                          'platform-testing.kafka.zk.topics.ms.max': 5.0,
+                          'platform-testing.kafka.zk.topics.ms.p50': 5.0,
+                          'platform-testing.kafka.zk.topics.ms.p95': 5.0,
+                          'platform-testing.kafka.zk.topics.ms.p99': 5.0}, metric_values(events))
+        self.assertEqual(set(['platform-testing']), set(event.source for event in events))
+        self.assertEqual(110000, events[0].timestamp)
+        self.assertEqual([], timer.events('platform-testing', 'platform-testing.kafka'))
+
+    def test_run_timer(self):
+        '''
+        Steps are only timed while a run timer is set
+        '''
+        @timed('decorated')
+        def decorated():
+            return 42
+
+        self.assertIs(NO_STEP, timed_step('step'))
+        self.assertEqual(42, decorated())
+        timer = StepTimer()
+        set_run_timer(timer)
+        try:
+            with timed_step('step'):
+                pass
+            self.assertEqual(42, decorated())
+            self.assertEqual(42, decorated())
+        finally:
+            set_run_timer(None)
+        self.assertEqual(42, decorated())
+        counts = metric_values(timer.events('s', 'p'))
+        self.assertEqual(1, counts['p.step.ms.count'])
+        self.assertEqual(2, counts['p.decorated.ms.count'])
+
+class FakeSink(sinks.Sink):
+    name = 'fake'
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, events):
+        self.sent.append(('send', list(events)))
+        return True
+
+    def send_more(self, events):
+        self.sent.append(('more', list(events)))
+        return True
+
+class TimedPlugin(object):
+    def runner(self, args, display=True):
+        with timed_step('zk.topics'):
+            pass
+        return [Event(1, 'kafka', 'kafka.health', [], 'OK')]
+
+class TestTimings(unittest.TestCase):
+    '''
+    Set of unit tests designed to validate the timings added by monitor.py --timings
+    '''
+    @staticmethod
+    def collector(*options):
+        with patch('sys.argv', ['monitor.py', '--plugin', 'kafka'] + list(options)):
+            collector = monitor.TestbotCollector(monitor.read_args())
+        collector._sinks = [FakeSink()]
+        return collector
+
+    def test_timings(self):
+        '''
+        The runtime, event count and steps come with the events of the run, the sends follow them
+        '''
+        collector = self.collector('--timings')
+        for _ in range(2):
+            collector._run_plugin(TimedPlugin())
+        sent = collector._sinks[0].sent
+        self.assertEqual(['send', 'more', 'send', 'more'], [kind for kind, _ in sent])
+        metrics = metric_values(sent[2][1])
+        self.assertEqual('OK', metrics['kafka.health'])
+        self.assertEqual(1, metrics['platform-testing.kafka.events'])
+        self.assertIn('platform-testing.kafka.runtime.ms', metrics)
+        self.assertEqual(1, metrics['platform-testing.kafka.zk.topics.ms.count'])
+        self.assertNotIn('platform-testing.kafka.send.fake.ms', metrics)
+        self.assertEqual(1, metric_values(sent[3][1])['platform-testing.kafka.send.fake.ms.count'])
+        self.assertIs(NO_STEP, timed_step('zk.topics'))
+
+    def test_no_timings(self):
+        '''
+        Without --timings the events of the plugin are sent as they are
+        '''
+        collector = self.collector()
+        collector._run_plugin(TimedPlugin())
+        self.assertEqual([('send', [Event(1, 'kafka', 'kafka.health', [], 'OK')])], collector._sinks[0].sent)
+
+def busy_worker(count):
+    '''
+    CPU bound work for a profiled thread
+    '''
+    return sum(index * index for index in range(count))
+
+def parallel_run(count):
+    '''
+    Plugin run doing its work in fetch_all workers
+    '''
+    return sorted(result for result, _ in fetch_all(busy_worker, [count, count + 1], max_workers=2).values())
+
+class TestRunProfiler(unittest.TestCase):
+    '''
+    Set of unit tests designed to validate the --profile reports
+    '''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def reports(self, extension):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.' + extension))
+
+    def test_sampling(self):
+        '''
+        The first run then one in every is profiled, every run returns its result
+        '''
+        profiler = profiling.RunProfiler(self.directory, every=3)
+        self.assertEqual([7] * 7, [profiler.run('kafka', lambda value: value, 7) for _ in range(7)])
+        self.assertEqual(['000001', '000004', '000007'], [name.split('.')[0][-6:] for name in self.reports('collapsed')])
+        self.assertEqual(3, len(self.reports('pstats')))
+        self.assertEqual([], self.reports('alloc.txt'))
+
+    def test_rotation(self):
+        '''
+        Only the reports of the last keep profiled runs of a plugin are kept
+        '''
+        open(os.path.join(self.directory, 'hdfs-20180101-000000-000001.collapsed'), 'w').close()
+        profiler = profiling.RunProfiler(self.directory, keep=2)
+        for _ in range(5):
+            profiler.run('kafka', len, 'abc')
+        kept = self.reports('collapsed')
+        self.assertEqual(['000004', '000005'], [name.split('.')[0][-6:] for name in kept if name.startswith('kafka-')])
+        self.assertIn('hdfs-20180101-000000-000001.collapsed', kept)
+        self.assertEqual(2, len(self.reports('pstats')))
+
+    def test_collapsed_stacks(self):
+        '''
+        The collapsed stacks hold the work of the run and of the threads it started
+        '''
+        profiler = profiling.RunProfiler(self.directory)
+        self.assertEqual([busy_worker(20000), busy_worker(20001)], profiler.run('kafka', parallel_run, 20000))
+        with open(os.path.join(self.directory, self.reports('collapsed')[0])) as report:
+            lines = report.read().splitlines()
+        for line in lines:
+            stack, microseconds = line.rsplit(' ', 1)
+            self.assertGreaterEqual(int(microseconds), profiling.MIN_STACK_US)
+            self.assertNotIn(' ', stack)
+        self.assertTrue(any(line.split(' ')[0].split(';')[0].endswith('(parallel_run)') for line in lines))
+        self.assertTrue(any('(busy_worker);' in line for line in lines))
+
+    def test_memory(self):
+        '''
+        With memory, the peak and the top allocation sites of the run are reported
+        '''
+        profiler = profiling.RunProfiler(self.directory, memory=True, top=3)
+        kept = profiler.run('kafka', lambda count: [bytearray(1024) for _ in range(count)], 100)
+        self.assertEqual(100, len(kept))
+        with open(os.path.join(self.directory, self.reports('alloc.txt')[0])) as report:
+            lines = report.read().splitlines()
+        self.assertTrue(lines[0].startswith('peak '))
+        self.assertLessEqual(len(lines), 4)
+        self.assertIn('unittests.py', lines[1])
+
+    def test_failed_run(self):
+        '''
+        A run which raises is still reported
+        '''
+        profiler = profiling.RunProfiler(self.directory)
+        self.assertRaises(ZeroDivisionError, profiler.run, 'kafka', lambda: 1 / 0)
+        self.assertEqual(1, len(self.reports('collapsed')))
+
+# monitor.py started as in a run, then the modules it imported
+STARTUP = ("import sys, json; sys.argv = ['monitor.py', '--plugin', 'kafka'] + sys.argv[1:];"
+           "import monitor; monitor.TestbotCollector(monitor.read_args());"
+           "print(json.dumps(sorted(sys.modules)))")
+
+def startup_modules(*args):
+    '''
+    Top level packages imported by the startup of monitor.py with args, in a fresh interpreter
+    '''
+    output = subprocess.check_output([sys.executable, '-c', STARTUP] + list(args),
+                                      cwd=os.path.dirname(os.path.abspath(monitor.__file__)),
+                                      universal_newlines=True)
+    return set(name.split('.')[0] for name in json.loads(output))
+
+class TestStartup(unittest.TestCase):
+    '''
+    Set of unit tests designed to validate that the startup stays light
+    '''
+    def test_no_backend_imported(self):
+        '''
+        Argument parsing and the collector setup import no backend client, nor the sinks
+        or the profiler when no output nor profiling is asked for
+        '''
+        modules = startup_modules()
+        self.assertEqual(set(), modules & set(BACKENDS + ('profiling',)))
+        for backend in ('requests', 'happybase', 'impala', 'kafka', 'avro'):
+            self.assertNotIn(backend, modules)
+
+    def test_lazy_imports(self):
+        '''
+        The sinks and the profiler are imported once an output or profiling is asked for
+        '''
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        modules = startup_modules('--postjson', 'http://localhost:1/metrics', '--profile', directory)
+        self.assertIn('sinks', modules)
+        self.assertIn('profiling', modules)
+        self.assertIn('requests', modules)
+
+    def test_discover_plugins(self):
+        '''
+        Every directory of plugins/ holding a TestbotPlugin.py is a plugin, found without importing it
+        '''
+        plugins_dir = os.path.join(os.path.dirname(os.path.abspath(monitor.__file__)), 'plugins')
+        expected = sorted(name for name in os.listdir(plugins_dir)
+                          if os.path.isfile(os.path.join(plugins_dir, name, 'TestbotPlugin.py')))
+        plugins = monitor.discover_plugins()
+
+        self.assertEqual(expected, plugins)
+        for plugin in ('hadoop_blackbox', 'hdfs', 'hdp', 'kafka', 'opentsdb', 'zookeeper'):
+            self.assertIn(plugin, plugins)
+        self.assertNotIn('common', plugins)
+
+if __name__ == '__main__':
+    unittest.main()